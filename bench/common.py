@@ -0,0 +1,78 @@
+"""
+Общее для бенчмарков: временный каталог с конфигом (база SQLite, если
+не задана другая) и импорт модулей сервера из server/src
+"""
+
+import json
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(ROOT, "server", "src")
+CONTEXTS_DIR = os.path.join(ROOT, "server", "contexts")
+
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+
+def percentile(values: list[float], q: float) -> float:
+    """
+    Квантиль q (от 0 до 1) списка значений
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def write_config(workdir: str, **overrides) -> str:
+    """
+    Записывает в workdir config.json для локального запуска (SQLite
+    в workdir, заглушки вместо ключей, без лимитов частоты и кэша).
+    overrides - ключи конфига поверх этих настроек
+    """
+    config = {
+        "client_secret": "bench",
+        "db_user": "",
+        "db_password": "",
+        "db_port": 0,
+        "db_host": "",
+        "db_name": "",
+        "db_uri": f"sqlite:///{os.path.join(workdir, 'bench.sqlite')}",
+        "api_tokens": ["sk-bench-0", "sk-bench-1", "sk-bench-2", "sk-bench-3"],
+        "contexts_dir": CONTEXTS_DIR,
+        "log_dir": os.path.join(workdir, "logs"),
+        "metrics_dir": None,
+        "cache_methods": [],
+        "rate_user_rate": 0,
+        "rate_group_rate": 0,
+    }
+    config.update(overrides)
+    path = os.path.join(workdir, "config.json")
+    with open(path, "w", encoding="UTF-8") as file:
+        json.dump(config, file)
+    return path
+
+
+def make_workdir(**overrides) -> str:
+    """
+    Создает временный каталог с config.json и переходит в него
+    (server.py читает config.json из текущего каталога)
+    """
+    workdir = tempfile.mkdtemp(prefix="strawberry_bench_")
+    write_config(workdir, **overrides)
+    os.chdir(workdir)
+    return workdir
+
+
+def load_server(**overrides):
+    """
+    Импортирует server с временным конфигом и готовой схемой базы
+    """
+    make_workdir(**overrides)
+    import server  # pylint: disable=import-outside-toplevel
+
+    server.db.migrate()
+    server.setup_key_slots()
+    return server
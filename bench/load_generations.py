@@ -0,0 +1,111 @@
+"""
+Нагрузочный бенчмарк генераций: ask_nn (очередь, ключи, запрос к
+нейросети, запись в базу) против локальной заглушки провайдера
+с постоянной задержкой. Показывает, как пропускная способность одного
+процесса растет с числом одновременных генераций:
+
+python bench/load_generations.py --latency 1.0 --levels 1 8 32 128 512
+
+Пока генерации выполнялись в пуле потоков Starlette (40 потоков),
+пропускная способность упиралась в 40 / latency генераций в секунду
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+
+from common import load_server, percentile
+from stub_model import StubModel
+
+STARLETTE_THREADS = 40
+
+
+async def run_level(server, concurrency: int, rounds: int) -> dict:
+    """
+    Выполняет concurrency * rounds генераций, не больше concurrency
+    одновременно. Возвращает пропускную способность и задержки
+    """
+    count = concurrency * rounds
+    gen_ids = [
+        server.db.add_record(
+            f"клубника {index}", 1, "generate_text", 1, int(time.time()), "web"
+        )
+        for index in range(count)
+    ]
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def generate(index: int, gen_id: int):
+        async with semaphore:
+            start = time.perf_counter()
+            # Разные затравки: одинаковые генерации объединились бы
+            await server.ask_nn(
+                "generate_text",
+                ["Пост о летнем урожае клубники", "Пост о варенье"],
+                f"клубника {index}",
+                gen_id,
+                user_id=index + 1,
+            )
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(generate(i, gen_id) for i, gen_id in enumerate(gen_ids)))
+    elapsed = time.perf_counter() - start
+
+    failed = sum(server.db.get_status(gen_id) != 1 for gen_id in gen_ids)
+    return {
+        "throughput": count / elapsed,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "failed": failed,
+    }
+
+
+async def main_async(args):
+    stub = StubModel(latency=args.latency, jitter=args.jitter)
+    url = await stub.start()
+    server = load_server(
+        nn_api_base=url,
+        key_max_in_flight=max(args.levels),
+        nn_hedge=False,
+        scheduler_max_queue=max(args.levels) * 2,
+        scheduler_max_user_queue=max(args.levels) * 2,
+    )
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print(f"stub latency {args.latency} s, {args.rounds} rounds per level")
+    print(
+        f"thread pool bound of the old path: "
+        f"{STARLETTE_THREADS / args.latency:.1f} gen/s"
+    )
+    print(f"{'concurrency':>11} {'gen/s':>8} {'p50, s':>8} {'p99, s':>8} {'failed':>6}")
+    try:
+        for concurrency in args.levels:
+            stub.max_in_flight = 0
+            result = await run_level(server, concurrency, args.rounds)
+            print(
+                f"{concurrency:>11} {result['throughput']:>8.1f} "
+                f"{result['p50']:>8.3f} {result['p99']:>8.3f} {result['failed']:>6}"
+                f"   (stub in flight: {stub.max_in_flight})"
+            )
+    finally:
+        await stub.stop()
+
+
+def main():
+    """
+    Разбор аргументов и запуск бенчмарка
+    """
+    parser = argparse.ArgumentParser(description="Generation throughput benchmark")
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument(
+        "--levels", type=int, nargs="+", default=[1, 8, 32, 128, 512]
+    )
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
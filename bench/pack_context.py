@@ -0,0 +1,155 @@
+"""
+Бенчмарк упаковки контекста (NNApi.prepare_query): время упаковки
+и заполнение бюджета токенов на корпусе русских постов, по методам
+генерации, в сравнении со старой упаковкой по 3000 символов:
+
+python bench/pack_context.py --vocab vocab/cl100k_base.tiktoken
+python bench/pack_context.py --corpus posts.json
+
+Без --corpus посты генерируются (русский текст с эмодзи, хэштегами
+и ссылками, длины - логнормальные, как у постов сообществ). Корпус -
+JSON-список строк. С --vocab токены упакованного запроса считаются
+точно, без него - той же оценкой, которой пакует сервер
+"""
+
+import argparse
+import json
+import random
+import time
+
+from common import CONTEXTS_DIR, percentile
+from models import GenerationMethod
+from nn_api import (
+    MESSAGE_OVERHEAD_TOKENS,
+    MODEL_CONTEXT_TOKENS,
+    SYSTEM_PROMPT,
+    NNApi,
+)
+from templates import TemplateRegistry
+from tokens import TokenCounter, make_token_counter
+
+# Старая упаковка: посты добавлялись, пока запрос короче 3000 символов
+OLD_MAX_CHARS = 3000
+
+WORDS = (
+    "клубника урожай лето сад грядка ягода сезон варенье рецепт сахар "
+    "неделя сообщество подписчики новости город парк выставка фестиваль "
+    "скидка магазин доставка заказ открытие команда проект встреча "
+    "праздник концерт билеты погода выходные семья дети школа книга "
+    "спорт тренировка победа турнир участники приз конкурс розыгрыш "
+    "сегодня завтра вечером утром обязательно приходите ждем вас"
+).split()
+EMOJI = ["🍓", "🔥", "🎉", "❤️", "👍", "😊", "👨‍👩‍👧", "🇷🇺", "✨", "📍"]
+
+
+def make_post(rng: random.Random) -> str:
+    """
+    Пост сообщества: предложения из слов, эмодзи, хэштеги и ссылки
+    """
+    length = min(int(rng.lognormvariate(5.8, 0.8)), 4000)
+    parts = []
+    size = 0
+    while size < length:
+        sentence = " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 14)))
+        sentence = sentence.capitalize() + rng.choice([".", "!", "?", "..."])
+        if rng.random() < 0.3:
+            sentence += " " + rng.choice(EMOJI)
+        parts.append(sentence)
+        size += len(sentence) + 1
+    if rng.random() < 0.4:
+        parts.append(" ".join(f"#{rng.choice(WORDS)}" for _ in range(3)))
+    if rng.random() < 0.2:
+        parts.append(f"https://vk.com/club{rng.randint(1, 10**8)}")
+    return " ".join(parts)
+
+
+def pack_by_chars(template, texts: list[str], hint: str) -> str:
+    """
+    Старая упаковка по числу символов (до перехода на токены)
+    """
+    static_len = len(template.static_text)
+    source = ""
+    for text in texts:
+        if len(source) + len(text) + len(hint) + static_len >= OLD_MAX_CHARS:
+            continue
+        source += f"{text}\n\n"
+    return template.render(source, hint).strip()
+
+
+def prompt_tokens(counter: TokenCounter, query: str) -> int:
+    """
+    Токены всего запроса к модели: системный промпт и упакованный запрос
+    """
+    return (
+        MESSAGE_OVERHEAD_TOKENS + counter.count(SYSTEM_PROMPT) + counter.count(query)
+    )
+
+
+def main():
+    """
+    Разбор аргументов и запуск бенчмарка
+    """
+    parser = argparse.ArgumentParser(description="Context packing benchmark")
+    parser.add_argument("--corpus", help="JSON list of posts")
+    parser.add_argument("--vocab", help="tiktoken vocabulary file for exact counts")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--posts", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.corpus:
+        with open(args.corpus, "r", encoding="UTF-8") as corpus_file:
+            corpus = json.load(corpus_file)
+    else:
+        corpus = [make_post(rng) for _ in range(5000)]
+
+    packer = TokenCounter()
+    exact = make_token_counter("cl100k_base", args.vocab) if args.vocab else packer
+    measure = "exact" if exact.name == "tiktoken" else "estimated"
+    templates = TemplateRegistry(CONTEXTS_DIR)
+
+    print(
+        f"{len(corpus)} posts, {args.requests} requests of {args.posts} posts, "
+        f"prompt tokens {measure}"
+    )
+    print(
+        f"{'method':>16} {'pack p50, us':>12} {'pack p99, us':>12} "
+        f"{'use':>6} {'min use':>7} {'over':>5} {'old use':>7} {'old over':>8}"
+    )
+    for method in GenerationMethod:
+        template = templates.get(method)
+        times = []
+        use = []
+        old_use = []
+        overflows = 0
+        old_overflows = 0
+        for _ in range(args.requests):
+            texts = rng.sample(corpus, min(args.posts, len(corpus)))
+            hint = ""
+            if method != GenerationMethod.GENERATE_FROM_SCRATCH:
+                hint = make_post(rng)[:rng.randint(20, 400)]
+            api = NNApi(template, method, packer)
+            start = time.perf_counter()
+            api.prepare_query(texts, hint)
+            times.append((time.perf_counter() - start) * 1e6)
+
+            # Сколько окна занял запрос из того, что осталось после ответа
+            available = MODEL_CONTEXT_TOKENS - api.reply_tokens
+            tokens = prompt_tokens(exact, api.query)
+            use.append(tokens / available)
+            overflows += tokens > available
+            old_tokens = prompt_tokens(exact, pack_by_chars(template, texts, hint))
+            old_use.append(old_tokens / available)
+            old_overflows += old_tokens > available
+
+        print(
+            f"{method.value:>16} {percentile(times, 0.5):>12.0f} "
+            f"{percentile(times, 0.99):>12.0f} "
+            f"{sum(use) / len(use):>6.1%} {min(use):>7.1%} {overflows:>5} "
+            f"{sum(old_use) / len(old_use):>7.1%} {old_overflows:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+Симуляция очереди генераций на смешанной нагрузке: юзеры присылают
+генерации разных методов (стоимость - NNApi.estimated_cost настоящих
+запросов на сгенерированных постах), время выполнения пропорционально
+стоимости. Сравниваются FairScheduler и общая очередь по приходу (FIFO),
+по каждому методу - квантили задержки (ожидание и выполнение):
+
+python bench/schedule_mix.py --load 0.9 --requests 2000
+
+Время сжато в --time-scale раз: задержки в отчете - в секундах модели.
+
+Цена честной очереди - хвост длинных генераций. У тяжелого юзера (пятая
+часть нагрузки) они ждут, пока выполнятся его же дешевые правки и запросы
+других юзеров: это и есть защита остальных от него, p99 его генераций
+в разы больше, чем в FIFO. У остальных юзеров p99 длинных генераций
+растет умеренно; бенчмарк завершается с ошибкой, если p99 какого-либо
+метода у них хуже FIFO больше чем в --max-slowdown раз
+"""
+
+import argparse
+import asyncio
+import random
+import sys
+import time
+
+from common import CONTEXTS_DIR, percentile
+from models import GenerationMethod
+from nn_api import NNApi
+from pack_context import make_post
+from scheduler import FairScheduler
+from templates import TemplateRegistry
+from tokens import TokenCounter
+
+# Доля методов в нагрузке: правки частые и короткие, генерации редкие и длинные
+MIX = {
+    GenerationMethod.GENERATE: 0.25,
+    GenerationMethod.GENERATE_FROM_SCRATCH: 0.1,
+    GenerationMethod.APPEND: 0.1,
+    GenerationMethod.EXTEND: 0.1,
+    GenerationMethod.REPHRASE: 0.15,
+    GenerationMethod.SUMMARIZE: 0.05,
+    GenerationMethod.UNMASK: 0.05,
+    GenerationMethod.FIX_GRAMMAR: 0.2,
+}
+# Скорость модели: единиц стоимости в секунду (generate_text ~ 7 с)
+COST_PER_SECOND = 1800.0
+# Юзер, который шлет пятую часть нагрузки
+HEAVY_USER = 0
+
+
+def make_workload(args, rng: random.Random) -> list[tuple[float, int, str, float]]:
+    """
+    Запросы (время прихода, юзер, метод, стоимость). Пятая часть
+    нагрузки - от одного юзера, который шлет пакеты генераций
+    """
+    templates = TemplateRegistry(CONTEXTS_DIR)
+    counter = TokenCounter()
+    corpus = [make_post(rng) for _ in range(500)]
+    methods = list(MIX)
+    weights = list(MIX.values())
+
+    requests = []
+    for _ in range(args.requests):
+        method = rng.choices(methods, weights)[0]
+        api = NNApi(templates.get(method), method, counter)
+        hint = ""
+        if method != GenerationMethod.GENERATE_FROM_SCRATCH:
+            hint = make_post(rng)[:rng.randint(40, 600)]
+        api.prepare_query(rng.sample(corpus, 20), hint)
+        if rng.random() < 0.2:
+            user_id = HEAVY_USER
+        else:
+            user_id = rng.randint(1, args.users)
+        requests.append((user_id, method.value, api.estimated_cost()))
+
+    # Приход по Пуассону с интенсивностью под заданную загрузку
+    mean_cost = sum(cost for _, _, cost in requests) / len(requests)
+    mean_service = mean_cost / COST_PER_SECOND
+    rate = args.load * args.concurrency / mean_service
+    arrival = 0.0
+    workload = []
+    for user_id, method, cost in requests:
+        arrival += rng.expovariate(rate)
+        workload.append((arrival, user_id, method, cost))
+    return workload
+
+
+async def replay(workload, args, scheduler: FairScheduler = None) -> dict:
+    """
+    Проигрывает нагрузку через FairScheduler или, без него, через
+    общую очередь по приходу. Возвращает задержки, с, по (методу,
+    "heavy" - тяжелый юзер или "others" - остальные)
+    """
+    fifo = asyncio.Semaphore(args.concurrency)
+    latencies: dict[tuple[str, str], list[float]] = {}
+    start = time.perf_counter()
+
+    async def run(arrival: float, user_id: int, method: str, cost: float):
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(max(arrival * args.time_scale - elapsed, 0))
+        arrived = time.perf_counter()
+        service = cost / COST_PER_SECOND * args.time_scale
+        if scheduler is None:
+            async with fifo:
+                await asyncio.sleep(service)
+        else:
+            async with scheduler.turn(user_id, cost):
+                await asyncio.sleep(service)
+        latency = (time.perf_counter() - arrived) / args.time_scale
+        group = "heavy" if user_id == HEAVY_USER else "others"
+        latencies.setdefault((method, group), []).append(latency)
+
+    await asyncio.gather(*(run(*request) for request in workload))
+    return latencies
+
+
+def slowdown(results: dict[str, dict]) -> dict[str, float]:
+    """
+    Во сколько раз p99 задержки остальных (не тяжелого) юзеров
+    в честной очереди больше, чем в FIFO, по методам
+    """
+    ratios = {}
+    for method in MIX:
+        fair, fifo = (
+            percentile(results[name].get((method.value, "others"), []), 0.99)
+            for name in ("fair", "fifo")
+        )
+        ratios[method.value] = fair / fifo if fifo else 1.0
+    return ratios
+
+
+def simulate(args) -> dict[str, dict]:
+    """
+    Проигрывает одну и ту же нагрузку через FIFO и FairScheduler
+    """
+    workload = make_workload(args, random.Random(args.seed))
+    policies = {
+        "fifo": None,
+        "fair": FairScheduler(
+            args.concurrency,
+            quantum=args.quantum,
+            max_queue=len(workload),
+            max_tenant_queue=len(workload),
+            aging=args.aging,
+        ),
+    }
+    return {
+        name: asyncio.run(replay(workload, args, scheduler))
+        for name, scheduler in policies.items()
+    }
+
+
+def parse_args(argv: list[str] = None) -> argparse.Namespace:
+    """
+    Аргументы симуляции
+    """
+    parser = argparse.ArgumentParser(description="Generation queue simulation")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--load", type=float, default=0.9)
+    parser.add_argument("--time-scale", type=float, default=0.01)
+    parser.add_argument("--quantum", type=float, default=4000.0)
+    parser.add_argument("--aging", type=float, default=1000.0)
+    parser.add_argument("--max-slowdown", type=float, default=1.3)
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def main():
+    """
+    Разбор аргументов и запуск симуляции
+    """
+    args = parse_args()
+    print(
+        f"{args.requests} requests, load {args.load}, concurrency {args.concurrency}"
+    )
+    results = simulate(args)
+
+    print(
+        f"{'method':>16} {'policy':>6} {'p50, s':>8} {'p95, s':>8} {'p99, s':>8} "
+        f"{'heavy p99':>10}"
+    )
+    for method in MIX:
+        for name, latencies in results.items():
+            values = latencies.get((method.value, "others"), [])
+            heavy = latencies.get((method.value, "heavy"), [])
+            print(
+                f"{method.value:>16} {name:>6} {percentile(values, 0.5):>8.1f} "
+                f"{percentile(values, 0.95):>8.1f} {percentile(values, 0.99):>8.1f} "
+                f"{percentile(heavy, 0.99):>10.1f}"
+            )
+
+    worst, ratio = max(slowdown(results).items(), key=lambda item: item[1])
+    print(f"worst p99 slowdown for other users: {worst} x{ratio:.2f}")
+    if ratio > args.max_slowdown:
+        print(f"slowdown is above --max-slowdown {args.max_slowdown}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
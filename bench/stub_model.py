@@ -0,0 +1,194 @@
+"""
+Локальная заглушка API нейросети (POST /v1/chat/completions в формате
+openai, обычный ответ и стрим) с внедрением сбоев: задержка с разбросом,
+ошибки провайдера и зависания. Для бенчмарков и тестов, отдельно:
+
+python bench/stub_model.py --port 8100 --latency 1.0 --error-rate 0.1
+
+Адрес заглушки (http://127.0.0.1:8100/v1) задается в nn_api_base конфига
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import socket
+import time
+
+from collections import Counter
+
+from aiohttp import web
+
+# Сценарии одного запроса: обычный ответ, ошибка провайдера, зависание
+OK = "ok"
+ERROR = "error"
+STALL = "stall"
+
+
+class StubModel:
+    """
+    Заглушка провайдера. Сценарий запроса берется из очереди faults
+    (для детерминированных тестов), а когда она пуста - случайно
+    по error_rate и stall_rate. Считает запросы по ключам и наибольшее
+    число одновременных запросов
+    """
+
+    def __init__(
+        self,
+        latency: float = 1.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+        stall_rate: float = 0.0,
+        stall_time: float = 3600.0,
+        chunks: int = 8,
+        faults: list[str] = None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.stall_rate = stall_rate
+        self.stall_time = stall_time
+        self.chunks = chunks
+        self.faults = list(faults or [])
+        self.requests = 0
+        self.outcomes = Counter()
+        self.keys = Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.runner = None
+        self.url = None
+
+    def _scenario(self) -> str:
+        if self.faults:
+            return self.faults.pop(0)
+        roll = random.random()
+        if roll < self.stall_rate:
+            return STALL
+        if roll < self.stall_rate + self.error_rate:
+            return ERROR
+        return OK
+
+    def _delay(self) -> float:
+        return max(random.gauss(self.latency, self.jitter), 0.0)
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        """
+        Ответ на /v1/chat/completions
+        """
+        body = await request.json()
+        scenario = self._scenario()
+        self.requests += 1
+        self.outcomes[scenario] += 1
+        self.keys[request.headers.get("Authorization", "")[len("Bearer "):]] += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if scenario == STALL:
+                await asyncio.sleep(self.stall_time)
+            if scenario == ERROR:
+                await asyncio.sleep(self._delay())
+                return web.json_response(
+                    {"error": {"message": "Injected failure", "type": "server_error"}},
+                    status=self.error_status,
+                )
+            prompt = body["messages"][-1]["content"]
+            content = f"Ответ заглушки на запрос из {len(prompt)} символов"
+            if body.get("stream"):
+                return await self._stream(request, content)
+            await asyncio.sleep(self._delay())
+            return web.json_response(
+                {
+                    "id": f"stub-{self.requests}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", "stub"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                }
+            )
+        finally:
+            self.in_flight -= 1
+
+    async def _stream(self, request: web.Request, content: str) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        words = content.split(" ")
+        step = max(len(words) // self.chunks, 1)
+        for start in range(0, len(words), step):
+            await asyncio.sleep(self._delay() / self.chunks)
+            delta = " ".join(words[start:start + step]) + " "
+            chunk = {"choices": [{"index": 0, "delta": {"content": delta}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        Запускает заглушку в текущем event loop, возвращает адрес для
+        nn_api_base. port=0 - любой свободный порт
+        """
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        # Зависшие запросы при остановке долго не ждем
+        self.runner = web.AppRunner(app, shutdown_timeout=1.0)
+        await self.runner.setup()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        await web.SockSite(self.runner, sock).start()
+        self.url = f"http://{host}:{sock.getsockname()[1]}/v1"
+        return self.url
+
+    async def stop(self):
+        """
+        Останавливает заглушку
+        """
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+def main():
+    """
+    Запускает заглушку отдельным процессом
+    """
+    parser = argparse.ArgumentParser(description="Stub model provider")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--stall-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    stub = StubModel(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        stall_rate=args.stall_rate,
+    )
+
+    async def serve():
+        print(f"Stub model: {await stub.start(args.host, args.port)}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await stub.stop()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
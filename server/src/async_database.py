@@ -0,0 +1,244 @@
+"""
+Модуль с асинхронным доступом к базе данных для корутин
+"""
+
+import time
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+from starlette.concurrency import run_in_threadpool
+
+from database import Database
+from db_common import (
+    DBException,
+    engine_pool_options,
+    pool_stats,
+    new_record,
+    record_result,
+    available_jobs,
+    job_candidates,
+    lease_job_query,
+    extend_lease_query,
+    finish_job_query,
+    exhausted_jobs,
+    expire_queries,
+)
+
+
+class ThreadedDatabase:
+    """
+    Асинхронная обертка над Database: каждый метод выполняется
+    в пуле потоков, чтобы не блокировать event loop
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    def pool_stats(self) -> dict:
+        """
+        Загрузка пула соединений
+        """
+        return self.db.pool_stats()
+
+    def __getattr__(self, name: str):
+        method = getattr(self.db, name)
+
+        async def call(*args, **kwargs):
+            return await run_in_threadpool(method, *args, **kwargs)
+
+        return call
+
+
+class AsyncDatabase(ThreadedDatabase):
+    """
+    Асинхронная база на SQLAlchemy asyncio (aiomysql для MariaDB, aiosqlite
+    для SQLite). Методы горячего пути и очереди задач работают без потоков,
+    остальные методы Database идут через пул потоков, как в ThreadedDatabase
+    """
+
+    def __init__(self, db: Database, uri: str = None, pool_options: dict = None):
+        super().__init__(db)
+        self.database_uri = uri or db.database_uri.replace(
+            "mysql+pymysql://", "mysql+aiomysql://"
+        ).replace("sqlite://", "sqlite+aiosqlite://")
+        self.engine = create_async_engine(
+            self.database_uri, **engine_pool_options(self.database_uri, pool_options)
+        )
+        self.generated_data = db.generated_data
+        self.generation_jobs = db.generation_jobs
+
+    def pool_stats(self) -> dict:
+        """
+        Загрузка пула соединений
+        """
+        return pool_stats(self.engine.sync_engine.pool)
+
+    async def _execute(self, method: str, query):
+        """
+        Выполняет запрос в своей транзакции, ошибки - DBException от method
+        """
+        try:
+            async with self.engine.begin() as connection:
+                return await connection.execute(query)
+        except Exception as exc:
+            raise DBException(f"Error in {method}: {exc}") from exc
+
+    async def add_record(
+        self,
+        query: str,
+        user_id: str,
+        gen_method: str,
+        group_id: int,
+        unix_date: int,
+        platform: str,
+    ) -> int:
+        """
+        Добавляет запись о генерации, возвращает ее айди
+        """
+        try:
+            async with self.engine.begin() as connection:
+                record = {
+                    "query": query,
+                    "user_id": user_id,
+                    "method": gen_method,
+                    "group_id": group_id,
+                    "unix_date": unix_date,
+                    "platform": platform,
+                }
+                result = await connection.execute(
+                    new_record(self.generated_data, **record)
+                )
+                return int(result.inserted_primary_key[0])
+        except Exception as exc:
+            raise DBException(f"Error in add_record: {exc}") from exc
+
+    async def add_record_result(
+        self,
+        text_id: int,
+        text: str,
+        gen_time: int,
+        is_ok: bool = True,
+    ):
+        """
+        Добавляет в запись результат генерации и потраченное время
+        """
+        await self._execute(
+            "add_record_result",
+            record_result(self.generated_data, text_id, text, gen_time, is_ok),
+        )
+
+    async def get_status(self, text_id: int) -> int:
+        """
+        Получает статус генерации
+        """
+        try:
+            async with self.engine.connect() as connection:
+                result = await connection.execute(
+                    select(self.generated_data.c.status).where(
+                        self.generated_data.c.id == text_id
+                    )
+                )
+                return int(result.fetchall()[0][0])
+        except Exception as exc:
+            raise DBException(f"Error in get_status: {exc}") from exc
+
+    async def get_value(self, text_id: int) -> str:
+        """
+        Получает результат генерации
+        """
+        try:
+            async with self.engine.connect() as connection:
+                result = await connection.execute(
+                    select(self.generated_data.c.text).where(
+                        self.generated_data.c.id == text_id
+                    )
+                )
+                return str(result.fetchall()[0][0])
+        except Exception as exc:
+            raise DBException(f"Error in get_value: {exc}") from exc
+
+    async def user_owns_post(self, user_id: int, text_id: int) -> bool:
+        """
+        Проверяет, принадлежит ли пост пользователю
+        """
+        try:
+            async with self.engine.connect() as connection:
+                result = await connection.execute(
+                    select(self.generated_data.c.user_id).where(
+                        self.generated_data.c.id == text_id
+                    )
+                )
+                rows = result.fetchall()
+                return bool(rows) and int(rows[0][0]) == user_id
+        except Exception as exc:
+            raise DBException(f"Error in user_owns_post: {exc}") from exc
+
+    async def lease_job(
+        self,
+        worker: str,
+        visibility_timeout: int,
+        max_attempts: int,
+    ):
+        """
+        Забирает задачу из очереди, как Database.lease_job.
+        Возвращает (job_id, gen_id, payload) или None
+        """
+        jobs = self.generation_jobs
+        now = int(time.time())
+        available = available_jobs(jobs, now, max_attempts)
+        candidates = await self._execute("lease_job", job_candidates(jobs, available))
+        for candidate in candidates.fetchall():
+            leased = await self._execute(
+                "lease_job",
+                lease_job_query(
+                    jobs, candidate, available, worker, now + visibility_timeout
+                ),
+            )
+            if leased.rowcount == 1:
+                job_id, gen_id, payload, _ = candidate
+                return int(job_id), int(gen_id), str(payload)
+        return None
+
+    async def extend_job_lease(self, job_id: int, worker: str, visibility_timeout: int):
+        """
+        Продлевает аренду задачи, пока воркер над ней работает
+        """
+        until = int(time.time()) + visibility_timeout
+        await self._execute(
+            "extend_job_lease",
+            extend_lease_query(self.generation_jobs, job_id, worker, until),
+        )
+
+    async def finish_job(self, job_id: int, worker: str, is_ok: bool = True):
+        """
+        Отмечает задачу выполненной (или окончательно упавшей)
+        """
+        await self._execute(
+            "finish_job",
+            finish_job_query(self.generation_jobs, job_id, worker, is_ok),
+        )
+
+    async def expire_jobs(self, max_attempts: int) -> list[int]:
+        """
+        Закрывает задачи, которые исчерпали попытки, и ставит
+        их генерациям статус ошибки. Возвращает айди этих генераций
+        """
+        try:
+            jobs = self.generation_jobs
+            async with self.engine.begin() as connection:
+                now = int(time.time())
+                exhausted = exhausted_jobs(jobs, now, max_attempts)
+                result = await connection.execute(
+                    select(jobs.c.gen_id).where(exhausted)
+                )
+                gen_ids = [row[0] for row in result.fetchall()]
+                if not gen_ids:
+                    return []
+
+                for query in expire_queries(
+                    jobs, self.generated_data, exhausted, gen_ids
+                ):
+                    await connection.execute(query)
+                return gen_ids
+        except Exception as exc:
+            raise DBException(f"Error in expire_jobs: {exc}") from exc
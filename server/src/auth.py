@@ -0,0 +1,83 @@
+"""
+Модуль с проверкой подписи параметров запуска Миниаппа
+"""
+
+import time
+
+from cache import ExpiringLRU
+from utils import is_valid, parse_query_string
+
+
+class AuthException(Exception):
+    """
+    Класс исключения, связанного с проверкой подписи
+    """
+
+    pass
+
+
+class AuthResult:
+    """
+    Результат авторизации запроса: параметры запуска или код ошибки
+    (status и message как в ответах API)
+    """
+
+    def __init__(self, data: dict = None, status: int = 0, message: str = "OK"):
+        self.data = data
+        self.status = status
+        self.message = message
+
+    @property
+    def user_id(self) -> int:
+        """
+        Айди юзера ВК
+        """
+        return self.data["vk_user_id"]
+
+    @property
+    def platform(self) -> str:
+        """
+        Платформа, с которой запущен Миниапп (None, если ее нет
+        в параметрах запуска)
+        """
+        return self.data.get("vk_platform")
+
+
+class AuthCache(ExpiringLRU):
+    """
+    LRU-кэш проверенных подписей: строка Authorization -> разобранные
+    параметры запуска. Клиенты опрашивают статус с одной и той же строкой,
+    поэтому разбор и HMAC делаются один раз. Запись живет max_age секунд
+    от vk_ts (времени запуска Миниаппа), после этого подпись снова
+    проверяется при каждом запросе. Параметры без vk_ts принимаются,
+    но не кэшируются
+    """
+
+    def __init__(self, secret: str, max_size: int, max_age: int):
+        super().__init__(max_size)
+        self.secret = secret
+        self.max_age = max_age
+
+    def check(self, authorization: str) -> dict:
+        """
+        Возвращает параметры запуска. AuthException - неверная подпись,
+        UtilsException - строку не удалось разобрать
+        """
+        now = time.time()
+        auth_data = self.lookup(authorization, now)
+        if auth_data is not None:
+            return auth_data
+
+        auth_data = parse_query_string(authorization)
+        if not is_valid(query=auth_data, secret=self.secret):
+            raise AuthException("Wrong sign")
+
+        try:
+            expires = int(auth_data["vk_ts"]) + self.max_age
+        except (KeyError, ValueError):
+            # Без времени запуска срок записи не определить
+            return auth_data
+
+        if self.max_size > 0 and expires > now:
+            self.store(authorization, auth_data, expires)
+        return auth_data
@@ -0,0 +1,168 @@
+"""
+Модуль с кэшем результатов генерации
+"""
+
+import asyncio
+import threading
+import time
+
+from collections import OrderedDict
+from hashlib import sha256
+
+from models import GenerationMethod
+
+
+def make_fingerprint(gen_method: str, query: str) -> str:
+    """
+    Ключ генерации: метод и готовый запрос к нейросети. В запросе уже есть
+    очищенная затравка и упакованные старые посты, так что одинаковые
+    ключи означают одинаковый запрос к модели
+    """
+    gen_method = GenerationMethod(gen_method).value
+    return sha256(f"{gen_method}\0{query}".encode("utf-8")).hexdigest()
+
+
+class ExpiringLRU:
+    """
+    LRU-словарь с временем жизни записей и счетчиками попаданий.
+    Общая часть ResultCache и AuthCache
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: OrderedDict[str, tuple[float, object]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key: str, now: float):
+        """
+        Возвращает значение по ключу или None, если записи нет
+        или она истекла к моменту now
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def store(self, key: str, value, expires: float):
+        """
+        Сохраняет значение до момента expires, вытесняя самые старые записи
+        """
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        """
+        Счетчики кэша (для логов и метрик)
+        """
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class ResultCache(ExpiringLRU):
+    """
+    Кэш результатов генерации с вытеснением по LRU и TTL.
+    Кэшируются только методы из methods: для генерации "с нуля"
+    повтор запроса обычно означает, что нужен другой вариант
+    """
+
+    def __init__(self, max_size: int, ttl: float, methods: list[str]):
+        super().__init__(max_size)
+        self.ttl = ttl
+        self.methods = set(methods)
+
+    def enabled_for(self, gen_method: str) -> bool:
+        """
+        Включен ли кэш для метода
+        """
+        return self.max_size > 0 and GenerationMethod(gen_method).value in self.methods
+
+    def get(self, key: str) -> str:
+        """
+        Возвращает результат по ключу или None
+        """
+        return self.lookup(key, time.monotonic())
+
+    def put(self, key: str, text: str):
+        """
+        Сохраняет результат, вытесняя самые старые записи
+        """
+        self.store(key, text, time.monotonic() + self.ttl)
+
+
+class SingleFlightException(Exception):
+    """
+    Класс исключения, связанного с объединением одинаковых генераций
+    """
+
+
+class SingleFlight:
+    """
+    Объединяет одинаковые генерации, которые идут одновременно: первая
+    идет в нейросеть, остальные ждут ее результата и не занимают ключи.
+    Все методы вызываются из event loop, поэтому блокировки не нужны
+    """
+
+    def __init__(self):
+        self.flights: dict[str, asyncio.Future] = {}
+        self.coalesced = 0
+
+    def in_flight(self, key: str) -> bool:
+        """
+        Идет ли сейчас генерация с таким ключом
+        """
+        return key in self.flights
+
+    async def run(self, key: str, func):
+        """
+        Выполняет корутину func() или присоединяется к уже идущей с тем же ключом
+        """
+        flight = self.flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            # shield: отмена одного ждущего не должна отменять общий результат
+            return await asyncio.shield(flight)
+
+        flight = asyncio.get_running_loop().create_future()
+        # Если ждущих нет, исключение никто не заберет - забираем сами,
+        # чтобы asyncio не ругался в лог
+        flight.add_done_callback(
+            lambda done: done.cancelled() or done.exception()
+        )
+        self.flights[key] = flight
+        try:
+            result = await func()
+            flight.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            # Ждущих никто не отменял: для них это ошибка генерации,
+            # а не отмена их собственных задач
+            flight.set_exception(
+                SingleFlightException("Coalesced generation was cancelled")
+            )
+            raise
+        except Exception as exc:
+            flight.set_exception(exc)
+            raise
+        finally:
+            del self.flights[key]
+
+    def stats(self) -> dict:
+        """
+        Счетчики (для логов и метрик)
+        """
+        return {"in_flight": len(self.flights), "coalesced": self.coalesced}
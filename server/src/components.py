@@ -0,0 +1,287 @@
+"""
+Модуль с общими компонентами сервера и воркеров: конфиг, логи, база,
+кэши, очереди и запросы к нейросети, а также проверка авторизации
+для эндпоинтов. Все создается при импорте из config.json
+"""
+
+import logging
+
+from fastapi import Header
+
+from config import Config
+from async_database import AsyncDatabase, ThreadedDatabase
+from utils import UtilsException
+from key_pool import make_key_slots
+from events import GenerationEvents
+from templates import TemplateRegistry
+from tokens import make_token_counter
+from cache import ResultCache, SingleFlight
+from write_behind import WriteBehindBuffer
+from auth import AuthCache, AuthException, AuthResult
+from state_store import GenerationStateStore, make_state_backend
+from model_client import ModelClient
+from metrics import MetricsExporter, TimedCalls
+from service_metrics import metrics_registry, generation_phase_seconds, db_call_seconds
+from structured_logging import LogPipeline
+from scheduler import FairScheduler, RateLimiter, TenantMetrics
+
+config = Config("config.json")
+log_pipeline = LogPipeline(
+    config.log.directory,
+    level=config.log.level,
+    rotation=config.log.rotation,
+    max_bytes=config.log.max_bytes,
+    backup_count=config.log.backup_count,
+    when=config.log.rotate_when,
+    sampling=config.log.sampling,
+)
+log_pipeline.start()
+# Опросы статуса - самые частые записи, пишется только доля из log_sampling
+poll_logger = logging.getLogger("strawberry.poll")
+
+
+def log_poll(msg: str, *args, text_id: int = None):
+    """
+    Пишет запись опроса, только если она попала в долю: сообщение
+    не форматируется и запись не создается для отброшенных опросов
+    """
+    if log_pipeline.sampled(poll_logger):
+        poll_logger.info(msg, *args, extra={"text_id": text_id, "sampled": True})
+
+
+db = TimedCalls(config.database(), db_call_seconds)
+# Доступ к базе из корутин: нативно асинхронный или через пул потоков
+adb = TimedCalls(
+    AsyncDatabase(db.target, config.db.async_uri, config.db.pool_options())
+    if config.db.use_async
+    else ThreadedDatabase(db.target),
+    db_call_seconds,
+)
+templates = TemplateRegistry(
+    config.prompts.contexts_dir, config.prompts.contexts_check_interval
+)
+token_counter = make_token_counter(
+    config.prompts.tokenizer_encoding, config.prompts.tokenizer_vocab_path
+)
+generation_events = GenerationEvents()
+single_flight = SingleFlight()
+result_cache = ResultCache(
+    config.cache.max_size,
+    config.cache.ttl,
+    config.cache.methods,
+)
+auth_cache = AuthCache(
+    config.auth.client_secret,
+    config.auth.cache_size,
+    config.auth.max_age,
+)
+post_writes = (
+    WriteBehindBuffer(
+        db.update_posts_many,
+        config.write_behind.max_size,
+        config.write_behind.interval,
+        config.write_behind.durability,
+        config.write_behind.timeout,
+    )
+    if config.write_behind.enabled
+    else None
+)
+# Владелец, статус и результат генераций для опросов без похода в базу
+generation_states = GenerationStateStore(
+    config.state.cache_size,
+    make_state_backend(
+        config.state.backend_uri,
+        config.state.cache_size,
+        config.state.ttl,
+    ),
+)
+# Лимиты частоты и честная очередь генераций между юзерами
+tenant_metrics = TenantMetrics()
+rate_limiter = RateLimiter(
+    config.rate.user_rate,
+    config.rate.user_burst,
+    config.rate.group_rate,
+    config.rate.group_burst,
+    config.rate.max_buckets,
+)
+fair_scheduler = FairScheduler(
+    config.scheduler.concurrency,
+    quantum=config.scheduler.quantum,
+    max_queue=config.scheduler.max_queue,
+    max_tenant_queue=config.scheduler.max_user_queue,
+    metrics=tenant_metrics,
+    aging=config.scheduler.aging,
+)
+# Запросы к нейросети: очередь юзеров, ключи, дубли и повторы
+model_client = ModelClient(
+    config, fair_scheduler, generation_events, generation_phase_seconds
+)
+
+metrics_exporter = MetricsExporter(
+    metrics_registry,
+    config.metrics.directory,
+    config.metrics.interval,
+    config.metrics.retention,
+)
+generations_running = metrics_registry.gauge(
+    "strawberry_generations_running",
+    "Генерации, которые сейчас выполняются",
+)
+generations_queued = metrics_registry.gauge(
+    "strawberry_generations_queued",
+    "Генерации в очереди за ключом",
+)
+# При общем учете ключей каждый процесс видит загрузку всех процессов
+key_in_flight = metrics_registry.gauge(
+    "strawberry_key_in_flight",
+    "Запросы к нейросети на ключе",
+    ("key",),
+    "sum" if config.keys.slots_backend == "local" else "max",
+)
+key_cooling_down = metrics_registry.gauge(
+    "strawberry_key_cooling_down",
+    "Ключ на паузе после 429/5xx",
+    ("key",),
+    "max",
+)
+key_requests = metrics_registry.counter(
+    "strawberry_key_requests_total",
+    "Запросы на ключе",
+    ("key",),
+)
+key_failures = metrics_registry.counter(
+    "strawberry_key_failures_total",
+    "Ошибки на ключе",
+    ("key",),
+)
+cache_hits = metrics_registry.counter(
+    "strawberry_cache_hits_total",
+    "Попадания в кэши",
+    ("cache",),
+)
+cache_misses = metrics_registry.counter(
+    "strawberry_cache_misses_total",
+    "Промахи кэшей",
+    ("cache",),
+)
+coalesced_generations = metrics_registry.counter(
+    "strawberry_coalesced_generations_total",
+    "Генерации, присоединенные к такой же идущей",
+)
+db_pool_checked_out = metrics_registry.gauge(
+    "strawberry_db_pool_checked_out",
+    "Занятые соединения пула",
+    ("pool",),
+)
+write_behind_pending = metrics_registry.gauge(
+    "strawberry_write_behind_pending",
+    "Изменения постов в буфере отложенной записи",
+)
+breaker_open = metrics_registry.gauge(
+    "strawberry_breaker_open",
+    "Разомкнут ли предохранитель провайдера",
+)
+tenant_generations = metrics_registry.counter(
+    "strawberry_tenant_generations_total",
+    "Генерации самых активных юзеров: admitted, limited, served",
+    ("user_id", "result"),
+)
+
+
+@metrics_registry.on_collect
+def collect_component_stats():
+    """
+    Переносит в метрики счетчики компонентов (stats())
+    """
+    scheduler_stats = fair_scheduler.stats()
+    generations_running.set(scheduler_stats["running"])
+    generations_queued.set(scheduler_stats["queued"])
+
+    for index, key in enumerate(config.key_pool.stats()):
+        key_in_flight.set(key["in_flight"], key=index)
+        key_cooling_down.set(int(key["cooling_down"]), key=index)
+        key_requests.set(key["requests"], key=index)
+        key_failures.set(key["failures"], key=index)
+
+    for name, cache in (
+        ("result", result_cache),
+        ("auth", auth_cache),
+        ("state", generation_states),
+    ):
+        stats = cache.stats()
+        cache_hits.set(stats["hits"], cache=name)
+        cache_misses.set(stats["misses"], cache=name)
+    coalesced_generations.set(single_flight.stats()["coalesced"])
+
+    db_pool_checked_out.set(db.pool_stats().get("checkedout", 0), pool="sync")
+    if config.db.use_async:
+        db_pool_checked_out.set(adb.pool_stats().get("checkedout", 0), pool="async")
+    if post_writes is not None:
+        write_behind_pending.set(post_writes.stats()["pending"])
+    breaker_open.set(int(model_client.breaker.is_open()))
+
+    for user_id, counters in tenant_metrics.top().items():
+        for result in ("admitted", "limited", "served"):
+            tenant_generations.set(counters[result], user_id=user_id, result=result)
+
+
+def setup_key_slots():
+    """
+    Подключает пул ключей к общему учету занятых ключей (после миграций:
+    учет в базе хранится в ее таблицах)
+    """
+    config.key_pool.use_slots(
+        make_key_slots(
+            config.keys.slots_backend,
+            config.key_pool,
+            db,
+            config.keys.slots_path,
+        )
+    )
+    logging.info("Key slots: %s", config.keys.slots_backend)
+
+
+def authorize(authorization: str, utils_message: str) -> AuthResult:
+    """
+    Проверяет подпись параметров запуска из заголовка Authorization
+    (с кэшем проверенных подписей). utils_message - сообщение ответа
+    со статусом 3, если заголовок не удалось разобрать
+    """
+    try:
+        return AuthResult(auth_cache.check(authorization))
+    except AuthException:
+        return AuthResult(status=1, message="Authorization error")
+    except UtilsException as exc:
+        logging.error("Error in utils, probably the request was not correct: %s", exc)
+        return AuthResult(status=3, message=utils_message)
+    except Exception as exc:
+        logging.error("Unknown error: %s", exc)
+        return AuthResult(status=4, message="Unknown error")
+
+
+def get_auth(Authorization=Header()) -> AuthResult:
+    """
+    Зависимость для эндпоинтов истории, статусов и файлов
+    """
+    return authorize(Authorization, "Authorization error")
+
+
+def get_generation_auth(Authorization=Header()) -> AuthResult:
+    """
+    Зависимость для эндпоинтов генерации: в записи генерации
+    нужна платформа из параметров запуска
+    """
+    auth = authorize(Authorization, "Authorization error")
+    if not auth.status and auth.platform is None:
+        logging.error("Key error. Check the header: 'vk_platform'")
+        return AuthResult(status=4, message="Key error. Check the header")
+    return auth
+
+
+def get_post_auth(Authorization=Header()) -> AuthResult:
+    """
+    Зависимость для действий с постами (у них свое сообщение об ошибке разбора)
+    """
+    return authorize(
+        Authorization, "Error in utils, probably the request was not correct"
+    )
@@ -3,62 +3,355 @@
 """
 
 import json
-import itertools
+
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+from database import Database
+from key_pool import KeyPool
 
 READY = 1
 BUSY = 0
 
 
+class AuthSettings(BaseModel):
+    """
+    Проверка подписи параметров запуска. Кэш проверенных подписей:
+    размер и время жизни записи от vk_ts
+    """
+
+    client_secret: str = Field(alias="client_secret")
+    cache_size: int = Field(10000, alias="auth_cache_size")
+    max_age: int = Field(86400, alias="auth_max_age")
+
+
+class DatabaseSettings(BaseModel):
+    """
+    База данных. Пул соединений: wait_timeout у MariaDB большой, но
+    соединения может рвать сеть, поэтому recycle и pre_ping включены.
+    use_async - асинхронный доступ (SQLAlchemy asyncio + aiomysql) для
+    корутин, без него корутины ходят в базу через пул потоков
+    """
+
+    user: str = Field(alias="db_user")
+    password: str = Field(alias="db_password")
+    port: int = Field(alias="db_port")
+    host: str = Field(alias="db_host")
+    name: str = Field(alias="db_name")
+    uri: Optional[str] = Field(None, alias="db_uri")
+    pool_size: int = Field(10, alias="db_pool_size")
+    max_overflow: int = Field(20, alias="db_max_overflow")
+    pool_timeout: float = Field(10, alias="db_pool_timeout")
+    pool_recycle: int = Field(3600, alias="db_pool_recycle")
+    pool_pre_ping: bool = Field(True, alias="db_pool_pre_ping")
+    use_async: bool = Field(False, alias="db_async")
+    async_uri: Optional[str] = Field(None, alias="db_async_uri")
+
+    def pool_options(self) -> dict:
+        """
+        Настройки пула соединений для create_engine
+        """
+        return {
+            "pool_size": self.pool_size,
+            "max_overflow": self.max_overflow,
+            "pool_timeout": self.pool_timeout,
+            "pool_recycle": self.pool_recycle,
+            "pool_pre_ping": self.pool_pre_ping,
+        }
+
+
+class PromptSettings(BaseModel):
+    """
+    Сборка запроса к нейросети. Шаблоны лежат в contexts_dir/<метод
+    генерации>.txt. Файл словаря tiktoken (в образе - vocab/, кладется
+    при сборке), без него токены оцениваются приближенно (null - сразу
+    так). rank_context - ранжирование старых постов по близости
+    к затравке перед упаковкой
+    """
+
+    contexts_dir: str = Field("contexts", alias="contexts_dir")
+    contexts_check_interval: float = Field(5.0, alias="contexts_check_interval")
+    tokenizer_encoding: str = Field("cl100k_base", alias="tokenizer_encoding")
+    tokenizer_vocab_path: Optional[str] = Field(
+        "vocab/cl100k_base.tiktoken", alias="tokenizer_vocab_path"
+    )
+    rank_context: bool = Field(True, alias="rank_context")
+    rank_time_budget: float = Field(0.05, alias="rank_time_budget")
+
+
+class CacheSettings(BaseModel):
+    """
+    Кэш одинаковых генераций. По умолчанию только для правок текста:
+    повтор generate_text обычно значит, что нужен другой вариант
+    """
+
+    max_size: int = Field(10000, alias="cache_max_size")
+    ttl: int = Field(3600, alias="cache_ttl")
+    methods: list[str] = Field(
+        ["fix_grammar", "summarize_text", "rephrase_text", "unmask_text"],
+        alias="cache_methods",
+    )
+
+
+class KeySettings(BaseModel):
+    """
+    Ключи API. Где считать занятые ключи: local - в процессе (один
+    процесс), shm - в разделяемой памяти (uvicorn --workers N на одной
+    машине), db - в базе (несколько машин или API и воркеры в разных
+    контейнерах)
+    """
+
+    tokens: list[str] = Field(alias="api_tokens")
+    max_in_flight: int = Field(1, alias="key_max_in_flight")
+    base_cooldown: float = Field(5.0, alias="key_base_cooldown")
+    max_cooldown: float = Field(300.0, alias="key_max_cooldown")
+    lease_ttl: float = Field(120.0, alias="key_lease_ttl")
+    acquire_timeout: float = Field(30.0, alias="key_acquire_timeout")
+    slots_backend: str = Field("local", alias="key_slots_backend")
+    slots_path: str = Field("/dev/shm/strawberry_key_slots", alias="key_slots_path")
+
+
+class ModelSettings(BaseModel):
+    """
+    Запросы к нейросети. api_base - другой адрес API (например, локальная
+    заглушка с внедрением сбоев). Дедлайн попытки задается по методам,
+    повторы - с экспоненциальной задержкой и разбросом. hedge - дублирующий
+    запрос на другом ключе, если первый идет дольше квантиля hedge_quantile
+    задержек метода (считается, когда накопится hedge_min_samples
+    успешных запросов)
+    """
+
+    api_base: Optional[str] = Field(None, alias="nn_api_base")
+    timeouts: dict[str, float] = Field(
+        {
+            "generate_text": 60.0,
+            "gen_from_scratch": 60.0,
+            "append_text": 45.0,
+            "extend_text": 45.0,
+        },
+        alias="nn_timeouts",
+    )
+    default_timeout: float = Field(20.0, alias="nn_default_timeout")
+    max_attempts: int = Field(3, alias="nn_max_attempts")
+    retry_base_delay: float = Field(0.5, alias="nn_retry_base_delay")
+    retry_max_delay: float = Field(5.0, alias="nn_retry_max_delay")
+    hedge: bool = Field(True, alias="nn_hedge")
+    hedge_quantile: float = Field(0.95, alias="nn_hedge_quantile")
+    hedge_min_samples: int = Field(20, alias="nn_hedge_min_samples")
+
+    def timeout(self, method: str) -> float:
+        """
+        Дедлайн одной попытки запроса к нейросети для метода генерации
+        """
+        return self.timeouts.get(method, self.default_timeout)
+
+
+class BreakerSettings(BaseModel):
+    """
+    Предохранитель провайдера: размыкается на open_time секунд, если среди
+    последних window запросов (не меньше min_calls) доля ошибок не меньше
+    failure_ratio
+    """
+
+    window: int = Field(20, alias="breaker_window")
+    min_calls: int = Field(10, alias="breaker_min_calls")
+    failure_ratio: float = Field(0.5, alias="breaker_failure_ratio")
+    open_time: float = Field(30.0, alias="breaker_open_time")
+
+
+class RateSettings(BaseModel):
+    """
+    Лимиты частоты генераций: rate в секунду и запас burst на юзера
+    и на группу (rate <= 0 - без лимита)
+    """
+
+    user_rate: float = Field(0.2, alias="rate_user_rate")
+    user_burst: float = Field(10, alias="rate_user_burst")
+    group_rate: float = Field(1.0, alias="rate_group_rate")
+    group_burst: float = Field(40, alias="rate_group_burst")
+    max_buckets: int = Field(100000, alias="rate_max_buckets")
+
+
+class SchedulerSettings(BaseModel):
+    """
+    Честная очередь генераций между юзерами: сколько генераций процесса
+    выполняется одновременно (по умолчанию - сколько запросов выдерживают
+    ключи), сколько запросов ждет в очереди всего и от одного юзера,
+    и сколько секунд можно ждать. quantum и aging - в единицах оценки
+    стоимости генерации (токенах): сколько юзер получает за круг и на
+    сколько дешевеет запрос за секунду ожидания
+    """
+
+    concurrency: int = Field(alias="scheduler_concurrency")
+    quantum: float = Field(4000.0, alias="scheduler_quantum")
+    aging: float = Field(1000.0, alias="scheduler_aging")
+    max_queue: int = Field(1000, alias="scheduler_max_queue")
+    max_user_queue: int = Field(20, alias="scheduler_max_user_queue")
+    timeout: float = Field(60.0, alias="scheduler_timeout")
+
+
+class JobSettings(BaseModel):
+    """
+    Очередь задач в базе: API только ставит задачи, а генерацию
+    выполняют отдельные процессы worker.py
+    """
+
+    enabled: bool = Field(False, alias="use_job_queue")
+    visibility_timeout: int = Field(120, alias="job_visibility_timeout")
+    max_attempts: int = Field(3, alias="job_max_attempts")
+    poll_interval: float = Field(1.0, alias="job_poll_interval")
+    worker_concurrency: int = Field(32, alias="worker_concurrency")
+
+
+class EventSettings(BaseModel):
+    """
+    SSE: поток, генерацию которого выполняет другой процесс (воркеры
+    очереди или другой из uvicorn --workers N), раз в fallback_interval
+    секунд сверяется со статусом в базе. Поток генерации этого процесса
+    ждет ее событий, а сверяется с базой, только если db_fallback включен
+    (по умолчанию - в режиме очереди задач)
+    """
+
+    db_fallback: bool = Field(alias="events_db_fallback")
+    fallback_interval: float = Field(5.0, alias="events_fallback_interval")
+
+
+class RequestLimits(BaseModel):
+    """
+    Размеры запросов: пакетная генерация (максимум запросов в пакете
+    и сколько из них выполняется одновременно), страница истории и длина
+    текста в режиме summary, посты в одном групповом действии
+    """
+
+    batch_max_size: int = Field(10, alias="batch_max_size")
+    batch_concurrency: int = Field(4, alias="batch_concurrency")
+    history_max_limit: int = Field(100, alias="history_max_limit")
+    history_summary_len: int = Field(200, alias="history_summary_len")
+    posts_action_max_size: int = Field(100, alias="posts_action_max_size")
+
+
+class StateSettings(BaseModel):
+    """
+    Хранилище состояния генераций для опросов статуса: размер кэша
+    в памяти и общее хранилище для нескольких процессов (redis://...,
+    memory:// - локальная замена, None - без него)
+    """
+
+    cache_size: int = Field(10000, alias="state_cache_size")
+    backend_uri: Optional[str] = Field(None, alias="state_backend_uri")
+    ttl: int = Field(3600, alias="state_ttl")
+
+
+class WriteBehindSettings(BaseModel):
+    """
+    Отложенная запись лайков, скрытия и публикации: изменения копятся
+    в буфере и пишутся пачкой раз в interval секунд. При durability
+    "memory" ответ уходит сразу, и пост чужого юзера не отличить от своего
+    (изменение просто не применится), при "flush" ответ ждет коммита
+    пачки. Ожидание места в буфере или коммита ограничено timeout
+    секундами, потом - ошибка
+    """
+
+    enabled: bool = Field(False, alias="write_behind")
+    max_size: int = Field(10000, alias="write_behind_max_size")
+    interval: float = Field(1.0, alias="write_behind_interval")
+    durability: str = Field("memory", alias="write_behind_durability")
+    timeout: float = Field(5.0, alias="write_behind_timeout")
+
+
+class MetricsSettings(BaseModel):
+    """
+    Метрики /metrics: каждый процесс раз в interval секунд сбрасывает
+    снимок в directory, общий для процессов uvicorn и воркеров (для
+    разных контейнеров - общий том). Снимки завершившихся процессов
+    удаляются через retention секунд
+    """
+
+    directory: Optional[str] = Field("/dev/shm/strawberry_metrics", alias="metrics_dir")
+    interval: float = Field(1.0, alias="metrics_interval")
+    retention: int = Field(86400, alias="metrics_retention")
+
+
+class LogSettings(BaseModel):
+    """
+    Логи: JSON по строке на запись в directory, файл у каждого процесса
+    свой. Пишет фоновый поток. Ротация по размеру (size, max_bytes)
+    или по времени (time, rotate_when). sampling - какая доля записей
+    уровня INFO пишется, по имени логгера (опросы статуса - strawberry.poll)
+    """
+
+    directory: str = Field("/home/logs", alias="log_dir")
+    level: str = Field("INFO", alias="log_level")
+    rotation: str = Field("size", alias="log_rotation")
+    max_bytes: int = Field(100 * 1024 * 1024, alias="log_max_bytes")
+    backup_count: int = Field(10, alias="log_backup_count")
+    rotate_when: str = Field("midnight", alias="log_rotate_when")
+    sampling: dict[str, float] = Field({"strawberry.poll": 0.01}, alias="log_sampling")
+
+
 class Config:
     """
-    Класс для загрузки конфига
+    Класс для загрузки конфига. Ключи в файле плоские (db_user,
+    nn_timeouts, ...), настройки разложены по разделам компонентов
     """
 
     def __init__(self, config_path: str):
         with open(config_path, "r", encoding="UTF-8") as cfg_file:
             data = json.load(cfg_file)
 
-        self.client_secret = data["client_secret"]
-
-        self.db_user = data["db_user"]
-        self.db_password = data["db_password"]
-        self.db_port = data["db_port"]
-        self.db_host = data["db_host"]
-        self.db_name = data["db_name"]
-
-        self.gen_context_path = data["gen_context_path"]
-        self.gen_from_scratch_context_path = data["gen_from_scratch_context_path"]
-        self.append_context_path = data["append_context_path"]
-        self.rephrase_context_path = data["rephrase_context_path"]
-        self.summarize_context_path = data["summarize_context_path"]
-        self.extend_context_path = data["extend_context_path"]
-        self.unmask_context_path = data["unmask_context_path"]
-        self.fix_grammar_context_path = data["fix_grammar_context_path"]
-
         if len(data["api_tokens"]) == 0:
             raise Exception("No api tokens in config file")
 
-        self.api_tokens = itertools.cycle(data["api_tokens"])
-        self.acquired = 0
-        self.available_count = len(data["api_tokens"])
+        # Умолчания, которые зависят от других ключей
+        data = {
+            "scheduler_concurrency": len(data["api_tokens"])
+            * data.get("key_max_in_flight", 1),
+            "events_db_fallback": data.get("use_job_queue", False),
+            **data,
+        }
 
-    def next_token(self) -> str:
-        """
-        Возвращает свободный токен и увеличивает счетчик
-        """
-        self.acquired += 1
-        return next(self.api_tokens)
+        self.auth = AuthSettings.parse_obj(data)
+        self.db = DatabaseSettings.parse_obj(data)
+        self.prompts = PromptSettings.parse_obj(data)
+        self.cache = CacheSettings.parse_obj(data)
+        self.keys = KeySettings.parse_obj(data)
+        self.nn = ModelSettings.parse_obj(data)
+        self.breaker = BreakerSettings.parse_obj(data)
+        self.rate = RateSettings.parse_obj(data)
+        self.scheduler = SchedulerSettings.parse_obj(data)
+        self.jobs = JobSettings.parse_obj(data)
+        self.events = EventSettings.parse_obj(data)
+        self.limits = RequestLimits.parse_obj(data)
+        self.state = StateSettings.parse_obj(data)
+        self.write_behind = WriteBehindSettings.parse_obj(data)
+        self.metrics = MetricsSettings.parse_obj(data)
+        self.log = LogSettings.parse_obj(data)
+
+        self.key_pool = KeyPool(
+            self.keys.tokens,
+            max_in_flight=self.keys.max_in_flight,
+            base_cooldown=self.keys.base_cooldown,
+            max_cooldown=self.keys.max_cooldown,
+            lease_ttl=self.keys.lease_ttl,
+        )
 
-    def free(self):
+    def database(self) -> Database:
         """
-        Освобождает токен - уменьшает счетчик
+        База из раздела db с настройками пула соединений
         """
-        self.acquired -= 1
+        return Database(
+            self.db.user,
+            self.db.password,
+            self.db.name,
+            self.db.port,
+            self.db.host,
+            uri=self.db.uri,
+            pool_options=self.db.pool_options(),
+        )
 
     def ready(self) -> bool:
         """
-        Возвращает статус
+        Возвращает статус: есть ли свободный и не остывающий ключ
         """
-        if self.acquired < self.available_count:
-            return True
-        return False
+        return self.key_pool.ready()
@@ -2,37 +2,78 @@
 Модуль с классом для общения с базой данных
 """
 
+import fcntl
+import time
+
+from contextlib import contextmanager
+
 from sqlalchemy import (
     create_engine,
     Table,
     Column,
     String,
     Integer,
+    Text,
+    Float,
     MetaData,
     inspect,
+    func,
     select,
     update,
     insert,
+    bindparam,
 )
-from models import GenerateResultInfo
-
+from models import GenerateResultInfo, PostAction
+from migrations import MIGRATIONS, LATEST_VERSION
+from db_common import (
+    DBException,
+    engine_pool_options,
+    pool_stats,
+    new_record,
+    record_result,
+)
+from database_jobs import JobQueueMixin
+from database_keys import KeySlotsMixin
 
-class DBException(Exception):
-    """
-    Класс исключения, связанного с базой данных
-    """
+# Именованная блокировка MariaDB, под которой применяются миграции
+# (сервер и воркеры стартуют одновременно), и сколько ее ждать, секунд
+MIGRATION_LOCK = "strawberry_schema_migration"
+MIGRATION_LOCK_TIMEOUT = 600
 
-    pass
+# Что меняет в записи каждое действие с постом
+POST_ACTION_VALUES = {
+    PostAction.LIKE: {"rating": 1},
+    PostAction.DISLIKE: {"rating": -1},
+    PostAction.HIDE: {"hidden": 1},
+    PostAction.RECOVER: {"hidden": 0},
+    PostAction.PUBLISH: {"published": 1},
+}
 
 
-class Database:
+class Database(JobQueueMixin, KeySlotsMixin):
     """
     Класс с логикой для взаимодействия с базой данных MariaDB/MySQL
     """
 
-    def __init__(self, user, password, database, port, host):
-        self.database_uri = f"mysql+pymysql://{user}:{password}@{host}:{port}/{database}?charset=utf8mb4"
-        self.engine = create_engine(self.database_uri)
+    def __init__(
+        self,
+        user,
+        password,
+        database,
+        port,
+        host,
+        *,
+        uri: str = None,
+        pool_options: dict = None,
+    ):
+        # uri позволяет подменить MariaDB, например, на SQLite при локальном запуске
+        self.database_uri = (
+            uri
+            or f"mysql+pymysql://{user}:{password}@{host}:{port}/{database}?charset=utf8mb4"
+        )
+        self.engine = create_engine(
+            self.database_uri, **engine_pool_options(self.database_uri, pool_options)
+        )
 
         self.meta = MetaData()
 
@@ -70,26 +111,144 @@ class Database:
             Column("hidden", Integer, nullable=False),
         )
 
+        self.schema_version = Table(
+            "schema_version",
+            self.meta,
+            Column("version", Integer, primary_key=True, autoincrement=False),
+            Column("description", String(256), nullable=False),
+            Column("applied", Integer, nullable=False),
+        )
+
+        self.generation_jobs = Table(
+            "generation_jobs",
+            self.meta,
+            Column(
+                "id",
+                Integer,
+                primary_key=True,
+                nullable=False,
+                autoincrement=True,
+            ),
+            Column("gen_id", Integer, nullable=False),
+            Column("payload", Text, nullable=False),
+            Column("state", Integer, nullable=False),
+            Column("attempts", Integer, nullable=False, default=0),
+            Column("lease_until", Integer, nullable=False, default=0),
+            Column("worker", String(128), nullable=False, default=""),
+            Column("created", Integer, nullable=False),
+        )
+
+        # Учет занятых API-ключей, общий для всех процессов и узлов.
+        # Строка - один слот ключа, занятый слот - holder и lease_until
+        self.key_slots = Table(
+            "key_slots",
+            self.meta,
+            Column("key_id", String(64), primary_key=True, autoincrement=False),
+            Column("slot", Integer, primary_key=True, autoincrement=False),
+            Column("holder", String(128), nullable=False, default=""),
+            Column("lease_until", Integer, nullable=False, default=0),
+        )
+
+        self.key_states = Table(
+            "key_states",
+            self.meta,
+            Column("key_id", String(64), primary_key=True, autoincrement=False),
+            Column("strikes", Integer, nullable=False, default=0),
+            Column("cooldown_until", Float, nullable=False, default=0),
+        )
+
+    def pool_stats(self) -> dict:
+        """
+        Загрузка пула соединений
+        """
+        return pool_stats(self.engine.pool)
+
+    def get_schema_version(self) -> int:
+        """
+        Возвращает номер последней примененной миграции (0 - база пустая)
+        """
+        try:
+            if not inspect(self.engine).has_table("schema_version"):
+                return 0
+            with self.engine.connect() as connection:
+                version = connection.execute(
+                    select(func.max(self.schema_version.c.version))
+                ).scalar()
+                return int(version or 0)
+        except Exception as exc:
+            raise DBException(f"Error in get_schema_version: {exc}") from exc
+
     def need_migration(self) -> bool:
         """
         Проверяет, нужна ли миграция
         """
         try:
-            if not inspect(self.engine).has_table("generated_data"):
-                return True
-            return False
+            return self.get_schema_version() < LATEST_VERSION
         except Exception as exc:
             raise DBException(f"Error in need_migration: {exc}") from exc
 
+    @contextmanager
+    def migration_lock(self):
+        """
+        Блокировка на время миграций, общая для всех процессов и узлов:
+        GET_LOCK в MariaDB/MySQL, flock файла рядом с базой в SQLite
+        """
+        if self.engine.dialect.name in ("mysql", "mariadb"):
+            with self.engine.connect() as connection:
+                acquired = connection.execute(
+                    select(func.get_lock(MIGRATION_LOCK, MIGRATION_LOCK_TIMEOUT))
+                ).scalar()
+                if acquired != 1:
+                    raise DBException("Migration lock is held by another process")
+                try:
+                    yield
+                finally:
+                    connection.execute(select(func.release_lock(MIGRATION_LOCK)))
+            return
+
+        path = self.engine.url.database
+        if not path or path == ":memory:":
+            # База в памяти видна только этому процессу
+            yield
+            return
+        with open(f"{path}.migrate.lock", "a", encoding="UTF-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
     def migrate(self):
         """
-        Делает миграцию (создает таблицы)
+        Применяет по порядку все миграции новее текущей версии схемы.
+        Версия читается уже под блокировкой: если схему обновил другой
+        процесс, пока этот ждал, миграции не повторяются
         """
         try:
-            self.meta.create_all(self.engine)
+            with self.migration_lock():
+                self._apply_migrations()
         except Exception as exc:
             raise DBException(f"Error in migrate: {exc}") from exc
 
+    def _apply_migrations(self):
+        """
+        Применяет миграции новее текущей версии (под migration_lock)
+        """
+        self.schema_version.create(self.engine, checkfirst=True)
+        current = self.get_schema_version()
+        for version, description, apply in MIGRATIONS:
+            if version <= current:
+                continue
+            with self.engine.begin() as connection:
+                apply(connection)
+                connection.execute(
+                    insert(self.schema_version).values(
+                        version=version,
+                        description=description,
+                        applied=int(time.time()),
+                    )
+                )
+
     def add_record(
         self,
         query: str,
@@ -104,31 +263,55 @@ class Database:
         """
         try:
             with self.engine.connect() as connection:
-                insert_query = insert(self.generated_data).values(
+                insert_query = new_record(
+                    self.generated_data,
                     query=query,
                     user_id=user_id,
                     method=gen_method,
                     group_id=group_id,
                     unix_date=unix_date,
-                    status=0,
-                    rating=0,
                     platform=platform,
-                    published=0,
-                    hidden=0,
-                )
-                connection.execute(insert_query)
-
-                get_id_query = select(self.generated_data.c.id).where(
-                    (self.generated_data.c.query == query)
-                    & (self.generated_data.c.unix_date == unix_date)
                 )
-
-                text_id = int(connection.execute(get_id_query).fetchall()[0][0])
-
-                return text_id
+                result = connection.execute(insert_query)
+                # Айди берем из ответа на INSERT, без второго запроса
+                return int(result.inserted_primary_key[0])
         except Exception as exc:
             raise DBException(f"Error in add_record: {exc}") from exc
 
+    def add_records(
+        self,
+        records: list[dict],
+        user_id: int,
+        unix_date: int,
+        platform: str,
+    ) -> list[int]:
+        """
+        Добавляет записи о генерациях пакета в одной транзакции.
+        records - список словарей с query, gen_method и group_id.
+        Возвращает айди записей в том же порядке
+        """
+        try:
+            with self.engine.begin() as connection:
+                # Строки вставляются по одной: айди каждой берем из ответа
+                # на ее INSERT. Айди многострочного INSERT не обязаны идти
+                # подряд (innodb_autoinc_lock_mode 2, параллельные вставки)
+                text_ids = []
+                for record in records:
+                    insert_query = new_record(
+                        self.generated_data,
+                        query=record["query"],
+                        user_id=user_id,
+                        method=record["gen_method"],
+                        group_id=record["group_id"],
+                        unix_date=unix_date,
+                        platform=platform,
+                    )
+                    result = connection.execute(insert_query)
+                    text_ids.append(int(result.inserted_primary_key[0]))
+                return text_ids
+        except Exception as exc:
+            raise DBException(f"Error in add_records: {exc}") from exc
+
     def add_record_result(
         self,
         text_id: int,
@@ -140,127 +323,182 @@ class Database:
         Добавляет в запись результат генерации и потраченное время
         """
         try:
-            status = 1 if is_ok else 2
             with self.engine.connect() as connection:
-                update_query = (
-                    update(self.generated_data)
-                    .where(self.generated_data.c.id == text_id)
-                    .values(
-                        text=text,
-                        gen_time=gen_time,
-                        status=status,
-                    )
+                connection.execute(
+                    record_result(self.generated_data, text_id, text, gen_time, is_ok)
                 )
-                connection.execute(update_query)
         except Exception as exc:
             raise DBException(f"Error in add_record_result: {exc}") from exc
 
-    def write_feedback(self, text_id: int, new_score: int):
+    def update_users_posts(
+        self, user_id: int, text_ids: list[int], values: dict
+    ) -> int:
         """
-        Ставит генерации оценку
+        Меняет посты юзера одним UPDATE. Проверка владельца - в условии
+        запроса, так что чужие и несуществующие посты просто не попадают
+        под него. Возвращает число найденных постов (MySQL-диалект SQLAlchemy
+        включает FOUND_ROWS, поэтому посты без изменений тоже считаются)
         """
         try:
             with self.engine.connect() as connection:
                 update_query = (
                     update(self.generated_data)
-                    .where(self.generated_data.c.id == text_id)
-                    .values(rating=new_score)
+                    .where(
+                        (self.generated_data.c.id.in_(text_ids))
+                        & (self.generated_data.c.user_id == user_id)
+                    )
+                    .values(**values)
                 )
 
-                connection.execute(update_query)
+                return connection.execute(update_query).rowcount
         except Exception as exc:
-            raise DBException(f"Error in write_feedback: {exc}") from exc
+            raise DBException(f"Error in update_users_posts: {exc}") from exc
+
+    def apply_post_action(
+        self, user_id: int, text_ids: list[int], action: PostAction
+    ) -> int:
+        """
+        Применяет действие к постам юзера, возвращает число измененных постов
+        """
+        return self.update_users_posts(user_id, text_ids, POST_ACTION_VALUES[action])
 
-    def hide_generation(self, text_id: int, hidden=1):
+    def update_posts_many(self, updates: list[tuple[int, int, str, object]]):
         """
-        Прячет (и открывает) пост и он не отправляется больше в истории
+        Записывает пачку изменений (text_id, user_id, column, value) одной
+        транзакцией: по одному executemany на каждое поле. Владелец
+        проверяется в условии, изменения чужих постов пропускаются
         """
         try:
-            with self.engine.connect() as connection:
-                update_query = (
-                    update(self.generated_data)
-                    .where(self.generated_data.c.id == text_id)
-                    .values(hidden=hidden)
+            by_column = {}
+            for text_id, user_id, column, value in updates:
+                by_column.setdefault(column, []).append(
+                    {"b_id": text_id, "b_user_id": user_id, "b_value": value}
                 )
 
-                connection.execute(update_query)
+            with self.engine.begin() as connection:
+                for column, params in by_column.items():
+                    update_query = (
+                        update(self.generated_data)
+                        .where(
+                            (self.generated_data.c.id == bindparam("b_id"))
+                            & (self.generated_data.c.user_id == bindparam("b_user_id"))
+                        )
+                        .values({column: bindparam("b_value")})
+                    )
+
+                    connection.execute(update_query, params)
         except Exception as exc:
-            raise DBException(f"Error in hide_generation: {exc}") from exc
+            raise DBException(f"Error in update_posts_many: {exc}") from exc
 
-    def write_published(self, text_id: int):
+    def _users_texts_filter(self, group_id: int, user_id: int):
         """
-        Ставит генерации оценку
+        Условие на видимые готовые тексты юзера (под индексы истории)
         """
-        try:
-            with self.engine.connect() as connection:
-                update_query = (
-                    update(self.generated_data)
-                    .where(self.generated_data.c.id == text_id)
-                    .values(published=1)
-                )
+        condition = (
+            (self.generated_data.c.user_id == user_id)
+            & (self.generated_data.c.status == 1)
+            & (self.generated_data.c.hidden == 0)
+        )
+        if group_id:
+            condition = condition & (self.generated_data.c.group_id == group_id)
+        return condition
 
-                connection.execute(update_query)
-        except Exception as exc:
-            raise DBException(f"Error in write_published: {exc}") from exc
+    def _users_texts_columns(self, summary_len: int = None) -> list:
+        """
+        Колонки страницы истории. summary_len - если задан, hint и text
+        обрезаются до этой длины прямо в запросе
+        """
+        table = self.generated_data
+        hint_column = table.c.query
+        text_column = table.c.text
+        if summary_len:
+            hint_column = func.substr(table.c.query, 1, summary_len)
+            text_column = func.substr(table.c.text, 1, summary_len)
+        return [
+            table.c.id,
+            table.c.user_id,
+            table.c.method,
+            hint_column.label("query"),
+            text_column.label("text"),
+            table.c.rating,
+            table.c.unix_date,
+            table.c.group_id,
+            table.c.status,
+            table.c.gen_time,
+            table.c.platform,
+            table.c.published,
+            table.c.hidden,
+        ]
 
     def get_users_texts(
         self,
         group_id: int,
         user_id: int,
+        limit: int,
+        *,
+        before_id: int = None,
+        offset: int = None,
+        summary_len: int = None,
     ) -> list[GenerateResultInfo]:
         """
-        Выбирает всю информацию о текстах, сгенерированных юзером
+        Выбирает страницу текстов, сгенерированных юзером, от новых к старым.
+        before_id - курсор: айди последнего поста предыдущей страницы.
+        summary_len - если задан, hint и text обрезаются до этой длины
+        прямо в запросе, полный текст можно получить отдельно
         """
         try:
-            with self.engine.connect() as connection:
-                if group_id:
-                    select_query = (
-                        select(self.generated_data)
-                        .where(
-                            (self.generated_data.c.user_id == user_id)
-                            & (self.generated_data.c.group_id == group_id)
-                            & (self.generated_data.c.status == 1)
-                            & (self.generated_data.c.hidden == 0)
-                        )
-                        .order_by(self.generated_data.c.id.desc())
-                    )
-                else:
-                    select_query = (
-                        select(self.generated_data)
-                        .where(
-                            (self.generated_data.c.user_id == user_id)
-                            & (self.generated_data.c.status == 1)
-                            & (self.generated_data.c.hidden == 0)
-                        )
-                        .order_by(self.generated_data.c.id.desc())
-                    )
+            table = self.generated_data
+            condition = self._users_texts_filter(group_id, user_id)
+            if before_id:
+                condition = condition & (table.c.id < before_id)
+
+            select_query = (
+                select(*self._users_texts_columns(summary_len))
+                .where(condition)
+                .order_by(table.c.id.desc())
+                .limit(limit)
+            )
+            if offset and not before_id:
+                select_query = select_query.offset(offset)
 
+            with self.engine.connect() as connection:
                 response = connection.execute(select_query).fetchall()
 
-                result = []
-                for row in response:
-                    result += [
-                        GenerateResultInfo(
-                            post_id=row[0],
-                            user_id=row[1],
-                            method=row[2],
-                            hint=row[3],
-                            text=row[4],
-                            rating=row[5],
-                            date=row[6],
-                            group_id=row[7],
-                            status=row[8],
-                            gen_time=row[9],
-                            platform=row[10],
-                            published=row[11],
-                            hidden=row[12],
-                        )
-                    ]
-                return result
+            return [
+                GenerateResultInfo(
+                    post_id=row[0],
+                    user_id=row[1],
+                    method=row[2],
+                    hint=row[3],
+                    text=row[4],
+                    rating=row[5],
+                    date=row[6],
+                    group_id=row[7],
+                    status=row[8],
+                    gen_time=row[9],
+                    platform=row[10],
+                    published=row[11],
+                    hidden=row[12],
+                )
+                for row in response
+            ]
 
         except Exception as exc:
             raise DBException(f"Error in get_users_texts: {exc}") from exc
 
+    def count_users_texts(self, group_id: int, user_id: int) -> int:
+        """
+        Считает видимые готовые тексты юзера (COUNT по индексу истории)
+        """
+        try:
+            with self.engine.connect() as connection:
+                count_query = select(func.count()).where(
+                    self._users_texts_filter(group_id, user_id)
+                )
+                return int(connection.execute(count_query).scalar())
+        except Exception as exc:
+            raise DBException(f"Error in count_users_texts: {exc}") from exc
+
     def get_status(self, text_id: int) -> str:
         """
         Получает статус генерации
@@ -276,6 +514,28 @@ class Database:
         except Exception as exc:
             raise DBException(f"Error in get_status: {exc}") from exc
 
+    def get_statuses(self, user_id: int, text_ids: list[int]) -> list[int]:
+        """
+        Получает статусы нескольких генераций пользователя одним запросом.
+        Для чужих и несуществующих постов возвращает -1
+        """
+        try:
+            with self.engine.connect() as connection:
+                select_query = select(
+                    self.generated_data.c.id,
+                    self.generated_data.c.status,
+                ).where(
+                    self.generated_data.c.id.in_(text_ids)
+                    & (self.generated_data.c.user_id == user_id)
+                )
+                statuses = {
+                    int(row[0]): int(row[1])
+                    for row in connection.execute(select_query).fetchall()
+                }
+                return [statuses.get(text_id, -1) for text_id in text_ids]
+        except Exception as exc:
+            raise DBException(f"Error in get_statuses: {exc}") from exc
+
     def get_value(self, text_id) -> str:
         """
         Получает результат генерации
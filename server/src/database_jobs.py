@@ -0,0 +1,157 @@
+"""
+Модуль с очередью задач generation_jobs для Database
+"""
+
+import time
+
+from sqlalchemy import select, insert
+
+from db_common import (
+    DBException,
+    JOB_QUEUED,
+    available_jobs,
+    job_candidates,
+    lease_job_query,
+    extend_lease_query,
+    finish_job_query,
+    exhausted_jobs,
+    expire_queries,
+)
+
+
+class JobQueueMixin:
+    """
+    Очередь задач generation_jobs для воркеров
+    """
+
+    def add_job(self, gen_id: int, payload: str):
+        """
+        Ставит генерацию в очередь задач для воркеров
+        """
+        try:
+            with self.engine.connect() as connection:
+                insert_query = insert(self.generation_jobs).values(
+                    gen_id=gen_id,
+                    payload=payload,
+                    state=JOB_QUEUED,
+                    attempts=0,
+                    lease_until=0,
+                    worker="",
+                    created=int(time.time()),
+                )
+                connection.execute(insert_query)
+        except Exception as exc:
+            raise DBException(f"Error in add_job: {exc}") from exc
+
+    def add_jobs(self, jobs: list[tuple[int, str]]):
+        """
+        Ставит в очередь несколько генераций одним INSERT.
+        jobs - список пар (gen_id, payload)
+        """
+        try:
+            now = int(time.time())
+            with self.engine.connect() as connection:
+                insert_query = insert(self.generation_jobs).values(
+                    [
+                        {
+                            "gen_id": gen_id,
+                            "payload": payload,
+                            "state": JOB_QUEUED,
+                            "attempts": 0,
+                            "lease_until": 0,
+                            "worker": "",
+                            "created": now,
+                        }
+                        for gen_id, payload in jobs
+                    ]
+                )
+                connection.execute(insert_query)
+        except Exception as exc:
+            raise DBException(f"Error in add_jobs: {exc}") from exc
+
+    def lease_job(
+        self,
+        worker: str,
+        visibility_timeout: int,
+        max_attempts: int,
+    ):
+        """
+        Забирает задачу из очереди: новую или ту, у которой истекла аренда
+        (воркер умер или завис). Захват - условный UPDATE, так что задачу
+        получит только один воркер. Возвращает (job_id, gen_id, payload) или None
+        """
+        try:
+            jobs = self.generation_jobs
+            with self.engine.connect() as connection:
+                now = int(time.time())
+                available = available_jobs(jobs, now, max_attempts)
+                candidates = connection.execute(
+                    job_candidates(jobs, available)
+                ).fetchall()
+
+                for candidate in candidates:
+                    lease_query = lease_job_query(
+                        jobs, candidate, available, worker, now + visibility_timeout
+                    )
+                    if connection.execute(lease_query).rowcount == 1:
+                        job_id, gen_id, payload, _ = candidate
+                        return int(job_id), int(gen_id), str(payload)
+                return None
+        except Exception as exc:
+            raise DBException(f"Error in lease_job: {exc}") from exc
+
+    def extend_job_lease(self, job_id: int, worker: str, visibility_timeout: int):
+        """
+        Продлевает аренду задачи, пока воркер над ней работает
+        """
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(
+                    extend_lease_query(
+                        self.generation_jobs,
+                        job_id,
+                        worker,
+                        int(time.time()) + visibility_timeout,
+                    )
+                )
+        except Exception as exc:
+            raise DBException(f"Error in extend_job_lease: {exc}") from exc
+
+    def finish_job(self, job_id: int, worker: str, is_ok: bool = True):
+        """
+        Отмечает задачу выполненной (или окончательно упавшей)
+        """
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(
+                    finish_job_query(self.generation_jobs, job_id, worker, is_ok)
+                )
+        except Exception as exc:
+            raise DBException(f"Error in finish_job: {exc}") from exc
+
+    def expire_jobs(self, max_attempts: int) -> list[int]:
+        """
+        Закрывает задачи, которые исчерпали попытки, и ставит
+        их генерациям статус ошибки. Возвращает айди этих генераций
+        """
+        try:
+            jobs = self.generation_jobs
+            with self.engine.begin() as connection:
+                now = int(time.time())
+                exhausted = exhausted_jobs(jobs, now, max_attempts)
+                gen_ids = [
+                    row[0]
+                    for row in connection.execute(
+                        select(jobs.c.gen_id).where(exhausted)
+                    ).fetchall()
+                ]
+                if not gen_ids:
+                    return []
+
+                for query in expire_queries(
+                    jobs, self.generated_data, exhausted, gen_ids
+                ):
+                    connection.execute(query)
+                return gen_ids
+        except Exception as exc:
+            raise DBException(f"Error in expire_jobs: {exc}") from exc
@@ -0,0 +1,223 @@
+"""
+Модуль с общим для процессов и узлов учетом занятых API-ключей для Database
+"""
+
+import time
+
+from sqlalchemy import func, select, update, insert
+from sqlalchemy.exc import IntegrityError
+
+from db_common import DBException
+
+
+class KeySlotsMixin:
+    """
+    Общий для процессов и узлов учет занятых API-ключей
+    (таблицы key_slots и key_states)
+    """
+
+    def register_key_slots(self, key_ids: list[str], max_in_flight: int):
+        """
+        Создает недостающие слоты и состояния ключей. Процессы стартуют
+        одновременно, поэтому при конфликте вставки просто повторяем
+        """
+        for attempt in range(3):
+            try:
+                self._insert_key_slots(key_ids, max_in_flight)
+                return
+            except IntegrityError as exc:
+                if attempt == 2:
+                    raise DBException(f"Error in register_key_slots: {exc}") from exc
+            except Exception as exc:
+                raise DBException(f"Error in register_key_slots: {exc}") from exc
+
+    def _insert_key_slots(self, key_ids: list[str], max_in_flight: int):
+        """
+        Одна попытка register_key_slots
+        """
+        with self.engine.begin() as connection:
+            existing = {
+                (str(row[0]), int(row[1]))
+                for row in connection.execute(
+                    select(self.key_slots.c.key_id, self.key_slots.c.slot)
+                ).fetchall()
+            }
+            slots = [
+                {"key_id": key_id, "slot": slot, "holder": "", "lease_until": 0}
+                for key_id in key_ids
+                for slot in range(max_in_flight)
+                if (key_id, slot) not in existing
+            ]
+            if slots:
+                connection.execute(insert(self.key_slots), slots)
+
+            existing = {
+                str(row[0])
+                for row in connection.execute(
+                    select(self.key_states.c.key_id)
+                ).fetchall()
+            }
+            states = [
+                {"key_id": key_id, "strikes": 0, "cooldown_until": 0}
+                for key_id in key_ids
+                if key_id not in existing
+            ]
+            if states:
+                connection.execute(insert(self.key_states), states)
+
+    def get_key_slots(self, max_in_flight: int) -> dict[str, tuple[int, float]]:
+        """
+        Возвращает для каждого ключа (занято слотов, пауза до)
+        """
+        try:
+            with self.engine.connect() as connection:
+                now = int(time.time())
+                busy = {
+                    str(row[0]): int(row[1])
+                    for row in connection.execute(
+                        select(self.key_slots.c.key_id, func.count())
+                        .where(
+                            (self.key_slots.c.holder != "")
+                            & (self.key_slots.c.lease_until >= now)
+                            & (self.key_slots.c.slot < max_in_flight)
+                        )
+                        .group_by(self.key_slots.c.key_id)
+                    ).fetchall()
+                }
+                states = select(
+                    self.key_states.c.key_id,
+                    self.key_states.c.cooldown_until,
+                )
+                return {
+                    str(row[0]): (busy.get(str(row[0]), 0), float(row[1]))
+                    for row in connection.execute(states).fetchall()
+                }
+        except Exception as exc:
+            raise DBException(f"Error in get_key_slots: {exc}") from exc
+
+    def acquire_key_slot(
+        self,
+        key_id: str,
+        max_in_flight: int,
+        holder: str,
+        lease_ttl: int,
+    ) -> int:
+        """
+        Занимает свободный слот ключа (или слот с истекшей арендой: процесс,
+        который его держал, упал). Захват - условный UPDATE, как у задач.
+        Возвращает номер слота или None
+        """
+        try:
+            slots = self.key_slots
+            with self.engine.connect() as connection:
+                now = int(time.time())
+                available = (slots.c.key_id == key_id) & (
+                    (slots.c.holder == "") | (slots.c.lease_until < now)
+                )
+                candidates = connection.execute(
+                    select(slots.c.slot, slots.c.holder)
+                    .where(available & (slots.c.slot < max_in_flight))
+                    .order_by(slots.c.slot)
+                ).fetchall()
+
+                for slot, old_holder in candidates:
+                    update_query = (
+                        update(slots)
+                        .where(
+                            available
+                            & (slots.c.slot == slot)
+                            & (slots.c.holder == old_holder)
+                        )
+                        .values(holder=holder, lease_until=now + lease_ttl)
+                    )
+                    if connection.execute(update_query).rowcount == 1:
+                        return int(slot)
+                return None
+        except Exception as exc:
+            raise DBException(f"Error in acquire_key_slot: {exc}") from exc
+
+    def extend_key_slot(self, key_id: str, slot: int, holder: str, lease_ttl: int):
+        """
+        Продлевает аренду слота, пока идет запрос к нейросети
+        """
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(
+                    update(self.key_slots)
+                    .where(
+                        (self.key_slots.c.key_id == key_id)
+                        & (self.key_slots.c.slot == slot)
+                        & (self.key_slots.c.holder == holder)
+                    )
+                    .values(lease_until=int(time.time()) + lease_ttl)
+                )
+        except Exception as exc:
+            raise DBException(f"Error in extend_key_slot: {exc}") from exc
+
+    def release_key_slot(self, key_id: str, slot: int, holder: str):
+        """
+        Освобождает слот, если его еще держит holder
+        """
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(
+                    update(self.key_slots)
+                    .where(
+                        (self.key_slots.c.key_id == key_id)
+                        & (self.key_slots.c.slot == slot)
+                        & (self.key_slots.c.holder == holder)
+                    )
+                    .values(holder="", lease_until=0)
+                )
+        except Exception as exc:
+            raise DBException(f"Error in release_key_slot: {exc}") from exc
+
+    def cool_down_key(self, key_id: str, base: float, maximum: float) -> float:
+        """
+        Ставит ключ на паузу с экспоненциальной задержкой по числу ошибок
+        подряд. Возвращает длину паузы
+        """
+        try:
+            states = self.key_states
+            with self.engine.connect() as connection:
+                for _ in range(3):
+                    strikes = connection.execute(
+                        select(states.c.strikes).where(states.c.key_id == key_id)
+                    ).scalar()
+                    if strikes is None:
+                        return 0.0
+                    cooldown = min(base * 2 ** int(strikes), maximum)
+                    update_query = (
+                        update(states)
+                        .where(
+                            (states.c.key_id == key_id)
+                            & (states.c.strikes == strikes)
+                        )
+                        .values(
+                            strikes=strikes + 1,
+                            cooldown_until=time.time() + cooldown,
+                        )
+                    )
+                    # Ошибку одновременно мог записать другой процесс
+                    if connection.execute(update_query).rowcount == 1:
+                        return cooldown
+                return 0.0
+        except Exception as exc:
+            raise DBException(f"Error in cool_down_key: {exc}") from exc
+
+    def reset_key_strikes(self, key_id: str):
+        """
+        Сбрасывает счетчик ошибок ключа после успешного запроса
+        """
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(
+                    update(self.key_states)
+                    .where(
+                        (self.key_states.c.key_id == key_id)
+                        & (self.key_states.c.strikes != 0)
+                    )
+                    .values(strikes=0)
+                )
+        except Exception as exc:
+            raise DBException(f"Error in reset_key_strikes: {exc}") from exc
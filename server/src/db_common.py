@@ -0,0 +1,154 @@
+"""
+Модуль с общим для Database и AsyncDatabase: исключение, состояния
+задач, настройки пула соединений и запросы, которые собираются одинаково
+для синхронного и асинхронного движка
+"""
+
+from sqlalchemy import Table, select, update, insert
+
+# Состояния задач в очереди generation_jobs
+JOB_QUEUED = 0
+JOB_LEASED = 1
+JOB_DONE = 2
+JOB_FAILED = 3
+
+
+class DBException(Exception):
+    """
+    Класс исключения, связанного с базой данных
+    """
+
+    pass
+
+
+def engine_pool_options(uri: str, pool_options: dict) -> dict:
+    """
+    Настройки пула соединений для create_engine. У SQLite свой пул
+    без этих параметров, поэтому для него они не передаются
+    """
+    if not pool_options or uri.startswith("sqlite"):
+        return {}
+    return pool_options
+
+
+def pool_stats(pool) -> dict:
+    """
+    Загрузка пула соединений (для логов и метрик)
+    """
+    stats = {"status": pool.status()}
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        if hasattr(pool, name):
+            stats[name] = getattr(pool, name)()
+    return stats
+
+
+def new_record(table: Table, **values):
+    """
+    INSERT записи о генерации, пока без результата.
+    values - query, user_id, method, group_id, unix_date и platform
+    """
+    return insert(table).values(status=0, rating=0, published=0, hidden=0, **values)
+
+
+def record_result(table: Table, text_id: int, text: str, gen_time: int, is_ok: bool):
+    """
+    UPDATE с результатом генерации и потраченным временем
+    """
+    return (
+        update(table)
+        .where(table.c.id == text_id)
+        .values(text=text, gen_time=gen_time, status=1 if is_ok else 2)
+    )
+
+
+def available_jobs(jobs: Table, now: int, max_attempts: int):
+    """
+    Условие для задач, которые можно забрать: новых или тех,
+    у которых истекла аренда, с неисчерпанными попытками
+    """
+    return (
+        (jobs.c.state == JOB_QUEUED)
+        | ((jobs.c.state == JOB_LEASED) & (jobs.c.lease_until < now))
+    ) & (jobs.c.attempts < max_attempts)
+
+
+def job_candidates(jobs: Table, available):
+    """
+    SELECT первых подходящих задач: (job_id, gen_id, payload, attempts)
+    """
+    return (
+        select(jobs.c.id, jobs.c.gen_id, jobs.c.payload, jobs.c.attempts)
+        .where(available)
+        .order_by(jobs.c.id)
+        .limit(10)
+    )
+
+
+def lease_job_query(jobs: Table, candidate: tuple, available, worker: str, until: int):
+    """
+    Условный UPDATE, который захватывает задачу candidate из job_candidates,
+    только если ее еще никто не забрал
+    """
+    job_id, _, _, attempts = candidate
+    return (
+        update(jobs)
+        .where((jobs.c.id == job_id) & (jobs.c.attempts == attempts) & available)
+        .values(
+            state=JOB_LEASED,
+            attempts=attempts + 1,
+            lease_until=until,
+            worker=worker,
+        )
+    )
+
+
+def extend_lease_query(jobs: Table, job_id: int, worker: str, until: int):
+    """
+    UPDATE, который продлевает аренду задачи воркера
+    """
+    return (
+        update(jobs)
+        .where(
+            (jobs.c.id == job_id)
+            & (jobs.c.worker == worker)
+            & (jobs.c.state == JOB_LEASED)
+        )
+        .values(lease_until=until)
+    )
+
+
+def finish_job_query(jobs: Table, job_id: int, worker: str, is_ok: bool):
+    """
+    UPDATE, который закрывает задачу воркера
+    """
+    return (
+        update(jobs)
+        .where((jobs.c.id == job_id) & (jobs.c.worker == worker))
+        .values(state=JOB_DONE if is_ok else JOB_FAILED)
+    )
+
+
+def exhausted_jobs(jobs: Table, now: int, max_attempts: int):
+    """
+    Условие для задач с истекшей арендой, которые исчерпали попытки
+    """
+    return (
+        (jobs.c.state == JOB_LEASED)
+        & (jobs.c.lease_until < now)
+        & (jobs.c.attempts >= max_attempts)
+    )
+
+
+def expire_queries(jobs: Table, records: Table, exhausted, gen_ids: list[int]):
+    """
+    UPDATE задач, исчерпавших попытки, и UPDATE их генераций
+    (статус ошибки, если результата еще нет)
+    """
+    return (
+        update(jobs)
+        .where(exhausted & jobs.c.gen_id.in_(gen_ids))
+        .values(state=JOB_FAILED),
+        update(records)
+        .where(records.c.id.in_(gen_ids) & (records.c.status == 0))
+        .values(status=2),
+    )
@@ -0,0 +1,50 @@
+"""
+Модуль с шиной событий о ходе генерации (для SSE)
+"""
+
+import asyncio
+import json
+
+
+class GenerationEvents:
+    """
+    Pub/sub внутри процесса: ask_nn публикует события по text_id,
+    а SSE-обработчики на них подписываются. Все методы вызываются
+    из event loop, поэтому блокировки не нужны
+    """
+
+    def __init__(self):
+        self.subscribers: dict[int, set[asyncio.Queue]] = {}
+
+    def subscribe(self, text_id: int) -> asyncio.Queue:
+        """
+        Подписывается на события генерации
+        """
+        queue = asyncio.Queue()
+        self.subscribers.setdefault(text_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, text_id: int, queue: asyncio.Queue):
+        """
+        Отписывается от событий генерации
+        """
+        queues = self.subscribers.get(text_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.subscribers[text_id]
+
+    def publish(self, text_id: int, event: str, data: dict):
+        """
+        Отправляет событие всем подписчикам генерации
+        """
+        for queue in self.subscribers.get(text_id, ()):
+            queue.put_nowait((event, data))
+
+
+def format_sse(event: str, data: dict) -> str:
+    """
+    Собирает одно сообщение в формате text/event-stream
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
@@ -0,0 +1,624 @@
+"""
+Модуль с пулом API-ключей нейросети
+"""
+
+import asyncio
+import fcntl
+import logging
+import mmap
+import os
+import secrets
+import socket
+import struct
+import threading
+import time
+
+from contextlib import contextmanager, asynccontextmanager
+from dataclasses import dataclass, field
+from hashlib import sha256
+
+# Коды ответа, после которых ключ надо временно не трогать
+COOLDOWN_STATUS_CODES = (429, 500, 502, 503, 504)
+ACQUIRE_POLL_INTERVAL = 0.05
+
+
+class KeyPoolException(Exception):
+    """
+    Класс исключения, связанного с пулом ключей
+    """
+
+    pass
+
+
+def make_key_id(token: str) -> str:
+    """
+    Идентификатор ключа для общих хранилищ: сам ключ туда не пишем
+    """
+    return sha256(token.encode("utf-8")).hexdigest()[:32]
+
+
+class LocalKeySlots:
+    """
+    Учет занятых ключей в памяти процесса. Подходит, только если
+    ключами пользуется один процесс
+    """
+
+    shared = False
+    poll_interval = ACQUIRE_POLL_INTERVAL
+
+    def __init__(self, key_count: int, max_in_flight: int):
+        self.max_in_flight = max_in_flight
+        self.in_flight = [0] * key_count
+        self.strikes = [0] * key_count
+        self.cooldown_until = [0.0] * key_count
+        self.lock = threading.Lock()
+
+    def snapshot(self) -> list[tuple[int, float]]:
+        """
+        Для каждого ключа: (занято слотов, пауза до)
+        """
+        with self.lock:
+            return list(zip(self.in_flight, self.cooldown_until))
+
+    def acquire(self, index: int, *_):
+        """
+        Занимает слот ключа. Возвращает описание слота или None.
+        Аренды нет (слоты живут вместе с процессом), срок аренды не нужен
+        """
+        with self.lock:
+            if self.in_flight[index] >= self.max_in_flight:
+                return None
+            self.in_flight[index] += 1
+            return index
+
+    def extend(self, index: int, slot, lease_ttl: float):
+        """
+        Процесс не может упасть отдельно от своих слотов, продлевать нечего
+        """
+
+    def release(self, index: int, *_):
+        """
+        Освобождает слот ключа (слоты одного ключа не различаются)
+        """
+        with self.lock:
+            self.in_flight[index] = max(self.in_flight[index] - 1, 0)
+
+    def cool_down(self, index: int, base: float, maximum: float):
+        """
+        Ставит ключ на паузу с экспоненциальной задержкой
+        """
+        with self.lock:
+            cooldown = min(base * 2 ** self.strikes[index], maximum)
+            self.strikes[index] += 1
+            self.cooldown_until[index] = time.time() + cooldown
+
+    def reset_strikes(self, index: int):
+        """
+        Сбрасывает счетчик ошибок ключа
+        """
+        with self.lock:
+            self.strikes[index] = 0
+
+
+class SharedMemoryKeySlots:
+    """
+    Учет занятых ключей в разделяемой памяти (файл в /dev/shm) для
+    нескольких процессов на одной машине, например uvicorn --workers N.
+    Доступ под fcntl.flock. Слот занятого процесса освобождается, когда
+    истекла аренда или процесс, который его держит, уже умер
+    """
+
+    shared = True
+    poll_interval = ACQUIRE_POLL_INTERVAL
+
+    MAGIC = b"SBKEYS01"
+    # magic, число ключей, слотов на ключ, хэш списка ключей
+    HEADER = struct.Struct("8sqq32s")
+    # число ошибок подряд, пауза до
+    KEY = struct.Struct("qd")
+    # pid, nonce аренды, аренда до
+    SLOT = struct.Struct("qqd")
+
+    def __init__(self, path: str, key_ids: list[str], max_in_flight: int):
+        self.path = path
+        self.key_count = len(key_ids)
+        self.max_in_flight = max_in_flight
+        self.key_size = self.KEY.size + self.SLOT.size * max_in_flight
+        size = self.HEADER.size + self.key_size * self.key_count
+        header = self.HEADER.pack(
+            self.MAGIC,
+            self.key_count,
+            max_in_flight,
+            sha256("\n".join(key_ids).encode("utf-8")).digest(),
+        )
+
+        # flock исключает только другие процессы: потоки этого процесса
+        # делят один дескриптор, поэтому между ними - обычная блокировка
+        self.lock = threading.Lock()
+        try:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            with self.locked():
+                # Другой набор ключей в конфиге - начинаем учет заново
+                if os.fstat(self.fd).st_size != size or os.pread(
+                    self.fd, self.HEADER.size, 0
+                ) != header:
+                    os.ftruncate(self.fd, 0)
+                    os.ftruncate(self.fd, size)
+                    os.pwrite(self.fd, header, 0)
+                self.memory = mmap.mmap(self.fd, size)
+        except OSError as exc:
+            raise KeyPoolException(f"Error in SharedMemoryKeySlots: {exc}") from exc
+
+    @contextmanager
+    def locked(self):
+        """
+        Эксклюзивный доступ к разделяемой памяти (среди процессов и потоков)
+        """
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _key_offset(self, index: int) -> int:
+        return self.HEADER.size + self.key_size * index
+
+    def _slot_offset(self, index: int, slot: int) -> int:
+        return self._key_offset(index) + self.KEY.size + self.SLOT.size * slot
+
+    def _slot_busy(self, index: int, slot: int, now: float) -> bool:
+        pid, _, lease_until = self.SLOT.unpack_from(
+            self.memory, self._slot_offset(index, slot)
+        )
+        return pid != 0 and lease_until >= now and pid_alive(pid)
+
+    def snapshot(self) -> list[tuple[int, float]]:
+        """
+        Для каждого ключа: (занято слотов, пауза до)
+        """
+        now = time.time()
+        with self.locked():
+            return [
+                (
+                    sum(
+                        self._slot_busy(index, slot, now)
+                        for slot in range(self.max_in_flight)
+                    ),
+                    self.KEY.unpack_from(self.memory, self._key_offset(index))[1],
+                )
+                for index in range(self.key_count)
+            ]
+
+    def acquire(self, index: int, lease_ttl: float):
+        """
+        Занимает слот ключа. Возвращает (слот, nonce) или None
+        """
+        now = time.time()
+        with self.locked():
+            for slot in range(self.max_in_flight):
+                if self._slot_busy(index, slot, now):
+                    continue
+                nonce = secrets.randbits(62)
+                self.SLOT.pack_into(
+                    self.memory,
+                    self._slot_offset(index, slot),
+                    os.getpid(),
+                    nonce,
+                    now + lease_ttl,
+                )
+                return slot, nonce
+            return None
+
+    def _holds(self, index: int, slot) -> bool:
+        pid, nonce, _ = self.SLOT.unpack_from(
+            self.memory, self._slot_offset(index, slot[0])
+        )
+        return pid == os.getpid() and nonce == slot[1]
+
+    def extend(self, index: int, slot, lease_ttl: float):
+        """
+        Продлевает аренду слота
+        """
+        with self.locked():
+            if self._holds(index, slot):
+                self.SLOT.pack_into(
+                    self.memory,
+                    self._slot_offset(index, slot[0]),
+                    os.getpid(),
+                    slot[1],
+                    time.time() + lease_ttl,
+                )
+
+    def release(self, index: int, slot):
+        """
+        Освобождает слот, если аренда еще наша
+        """
+        with self.locked():
+            if self._holds(index, slot):
+                self.SLOT.pack_into(
+                    self.memory, self._slot_offset(index, slot[0]), 0, 0, 0.0
+                )
+
+    def cool_down(self, index: int, base: float, maximum: float):
+        """
+        Ставит ключ на паузу с экспоненциальной задержкой
+        """
+        with self.locked():
+            strikes, _ = self.KEY.unpack_from(self.memory, self._key_offset(index))
+            cooldown = min(base * 2**strikes, maximum)
+            self.KEY.pack_into(
+                self.memory,
+                self._key_offset(index),
+                strikes + 1,
+                time.time() + cooldown,
+            )
+
+    def reset_strikes(self, index: int):
+        """
+        Сбрасывает счетчик ошибок ключа
+        """
+        with self.locked():
+            _, cooldown_until = self.KEY.unpack_from(
+                self.memory, self._key_offset(index)
+            )
+            self.KEY.pack_into(self.memory, self._key_offset(index), 0, cooldown_until)
+
+
+def pid_alive(pid: int) -> bool:
+    """
+    Жив ли процесс на этой машине
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class DatabaseKeySlots:
+    """
+    Учет занятых ключей в базе данных: общий для всех процессов и машин
+    (API и воркеры очереди в разных контейнерах). Слоты захватываются
+    условным UPDATE с арендой, слоты упавших процессов освобождаются
+    по истечении аренды. Снимок загрузки кэшируется на snapshot_ttl секунд,
+    чтобы проверки готовности не ходили в базу на каждый запрос
+    """
+
+    shared = True
+    poll_interval = 0.5
+
+    def __init__(
+        self,
+        db,
+        key_ids: list[str],
+        max_in_flight: int,
+        snapshot_ttl: float = 0.5,
+    ):
+        self.db = db
+        self.key_ids = key_ids
+        self.max_in_flight = max_in_flight
+        self.snapshot_ttl = snapshot_ttl
+        self.cached_snapshot = None
+        self.cached_at = 0.0
+        self.lock = threading.Lock()
+        try:
+            db.register_key_slots(key_ids, max_in_flight)
+        except Exception as exc:
+            raise KeyPoolException(f"Error in DatabaseKeySlots: {exc}") from exc
+
+    def _invalidate(self):
+        with self.lock:
+            self.cached_snapshot = None
+
+    def snapshot(self) -> list[tuple[int, float]]:
+        """
+        Для каждого ключа: (занято слотов, пауза до)
+        """
+        now = time.monotonic()
+        with self.lock:
+            cached = self.cached_snapshot
+            if cached is not None and now - self.cached_at < self.snapshot_ttl:
+                return cached
+        try:
+            slots = self.db.get_key_slots(self.max_in_flight)
+        except Exception as exc:
+            raise KeyPoolException(f"Error in DatabaseKeySlots: {exc}") from exc
+        snapshot = [slots.get(key_id, (0, 0.0)) for key_id in self.key_ids]
+        with self.lock:
+            self.cached_snapshot = snapshot
+            self.cached_at = now
+        return snapshot
+
+    def acquire(self, index: int, lease_ttl: float):
+        """
+        Занимает слот ключа. Возвращает (слот, holder) или None
+        """
+        holder = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        try:
+            slot = self.db.acquire_key_slot(
+                self.key_ids[index], self.max_in_flight, holder, int(lease_ttl)
+            )
+        except Exception as exc:
+            raise KeyPoolException(f"Error in DatabaseKeySlots: {exc}") from exc
+        self._invalidate()
+        return None if slot is None else (slot, holder)
+
+    def extend(self, index: int, slot, lease_ttl: float):
+        """
+        Продлевает аренду слота
+        """
+        try:
+            self.db.extend_key_slot(self.key_ids[index], *slot, int(lease_ttl))
+        except Exception as exc:
+            raise KeyPoolException(f"Error in DatabaseKeySlots: {exc}") from exc
+
+    def release(self, index: int, slot):
+        """
+        Освобождает слот, если аренда еще наша
+        """
+        try:
+            self.db.release_key_slot(self.key_ids[index], *slot)
+        except Exception as exc:
+            raise KeyPoolException(f"Error in DatabaseKeySlots: {exc}") from exc
+        self._invalidate()
+
+    def cool_down(self, index: int, base: float, maximum: float):
+        """
+        Ставит ключ на паузу с экспоненциальной задержкой
+        """
+        try:
+            self.db.cool_down_key(self.key_ids[index], base, maximum)
+        except Exception as exc:
+            raise KeyPoolException(f"Error in DatabaseKeySlots: {exc}") from exc
+        self._invalidate()
+
+    def reset_strikes(self, index: int):
+        """
+        Сбрасывает счетчик ошибок ключа
+        """
+        try:
+            self.db.reset_key_strikes(self.key_ids[index])
+        except Exception as exc:
+            raise KeyPoolException(f"Error in DatabaseKeySlots: {exc}") from exc
+
+
+@dataclass(eq=False)
+class KeyState:
+    """
+    Счетчики одного ключа в этом процессе (загрузка и паузы - в slots)
+    """
+
+    token: str
+    key_id: str = field(init=False)
+    total_requests: int = 0
+    total_failures: int = 0
+
+    def __post_init__(self):
+        self.key_id = make_key_id(self.token)
+
+
+@dataclass(eq=False)
+class KeyLease:
+    """
+    Выданный ключ. Через него сообщаем пулу, чем закончился запрос
+    """
+
+    token: str
+    index: int = 0
+    slot: object = None
+    status_code: int = field(default=None, init=False)
+
+    def failed(self, status_code: int = None):
+        """
+        Отмечает, что запрос на этом ключе упал с указанным кодом
+        """
+        self.status_code = status_code if status_code is not None else 0
+
+
+class KeyPool:
+    """
+    Пул ключей с ограничением одновременных запросов на ключ,
+    выбором наименее загруженного ключа и паузой с экспоненциальной
+    задержкой после 429/5xx. Загрузка и паузы хранятся в slots:
+    в памяти процесса (LocalKeySlots), в разделяемой памяти машины
+    (SharedMemoryKeySlots) или в базе (DatabaseKeySlots). Слот берется
+    в аренду на lease_ttl секунд и продлевается, пока идет запрос
+    """
+
+    def __init__(
+        self,
+        tokens: list[str],
+        max_in_flight: int = 1,
+        base_cooldown: float = 5.0,
+        max_cooldown: float = 300.0,
+        lease_ttl: float = 120.0,
+    ):
+        if len(tokens) == 0:
+            raise KeyPoolException("No api tokens for the key pool")
+        self.keys = [KeyState(token) for token in tokens]
+        self.max_in_flight = max_in_flight
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.lease_ttl = lease_ttl
+        self.slots = LocalKeySlots(len(tokens), max_in_flight)
+        self.lock = threading.Lock()
+
+    def key_ids(self) -> list[str]:
+        """
+        Идентификаторы ключей для общих хранилищ
+        """
+        return [key.key_id for key in self.keys]
+
+    def use_slots(self, slots):
+        """
+        Переключает пул на другое хранилище загрузки ключей
+        """
+        self.slots = slots
+
+    def _candidates(self, exclude: set[int] = frozenset()) -> list[int]:
+        """
+        Ключи, которые можно занять, от наименее загруженного
+        """
+        now = time.time()
+        snapshot = self.slots.snapshot()
+        available = [
+            index
+            for index, (in_flight, cooldown_until) in enumerate(snapshot)
+            if cooldown_until <= now
+            and in_flight < self.max_in_flight
+            and index not in exclude
+        ]
+        return sorted(available, key=lambda index: snapshot[index][0])
+
+    def try_acquire(self, exclude: set[int] = frozenset()) -> KeyLease:
+        """
+        Занимает наименее загруженный доступный ключ, кроме ключей
+        с номерами из exclude. Возвращает None, если свободных ключей нет
+        """
+        for index in self._candidates(exclude):
+            # Слот мог занять другой процесс - тогда пробуем следующий ключ
+            slot = self.slots.acquire(index, self.lease_ttl)
+            if slot is None:
+                continue
+            key = self.keys[index]
+            with self.lock:
+                key.total_requests += 1
+            return KeyLease(key.token, index, slot)
+        return None
+
+    def release(self, lease: KeyLease):
+        """
+        Освобождает ключ. Если запрос упал с 429/5xx, ставит ключ на паузу
+        """
+        if lease.status_code is not None:
+            with self.lock:
+                self.keys[lease.index].total_failures += 1
+        # Ошибка хранилища не должна ронять уже выполненный запрос:
+        # неосвобожденный слот освободится по истечении аренды
+        try:
+            self.slots.release(lease.index, lease.slot)
+            if lease.status_code is None:
+                self.slots.reset_strikes(lease.index)
+            elif lease.status_code in COOLDOWN_STATUS_CODES:
+                self.slots.cool_down(
+                    lease.index, self.base_cooldown, self.max_cooldown
+                )
+        except KeyPoolException as exc:
+            logging.error("Error while releasing api token: %s", exc)
+
+    def extend(self, lease: KeyLease):
+        """
+        Продлевает аренду слота ключа
+        """
+        self.slots.extend(lease.index, lease.slot, self.lease_ttl)
+
+    def ready(self) -> bool:
+        """
+        Есть ли сейчас хотя бы один ключ, который можно занять
+        """
+        return len(self._candidates()) > 0
+
+    @contextmanager
+    def lease(self):
+        """
+        Контекстный менеджер, который занимает ключ и гарантированно
+        освобождает его при выходе, в том числе при исключении
+        """
+        key_lease = self.try_acquire()
+        if key_lease is None:
+            raise KeyPoolException("No free api tokens")
+        try:
+            yield key_lease
+        except BaseException:
+            if key_lease.status_code is None:
+                key_lease.failed()
+            raise
+        finally:
+            self.release(key_lease)
+
+    async def _call(self, func, *args):
+        """
+        Вызов хранилища из корутины: общие хранилища блокируются
+        (база, flock), поэтому их вызываем в пуле потоков
+        """
+        if not self.slots.shared:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def _keep_extended(self, key_lease: KeyLease):
+        """
+        Продлевает аренду, пока идет запрос
+        """
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            try:
+                await self._call(self.extend, key_lease)
+            except KeyPoolException:
+                pass
+
+    @asynccontextmanager
+    async def lease_async(
+        self, timeout: float = 0.0, exclude: set[int] = frozenset()
+    ):
+        """
+        То же, что lease, но ждет освобождения ключа до timeout секунд,
+        не блокируя event loop. exclude - номера ключей, которые брать нельзя
+        """
+        deadline = time.monotonic() + timeout
+        key_lease = await self._call(self.try_acquire, exclude)
+        while key_lease is None:
+            if time.monotonic() >= deadline:
+                raise KeyPoolException("No free api tokens")
+            await asyncio.sleep(self.slots.poll_interval)
+            key_lease = await self._call(self.try_acquire, exclude)
+        renewal = (
+            asyncio.create_task(self._keep_extended(key_lease))
+            if self.slots.shared
+            else None
+        )
+        try:
+            yield key_lease
+        except BaseException:
+            if key_lease.status_code is None:
+                key_lease.failed()
+            raise
+        finally:
+            if renewal is not None:
+                renewal.cancel()
+            await self._call(self.release, key_lease)
+
+    def stats(self) -> list[dict]:
+        """
+        Снимок состояния ключей (для логов и метрик). in_flight -
+        по всем процессам, requests и failures - по этому процессу
+        """
+        now = time.time()
+        snapshot = self.slots.snapshot()
+        with self.lock:
+            return [
+                {
+                    "key": key.token[:10],
+                    "in_flight": snapshot[index][0],
+                    "cooling_down": snapshot[index][1] > now,
+                    "requests": key.total_requests,
+                    "failures": key.total_failures,
+                }
+                for index, key in enumerate(self.keys)
+            ]
+
+
+def make_key_slots(backend: str, pool: KeyPool, db=None, path: str = None):
+    """
+    Хранилище загрузки ключей по настройке из конфига:
+    local - процесс, shm - машина, db - все процессы с общей базой
+    """
+    if backend == "local":
+        return LocalKeySlots(len(pool.keys), pool.max_in_flight)
+    if backend == "shm":
+        return SharedMemoryKeySlots(path, pool.key_ids(), pool.max_in_flight)
+    if backend == "db":
+        return DatabaseKeySlots(db, pool.key_ids(), pool.max_in_flight)
+    raise KeyPoolException(f"Unknown key slots backend: {backend}")
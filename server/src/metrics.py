@@ -0,0 +1,450 @@
+"""
+Модуль с метриками в текстовом формате Prometheus. Каждый процесс
+считает метрики в памяти и раз в interval секунд сбрасывает снимок
+в общий каталог, а /metrics складывает снимки всех процессов
+"""
+
+import asyncio
+import bisect
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from contextlib import contextmanager
+from enum import Enum
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+class MetricsException(Exception):
+    """
+    Класс исключения, связанного с метриками
+    """
+
+    pass
+
+
+class Metric:
+    """
+    Метрика с метками: значения хранятся по кортежу значений меток
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values: dict[tuple, object] = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if len(labels) != len(self.labels):
+            raise MetricsException(f"Wrong labels for {self.name}: {labels}")
+        return tuple(
+            str(value.value if isinstance(value, Enum) else value)
+            for value in (labels[label] for label in self.labels)
+        )
+
+    def dump(self) -> dict:
+        """
+        Снимок метрики для сброса в файл
+        """
+        with self.lock:
+            return {
+                "kind": self.kind,
+                "help": self.documentation,
+                "labels": list(self.labels),
+                "values": [[list(key), value] for key, value in self.values.items()],
+            }
+
+
+class Counter(Metric):
+    """
+    Счетчик: только растет, между процессами складывается
+    """
+
+    kind = "counter"
+
+    def inc(self, value: float = 1, **labels):
+        """
+        Увеличивает счетчик
+        """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, value: float, **labels):
+        """
+        Выставляет значение счетчика, который ведет сам компонент
+        (например, попадания в кэш из его stats())
+        """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Gauge(Metric):
+    """
+    Текущее значение. Между процессами складывается (aggregate="sum")
+    или берется наибольшее (aggregate="max" - для значений, которые
+    каждый процесс читает из общего хранилища)
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple = (),
+        aggregate: str = "sum",
+    ):
+        super().__init__(name, documentation, labels)
+        self.aggregate = aggregate
+
+    def set(self, value: float, **labels):
+        """
+        Выставляет значение
+        """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def dump(self) -> dict:
+        return dict(super().dump(), aggregate=self.aggregate)
+
+
+class Histogram(Metric):
+    """
+    Гистограмма: число наблюдений по корзинам, сумма и количество
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple = (),
+        buckets: tuple = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        """
+        Добавляет наблюдение
+        """
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            # Корзины (последняя - +Inf), сумма, количество
+            entry = self.values.get(key)
+            if entry is None:
+                entry = [0] * (len(self.buckets) + 1) + [0.0, 0]
+                self.values[key] = entry
+            entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Замеряет время выполнения блока with
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def dump(self) -> dict:
+        with self.lock:
+            values = [[list(key), list(value)] for key, value in self.values.items()]
+        return {
+            "kind": self.kind,
+            "help": self.documentation,
+            "labels": list(self.labels),
+            "buckets": list(self.buckets),
+            "values": values,
+        }
+
+
+class Registry:
+    """
+    Набор метрик процесса. Функции из on_collect вызываются перед каждым
+    снимком и выставляют метрики, которые берутся из stats() компонентов
+    """
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+        self.collectors = []
+
+    def _add(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise MetricsException(f"Duplicate metric: {metric.name}")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> Counter:
+        """
+        Регистрирует счетчик
+        """
+        return self._add(Counter(name, documentation, labels))
+
+    def gauge(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple = (),
+        aggregate: str = "sum",
+    ) -> Gauge:
+        """
+        Регистрирует текущее значение
+        """
+        return self._add(Gauge(name, documentation, labels, aggregate))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple = (),
+        buckets: tuple = LATENCY_BUCKETS,
+    ) -> Histogram:
+        """
+        Регистрирует гистограмму
+        """
+        return self._add(Histogram(name, documentation, labels, buckets))
+
+    def on_collect(self, func):
+        """
+        Добавляет функцию, которая обновляет метрики перед снимком
+        """
+        self.collectors.append(func)
+        return func
+
+    def snapshot(self) -> dict:
+        """
+        Снимок всех метрик процесса
+        """
+        for func in self.collectors:
+            try:
+                func()
+            except Exception as exc:
+                logging.error(f"Error in metrics collector {func.__name__}: {exc}")
+        return {name: metric.dump() for name, metric in self.metrics.items()}
+
+
+def merge_snapshots(snapshots: list[tuple[dict, bool]]) -> dict:
+    """
+    Складывает снимки процессов: (снимок, свежий ли он). Счетчики
+    и гистограммы складываются по всем снимкам, включая процессы, которые
+    уже завершились (иначе счетчики бы уменьшались), текущие значения -
+    только по свежим снимкам
+    """
+    merged = {}
+    for snapshot, fresh in snapshots:
+        for name, metric in snapshot.items():
+            if metric["kind"] == "gauge" and not fresh:
+                continue
+            target = merged.setdefault(name, dict(metric, values={}))
+            for key, value in metric["values"]:
+                key = tuple(key)
+                current = target["values"].get(key)
+                if current is None:
+                    target["values"][key] = value
+                elif metric["kind"] == "histogram":
+                    target["values"][key] = [a + b for a, b in zip(current, value)]
+                elif metric.get("aggregate") == "max":
+                    target["values"][key] = max(current, value)
+                else:
+                    target["values"][key] = current + value
+    return merged
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: list[str], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def render(metrics: dict) -> str:
+    """
+    Текстовый формат Prometheus (text/plain; version=0.0.4)
+    """
+    lines = []
+    for name, metric in sorted(metrics.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        labels = metric["labels"]
+        for key, value in sorted(metric["values"].items()):
+            if metric["kind"] != "histogram":
+                lines.append(
+                    f"{name}{_format_labels(labels, key)} {_format_number(value)}"
+                )
+                continue
+            cumulative = 0
+            bounds = metric["buckets"] + [float("inf")]
+            for bound, count in zip(bounds, value):
+                cumulative += count
+                le = f'le="{_format_number(bound)}"'
+                lines.append(
+                    f"{name}_bucket{_format_labels(labels, key, le)} {cumulative}"
+                )
+            lines.append(
+                f"{name}_sum{_format_labels(labels, key)} {_format_number(value[-2])}"
+            )
+            lines.append(f"{name}_count{_format_labels(labels, key)} {value[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """
+    Сбрасывает снимок метрик процесса в directory/<хост>-<pid>.json
+    раз в interval секунд (фоновый поток) и собирает /metrics из снимков
+    всех процессов каталога. Каталог общий для процессов uvicorn и воркеров
+    (на одной машине - /dev/shm, в разных контейнерах - общий том).
+    Без каталога /metrics показывает только этот процесс. Снимки, которые
+    не обновлялись retention секунд, удаляются
+    """
+
+    def __init__(
+        self,
+        registry: Registry,
+        directory: str = None,
+        interval: float = 1.0,
+        retention: float = 86400,
+    ):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self.retention = retention
+        self.name = f"{socket.gethostname()}-{os.getpid()}.json"
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Запускает фоновый сброс снимков (если задан каталог)
+        """
+        if not self.directory or self.thread is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = threading.Thread(
+            target=self.run, name="metrics-exporter", daemon=True
+        )
+        self.thread.start()
+
+    def run(self):
+        """
+        Фоновый поток: сбрасывает снимок раз в interval секунд
+        """
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        """
+        Атомарно записывает снимок процесса в каталог
+        """
+        path = os.path.join(self.directory, self.name)
+        try:
+            with open(f"{path}.tmp", "w", encoding="UTF-8") as snapshot_file:
+                json.dump(self.registry.snapshot(), snapshot_file)
+            os.replace(f"{path}.tmp", path)
+        except OSError as exc:
+            logging.error(f"Error while writing metrics snapshot: {exc}")
+
+    def stop(self):
+        """
+        Останавливает фоновый поток, записав последний снимок
+        """
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+    def collect(self) -> str:
+        """
+        Метрики всех процессов в текстовом формате Prometheus
+        """
+        snapshots = [(self.registry.snapshot(), True)]
+        if self.directory:
+            now = time.time()
+            for name in os.listdir(self.directory):
+                if name == self.name or not name.endswith(".json"):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    age = now - os.path.getmtime(path)
+                    if age > self.retention:
+                        os.remove(path)
+                        continue
+                    fresh = age < 3 * self.interval
+                    with open(path, "r", encoding="UTF-8") as snapshot_file:
+                        snapshots.append((json.load(snapshot_file), fresh))
+                except (OSError, ValueError) as exc:
+                    logging.error(f"Error while reading metrics snapshot {name}: {exc}")
+        return render(merge_snapshots(snapshots))
+
+
+class TimedCalls:
+    """
+    Обертка, которая замеряет время каждого вызова публичных методов
+    объекта (синхронных и корутин) в гистограмму с меткой method
+    """
+
+    def __init__(self, target, histogram: Histogram):
+        self.target = target
+        self.histogram = histogram
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.target, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        histogram = self.histogram
+
+        if asyncio.iscoroutinefunction(attr):
+
+            async def call_async(*args, **kwargs):
+                with histogram.time(method=name):
+                    return await attr(*args, **kwargs)
+
+            return call_async
+
+        def call(*args, **kwargs):
+            with histogram.time(method=name):
+                return attr(*args, **kwargs)
+
+        return call
@@ -0,0 +1,22 @@
+"""
+Применяет миграции схемы к базе из config.json:
+
+python migrate.py
+"""
+
+from config import Config
+
+
+def main():
+    """
+    Применяет миграции к базе из config.json
+    """
+    config = Config("config.json")
+    db = config.database()
+    print(f"Schema version: {db.get_schema_version()}")
+    db.migrate()
+    print(f"Schema version: {db.get_schema_version()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Модуль с версионными миграциями схемы базы данных. Миграция описывает
+схему так, как она была на своей версии, а не текущие таблицы Database:
+применение старых миграций не зависит от последующих изменений кода.
+Миграции применяются при старте сервера (Database.migrate) или вручную:
+
+python migrate.py
+"""
+
+from sqlalchemy import (
+    Column,
+    Float,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    inspect,
+)
+
+
+def reflect_table(connection, name: str) -> Table:
+    """
+    Таблица в том виде, в каком она сейчас в базе
+    """
+    return Table(name, MetaData(), autoload_with=connection)
+
+
+def create_index(connection, table_name: str, name: str, *columns: str):
+    """
+    Создает индекс, если его еще нет (таблицы могли создать раньше,
+    чем появились миграции, а в MariaDB DDL не откатывается)
+    """
+    existing = {index["name"] for index in inspect(connection).get_indexes(table_name)}
+    if name in existing:
+        return
+    table = reflect_table(connection, table_name)
+    Index(name, *(table.c[column] for column in columns)).create(connection)
+
+
+def create_tables(connection):
+    """
+    Создает таблицы, которых еще нет (схема версии 1)
+    """
+    meta = MetaData()
+    Table(
+        "generated_data",
+        meta,
+        Column("id", Integer, primary_key=True, nullable=False, autoincrement=True),
+        Column("user_id", Integer, nullable=False),
+        Column("method", String(128), nullable=False),
+        Column("query", String(4096), nullable=False),
+        Column("text", String(4096), nullable=False),
+        Column("rating", Integer, nullable=False),
+        Column("unix_date", Integer, nullable=False),
+        Column("group_id", Integer, nullable=False),
+        Column("status", Integer, nullable=False),
+        Column("gen_time", Integer, nullable=False),
+        Column("platform", String(128), nullable=False),
+        Column("published", Integer, nullable=False),
+        Column("hidden", Integer, nullable=False),
+    )
+    Table(
+        "generation_jobs",
+        meta,
+        Column("id", Integer, primary_key=True, nullable=False, autoincrement=True),
+        Column("gen_id", Integer, nullable=False),
+        Column("payload", Text, nullable=False),
+        Column("state", Integer, nullable=False),
+        Column("attempts", Integer, nullable=False),
+        Column("lease_until", Integer, nullable=False),
+        Column("worker", String(128), nullable=False),
+        Column("created", Integer, nullable=False),
+    )
+    meta.create_all(connection)
+
+
+def add_generated_data_indexes(connection):
+    """
+    Индексы под запросы к generated_data: история пользователя
+    (get_users_texts, с группой и без) и поиск записи по дате в add_record
+    """
+    create_index(
+        connection,
+        "generated_data",
+        "ix_generated_data_user_history",
+        "user_id",
+        "status",
+        "hidden",
+        "id",
+    )
+    create_index(
+        connection,
+        "generated_data",
+        "ix_generated_data_user_group_history",
+        "user_id",
+        "group_id",
+        "status",
+        "hidden",
+        "id",
+    )
+    create_index(
+        connection, "generated_data", "ix_generated_data_unix_date", "unix_date"
+    )
+
+
+def add_generation_jobs_indexes(connection):
+    """
+    Индексы под захват задач воркерами и закрытие задач по gen_id
+    """
+    create_index(
+        connection,
+        "generation_jobs",
+        "ix_generation_jobs_state_lease",
+        "state",
+        "lease_until",
+    )
+    create_index(
+        connection, "generation_jobs", "ix_generation_jobs_gen_id", "gen_id"
+    )
+
+
+def drop_generated_data_date_index(connection):
+    """
+    add_record берет айди из ответа на INSERT, индекс по дате больше не нужен
+    """
+    existing = {
+        index["name"] for index in inspect(connection).get_indexes("generated_data")
+    }
+    if "ix_generated_data_unix_date" in existing:
+        table = reflect_table(connection, "generated_data")
+        Index("ix_generated_data_unix_date", table.c.unix_date).drop(connection)
+
+
+def create_key_slots_tables(connection):
+    """
+    Таблицы общего учета занятых API-ключей
+    """
+    meta = MetaData()
+    Table(
+        "key_slots",
+        meta,
+        Column("key_id", String(64), primary_key=True, autoincrement=False),
+        Column("slot", Integer, primary_key=True, autoincrement=False),
+        Column("holder", String(128), nullable=False),
+        Column("lease_until", Integer, nullable=False),
+    )
+    Table(
+        "key_states",
+        meta,
+        Column("key_id", String(64), primary_key=True, autoincrement=False),
+        Column("strikes", Integer, nullable=False),
+        Column("cooldown_until", Float, nullable=False),
+    )
+    meta.create_all(connection)
+
+
+# (версия, описание, функция). Новые миграции только добавляются в конец
+MIGRATIONS = [
+    (1, "create tables", create_tables),
+    (2, "generated_data indexes", add_generated_data_indexes),
+    (3, "generation_jobs indexes", add_generation_jobs_indexes),
+    (4, "drop generated_data unix_date index", drop_generated_data_date_index),
+    (5, "key slots tables", create_key_slots_tables),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
@@ -0,0 +1,257 @@
+"""
+Модуль с запросами к нейросети: ключ из пула, дедлайн метода, дубль
+медленного запроса и повторы после ошибок провайдера
+"""
+
+import asyncio
+import logging
+import time
+
+from config import Config
+from events import GenerationEvents
+from key_pool import COOLDOWN_STATUS_CODES, KeyPoolException
+from metrics import Histogram
+from nn_api import NNApi, NNException
+from resilience import CLOSED, CircuitBreaker, LatencyTracker, retry_delay
+from scheduler import FairScheduler, SchedulerException
+from utils import prepare_string
+
+
+def is_provider_failure(exc: NNException) -> bool:
+    """
+    Ошибка на стороне провайдера (сеть, таймаут, 429/5xx), а не в запросе:
+    такие ошибки повторяем и учитываем в предохранителе
+    """
+    return exc.status_code is None or exc.status_code in COOLDOWN_STATUS_CODES
+
+
+class ModelClient:
+    """
+    Запросы к нейросети для ask_nn. Каждая попытка ждет своей очереди
+    среди юзеров (scheduler) и берет ключ из пула config.key_pool.
+    breaker - предохранитель провайдера, latency - задержки ответов
+    по методам (по ним решается, когда отправлять дубль)
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        scheduler: FairScheduler,
+        events: GenerationEvents,
+        phase_seconds: Histogram,
+    ):
+        self.config = config
+        self.scheduler = scheduler
+        self.events = events
+        self.phase_seconds = phase_seconds
+        self.breaker = CircuitBreaker(
+            config.breaker.window,
+            config.breaker.min_calls,
+            config.breaker.failure_ratio,
+            config.breaker.open_time,
+        )
+        self.latency = LatencyTracker()
+
+    async def attempt(
+        self,
+        api: NNApi,
+        gen_id: int,
+        stream: bool,
+        key_timeout: float,
+        busy_keys: set[int],
+    ):
+        """
+        Одна попытка запроса к нейросети на ключе, которого нет в busy_keys,
+        с дедлайном метода. Таймаут считается ошибкой ключа (как 504):
+        зависший ключ уходит на паузу
+        """
+        timeout = self.config.nn.timeout(api.gen_method)
+        async with self.config.key_pool.lease_async(key_timeout, busy_keys) as lease:
+            logging.info("Got token[:10]: %s", lease.token[:10])
+            busy_keys.add(lease.index)
+            time_start = time.monotonic()
+            try:
+                if stream:
+
+                    async def read_stream():
+                        async for delta in api.stream_request(lease.token):
+                            self.events.publish(gen_id, "delta", {"text_data": delta})
+
+                    await asyncio.wait_for(read_stream(), timeout)
+                else:
+                    await asyncio.wait_for(api.send_request(lease.token), timeout)
+            except asyncio.TimeoutError as exc:
+                lease.failed(504)
+                self.breaker.record(False)
+                raise NNException(
+                    f"Model request timed out after {timeout} s", 504
+                ) from exc
+            except NNException as exc:
+                lease.failed(exc.status_code)
+                if is_provider_failure(exc):
+                    self.breaker.record(False)
+                raise
+            finally:
+                busy_keys.discard(lease.index)
+                self.phase_seconds.observe(
+                    time.monotonic() - time_start,
+                    gen_method=api.gen_method.value,
+                    phase="send_request",
+                )
+            self.breaker.record(True)
+            if not stream:
+                self.latency.add(api.gen_method, time.monotonic() - time_start)
+
+    def hedge_delay(self, api: NNApi) -> float:
+        """
+        Через сколько секунд отправлять дубль запроса (None - без дубля)
+        """
+        if not self.config.nn.hedge:
+            return None
+        return self.latency.quantile(
+            api.gen_method,
+            self.config.nn.hedge_quantile,
+            self.config.nn.hedge_min_samples,
+        )
+
+    async def hedged(self, api: NNApi, gen_id: int, user_id: int):
+        """
+        Запрос к нейросети с дублем: если первая попытка идет дольше
+        обычного для метода, такая же уходит на другой свободный ключ,
+        и побеждает первый ответ. Дубль занимает свое место в очереди
+        генераций юзера user_id; нет сразу свободного места или ключа -
+        дубля нет
+        """
+        busy_keys = set()
+        first = asyncio.create_task(
+            self.attempt(
+                api, gen_id, False, self.config.keys.acquire_timeout, busy_keys
+            )
+        )
+
+        async def hedge():
+            async with self.scheduler.turn(user_id, api.estimated_cost(), 0):
+                await self.attempt(api, gen_id, False, 0.0, busy_keys)
+
+        hedge_delay = self.hedge_delay(api)
+        pending = {first}
+        try:
+            if hedge_delay is not None:
+                done, _ = await asyncio.wait(pending, timeout=hedge_delay)
+                if not done and self.breaker.state == CLOSED:
+                    logging.info("Hedging gen_id=%s after %.2f s", gen_id, hedge_delay)
+                    pending.add(asyncio.create_task(hedge()))
+
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        return
+                    # Дублю не хватило места или ключа - ждем первую попытку
+                    if task is first or not isinstance(
+                        task.exception(), (KeyPoolException, SchedulerException)
+                    ):
+                        error = error or task.exception()
+            if error is None:
+                error = NNException(
+                    "Model request timed out after "
+                    f"{self.config.nn.timeout(api.gen_method)} s",
+                    504,
+                )
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def request(
+        self,
+        api: NNApi,
+        gen_id: int,
+        stream: bool = False,
+        user_id: int = 0,
+        reserved: bool = False,
+    ):
+        """
+        Запрос к нейросети с повторами после ошибок провайдера. Каждая
+        попытка держит место в очереди только на время запроса: пауза
+        перед повтором его не занимает. reserved - место в очереди занято
+        при приеме запроса. Когда предохранитель разомкнут, сразу
+        завершается ошибкой. Стрим повторяется, только если подписчики
+        еще не получили ни куска
+        """
+        max_attempts = self.config.nn.max_attempts
+        try:
+            for attempt in range(max_attempts):
+                if not self.breaker.allow():
+                    raise NNException("Model provider is unavailable (circuit is open)")
+                queued_at = time.perf_counter()
+                turn = self.scheduler.turn(
+                    user_id,
+                    api.estimated_cost(),
+                    self.config.scheduler.timeout,
+                    reserved,
+                )
+                # Резерв переходит в место в очереди при входе в turn
+                reserved = False
+                try:
+                    async with turn:
+                        self.phase_seconds.observe(
+                            time.perf_counter() - queued_at,
+                            gen_method=api.gen_method.value,
+                            phase="queue",
+                        )
+                        if stream:
+                            await self.attempt(
+                                api,
+                                gen_id,
+                                True,
+                                self.config.keys.acquire_timeout,
+                                set(),
+                            )
+                        else:
+                            await self.hedged(api, gen_id, user_id)
+                    return
+                except NNException as exc:
+                    if (
+                        not is_provider_failure(exc)
+                        or attempt + 1 >= max_attempts
+                        or (stream and api.get_result())
+                    ):
+                        raise
+                    delay = retry_delay(
+                        attempt,
+                        self.config.nn.retry_base_delay,
+                        self.config.nn.retry_max_delay,
+                    )
+                    logging.info("Retrying gen_id=%s in %.2f s: %s", gen_id, delay, exc)
+                    await asyncio.sleep(delay)
+        finally:
+            if reserved:
+                self.scheduler.release(user_id)
+
+    async def generate(
+        self,
+        api: NNApi,
+        gen_id: int,
+        stream: bool = False,
+        user_id: int = 0,
+        reserved: bool = False,
+    ) -> str:
+        """
+        Текст генерации по готовому запросу: запрос к нейросети (request)
+        и постобработка ответа
+        """
+        if stream and api.gen_method == "append_text":
+            # Итоговый текст начинается с заданного,
+            # поэтому и поток начинаем с него
+            self.events.publish(gen_id, "delta", {"text_data": f"{api.hint} "})
+        await self.request(api, gen_id, stream, user_id, reserved)
+
+        result = prepare_string(api.get_result())
+        if api.gen_method == "append_text":
+            result = result.replace(api.hint, "")
+            result = prepare_string(f"{api.hint} {result}")
+        return result
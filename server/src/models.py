@@ -22,6 +22,18 @@ class GenerationMethod(str, Enum):
     FIX_GRAMMAR = "fix_grammar"
 
 
+class PostAction(str, Enum):
+    """
+    Модель, содержащая действия с готовым постом
+    """
+
+    LIKE = "like"
+    DISLIKE = "dislike"
+    HIDE = "hide"
+    RECOVER = "recover"
+    PUBLISH = "publish"
+
+
 class GenerateQueryModel(BaseModel):
     """
     Модель для запроса генерации. Берет на вход данные для
@@ -49,6 +61,31 @@ class GenerateQueryModel(BaseModel):
     group_id: int
 
 
+class GenerateBatchQueryModel(BaseModel):
+    """
+    Модель для пакетного запроса генерации: несколько вариантов за один вызов
+
+    items - list[GenerateQueryModel], запросы генерации, каждый как
+    в /api/v1/generation/generate
+    """
+
+    items: list[GenerateQueryModel]
+
+
+class PostsActionQueryModel(BaseModel):
+    """
+    Модель для действия сразу с несколькими постами из истории
+
+    action - PostAction, действие. Доступные значения: "like", "dislike",
+    "hide", "recover", "publish"
+
+    post_ids - list[int], айди генераций, полученные из generate
+    """
+
+    action: PostAction
+    post_ids: list[int]
+
+
 class SendFeedbackResult(BaseModel):
     """
     Модель, описывающая результат операции. Содержит код
@@ -72,6 +109,43 @@ class SendFeedbackResult(BaseModel):
     message: str
 
 
+class PostsActionCount(BaseModel):
+    """
+    Модель с числом постов, к которым применилось действие
+
+    count - int, сколько постов изменено. Чужие и несуществующие
+    посты не учитываются
+    """
+
+    count: int
+
+
+class PostsActionResult(BaseModel):
+    """
+    Модель с результатом действия над несколькими постами
+
+
+    status - int, статус операции:
+    * 0 - OK
+    * 1 - VK API Auth error
+    * 2 - NN API error
+    * 3 - request error
+    * 4 - unknown error
+    * 5 - not implemented
+    * 6 - db error
+    * 7 - rate limit exceeded
+
+    message - str, текстовое описание статуса. Тут хранится текст исключения,
+    если оно произошло
+
+    data - PostsActionCount, count, число измененных постов
+    """
+
+    status: int
+    message: str
+    data: PostsActionCount
+
+
 class GenerateResultID(BaseModel):
     """
     Модель с результатами генерации. Возвращает статус операции и
@@ -83,6 +157,29 @@ class GenerateResultID(BaseModel):
     text_id: int
 
 
+class GenerateResultBatchID(BaseModel):
+    """
+    Модель с айди результатов пакетной генерации
+
+    text_ids - list[int], айди текстов в том же порядке, что и запросы.
+    -1 - запрос не принят
+    """
+
+    text_ids: list[int]
+
+
+class GenerateResultBatchStatus(BaseModel):
+    """
+    Модель со статусами пакетной генерации
+
+    text_statuses - list[int], статусы генераций в том же порядке, что и
+    переданные айди. 0 - не готово, 1 - готово, 2 - ошибка,
+    -1 - пост не найден или не принадлежит пользователю
+    """
+
+    text_statuses: list[int]
+
+
 class GenerateResultStatus(BaseModel):
     """
     Модель с результатами генерации. Возвращает статус операции и
@@ -133,6 +230,60 @@ class GenerateID(BaseModel):
     data: GenerateResultID
 
 
+class GenerateBatchID(BaseModel):
+    """
+    Модель с результатами пакетной генерации. Возвращает статус операции и
+    айди всех результатов сразу
+
+
+    status - int, статус операции:
+    * 0 - OK
+    * 1 - VK API Auth error
+    * 2 - NN API error
+    * 3 - request error
+    * 4 - unknown error
+    * 5 - not implemented
+    * 6 - db error
+    * 7 - rate limit exceeded
+
+    message - str, текстовое описание статуса. Тут хранится текст исключения,
+    если оно произошло
+
+    data - GenerateResultBatchID, text_ids, айди текстов, по которым
+    можно потом получить результаты
+    """
+
+    status: int
+    message: str
+    data: GenerateResultBatchID
+
+
+class GenerateBatchStatus(BaseModel):
+    """
+    Модель со статусами всех генераций пакета
+
+
+    status - int, статус операции:
+    * 0 - OK
+    * 1 - VK API Auth error
+    * 2 - NN API error
+    * 3 - request error
+    * 4 - unknown error
+    * 5 - not implemented
+    * 6 - db error
+    * 7 - rate limit exceeded
+
+    message - str, текстовое описание статуса. Тут хранится текст исключения,
+    если оно произошло
+
+    data - GenerateResultBatchStatus, text_statuses, статусы генераций
+    """
+
+    status: int
+    message: str
+    data: GenerateResultBatchStatus
+
+
 class GenerateStatus(BaseModel):
     """
     Модель с результатами генерации. Возвращает статус операции и текст с
@@ -252,13 +403,17 @@ class UserResults(BaseModel):
 
     data - GenerateResultInfo, список результатов генерации юзера
 
-    count - int, длина массива data
+    count - int, сколько всего таких постов у юзера (без учета пагинации)
+
+    next_cursor - int, значение cursor для следующей страницы,
+    -1 - страниц больше нет
     """
 
     status: int
     message: str
     data: list[GenerateResultInfo]
     count: int
+    next_cursor: int = -1
 
 
 class UploadFileResult(BaseModel):
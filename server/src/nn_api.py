@@ -2,25 +2,51 @@
 Модуль с реализацией общения с апи нейросетей
 """
 
+import math
+
 import openai
 
-MAX_WORDS_LEN = 3000
+from models import GenerationMethod
+from templates import Template
+from tokens import TokenCounter
+
+MODEL_CONTEXT_TOKENS = 4096
+# Служебные токены chat-формата на два сообщения и начало ответа
+MESSAGE_OVERHEAD_TOKENS = 11
 MIN_WORDS_LEN = 5
 SYSTEM_PROMPT = "Тебя зовут Strawberry, ты помогаешь писать посты в сообщества социальных сетей. Ты должен отвечать только текстом одного поста для публикации"
 NO_SOURCE_TEXTS_REPLACEMENT = (
     "Старых постов в сообществе нет, так что придумай что-то креативное"
 )
-OLD_TEXTS_PLACEHOLDER = "[OLD_TEXTS]"
-HINT_PLACEHOLDER = "[HINT]"
+
+# Сколько токенов оставить под ответ: (минимум, во сколько раз
+# ответ может быть длиннее затравки)
+REPLY_BUDGETS = {
+    GenerationMethod.GENERATE: (1024, 0.0),
+    GenerationMethod.GENERATE_FROM_SCRATCH: (1024, 0.0),
+    GenerationMethod.APPEND: (768, 0.0),
+    GenerationMethod.EXTEND: (512, 2.0),
+    GenerationMethod.REPHRASE: (128, 1.5),
+    GenerationMethod.SUMMARIZE: (128, 1.0),
+    GenerationMethod.UNMASK: (128, 1.2),
+    GenerationMethod.FIX_GRAMMAR: (128, 1.2),
+}
+# Во сколько раз токен ответа дороже токена запроса по времени:
+# запрос читается целиком, а ответ генерируется по токену
+REPLY_TOKEN_WEIGHT = 8
 
 
 class NNException(Exception):
     """
     Класс исключения, связанного с подготовкой данных и
     отправкой запроса на апи нейросетей
+
+    status_code - HTTP код ответа провайдера, если он известен
     """
 
-    pass
+    def __init__(self, message: str, status_code: int = None):
+        super().__init__(message)
+        self.status_code = status_code
 
 
 class NNApi:
@@ -28,70 +54,107 @@ class NNApi:
     Класс для подготовки запросов и общения с API нейросети
     """
 
-    def __init__(self, token: str):
-        openai.api_key = token
-        self.context = ""
+    def __init__(
+        self,
+        template: Template,
+        gen_method: str,
+        token_counter: TokenCounter,
+        api_base: str = None,
+    ):
+        self.template = template
+        # Адрес API провайдера (None - адрес openai по умолчанию)
+        self.api_base = api_base
+        self.gen_method = GenerationMethod(gen_method)
+        self.token_counter = token_counter
+        self.prompt_tokens = 0
+        self.reply_tokens = 0
+        self.hint = ""
         self.query = ""
         self.result = ""
 
-    def load_context(self, path: str):
-        """
-        Загружает шаблон контекста из файлика
-        """
-        try:
-            with open(path, "r", encoding="UTF-8") as ctx_file:
-                self.context = ctx_file.read()
-        except Exception as exc:
-            raise NNException(f"Error in load_context: {exc}") from exc
-
     def prepare_query(self, context_data: list[str], hint: str):
         """
-        Расставляет данные по шаблону контекста
+        Расставляет данные по шаблону контекста. В шаблон со старыми
+        постами они добавляются, пока хватает бюджета токенов: окно модели
+        минус системный промпт, шаблон, затравка и место под ответ
+        для данного метода
         """
         try:
-            if len(hint) >= MAX_WORDS_LEN:
+            count = self.token_counter.count
+            hint_tokens = count(hint)
+            reply_min, reply_factor = REPLY_BUDGETS[self.gen_method]
+            system_tokens = MESSAGE_OVERHEAD_TOKENS + count(SYSTEM_PROMPT)
+            reply_tokens = max(reply_min, math.ceil(reply_factor * hint_tokens))
+            budget = (
+                MODEL_CONTEXT_TOKENS
+                - system_tokens
+                - count(self.template.static_text)
+                - hint_tokens
+                - reply_tokens
+            )
+            if budget < 0:
                 raise NNException(
                     "Error in prepare_query: the request is too long (hint alone is larger than allowed input in model)"
                 )
 
             source_texts_string = ""
-
-            for text in context_data:
-                # Собираем строку с постами чтобы она была не длиннее, чем нужно.
-                # Считаю не количество слов, а количество букв потому что
-                # токенизатор не любит русский
-                if (
-                    len(source_texts_string) + len(text) + len(hint) + len(self.context)
-                ) >= MAX_WORDS_LEN:
-                    continue
-                source_texts_string += f"{text}\n\n"
-
-            if (
-                len(source_texts_string) > MIN_WORDS_LEN
-            ):  # Минимальная проверка на валидность контекста
-                self.query = self.context.replace(
-                    OLD_TEXTS_PLACEHOLDER,
-                    source_texts_string,
-                )
-            else:
-                # Если контекст слишком маленький,
-                # то надо просто сказать нейросети быть креативной
-                self.query = self.context.replace(
-                    OLD_TEXTS_PLACEHOLDER,
-                    NO_SOURCE_TEXTS_REPLACEMENT,
-                )
-
-            self.query = self.query.replace(HINT_PLACEHOLDER, hint)
-            self.query = self.query.strip()
+            if self.template.needs_old_texts:
+                source_texts_string = self.pack_texts(context_data, budget)
+
+            self.hint = hint
+            self.query = self.template.render(source_texts_string, hint).strip()
+            # Стоимость - по запросу, который действительно уйдет в модель
+            self.prompt_tokens = system_tokens + count(self.query)
+            self.reply_tokens = reply_tokens
+        except NNException:
+            raise
         except Exception as exc:
             raise NNException(f"Error in prepare_query: {exc}") from exc
 
-    def send_request(self):
+    def pack_texts(self, context_data: list[str], budget: int) -> str:
+        """
+        Старые посты через пустую строку, сколько влезает в budget токенов
+        """
+        count = self.token_counter.count
+        separator_tokens = count("\n\n")
+        source_texts = []
+        used = 0
+        for text in context_data:
+            # Пост, который не влезает, пропускаем, но пробуем следующие:
+            # более короткие могут заполнить остаток бюджета
+            text_tokens = count(text) + separator_tokens
+            if used + text_tokens > budget:
+                continue
+            source_texts.append(text)
+            used += text_tokens
+
+        source_texts_string = "\n\n".join(source_texts)
+
+        if (
+            len(source_texts_string) <= MIN_WORDS_LEN
+        ):  # Минимальная проверка на валидность контекста
+            # Если контекст слишком маленький,
+            # то надо просто сказать нейросети быть креативной
+            return NO_SOURCE_TEXTS_REPLACEMENT
+        return source_texts_string
+
+    def estimated_cost(self) -> int:
         """
-        Отправляет запрос к API нейросети
+        Оценка стоимости запроса для очереди генераций: токены
+        упакованного запроса плюс взвешенный бюджет ответа метода
+        """
+        return self.prompt_tokens + REPLY_TOKEN_WEIGHT * self.reply_tokens
+
+    async def send_request(self, token: str):
+        """
+        Отправляет запрос к API нейросети, не блокируя event loop.
+        Ключ передается в запрос, а не в openai.api_key: запросы идут
+        конкурентно и глобальный ключ бы перетирался
         """
         try:
-            completion = openai.ChatCompletion.create(
+            completion = await openai.ChatCompletion.acreate(
+                api_key=token,
+                api_base=self.api_base,
                 model="gpt-3.5-turbo",
                 messages=[
                     {"role": "system", "content": SYSTEM_PROMPT},
@@ -100,7 +163,38 @@ class NNApi:
             )
             self.result = completion.choices[0].message.content
         except Exception as exc:
-            raise NNException(f"Error in send_request: {exc}") from exc
+            raise NNException(
+                f"Error in send_request: {exc}",
+                getattr(exc, "http_status", None),
+            ) from exc
+
+    async def stream_request(self, token: str):
+        """
+        Отправляет запрос к API нейросети в режиме стриминга и отдает
+        куски ответа по мере их прихода. Полный ответ копится в self.result
+        """
+        self.result = ""
+        try:
+            chunks = await openai.ChatCompletion.acreate(
+                api_key=token,
+                api_base=self.api_base,
+                model="gpt-3.5-turbo",
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": self.query},
+                ],
+                stream=True,
+            )
+            async for chunk in chunks:
+                delta = chunk["choices"][0]["delta"].get("content")
+                if delta:
+                    self.result += delta
+                    yield delta
+        except Exception as exc:
+            raise NNException(
+                f"Error in stream_request: {exc}",
+                getattr(exc, "http_status", None),
+            ) from exc
 
     def get_result(self) -> str:
         """
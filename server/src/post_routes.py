@@ -0,0 +1,399 @@
+"""
+Модуль с эндпоинтами действий с готовыми постами и истории генераций
+"""
+
+import logging
+
+from fastapi import APIRouter, Depends
+
+from models import (
+    SendFeedbackResult,
+    PostsActionQueryModel,
+    PostsActionCount,
+    PostsActionResult,
+    PostAction,
+    UserResults,
+)
+from database import DBException, POST_ACTION_VALUES
+from write_behind import WriteBehindException
+from auth import AuthResult
+from service_metrics import MetricsRoute
+from components import config, db, post_writes, get_auth, get_post_auth
+
+router = APIRouter(route_class=MetricsRoute)
+
+
+def apply_post_action(user_id: int, text_id: int, action: PostAction) -> bool:
+    """
+    Применяет действие к посту юзера: сразу или через буфер отложенной
+    записи. False - пост не принадлежит юзеру (без буфера)
+    """
+    if post_writes is None:
+        return db.apply_post_action(user_id, [text_id], action) > 0
+    try:
+        post_writes.put(user_id, text_id, POST_ACTION_VALUES[action])
+    except WriteBehindException as exc:
+        raise DBException(f"Error in write-behind: {exc}") from exc
+    return True
+
+
+@router.post(
+    "/api/v1/post/{post_id}/like",
+    response_model=SendFeedbackResult,
+    tags=["Действия с готовым постом"],
+)
+def send_like(post_id: int, auth: AuthResult = Depends(get_post_auth)):
+    """
+    Метод для отправки лайка на пост
+
+    post_id - айди генерации, полученный из generate
+
+    """
+    if auth.status:
+        return SendFeedbackResult(status=auth.status, message=auth.message)
+
+    result_id = int(post_id)
+
+    if result_id <= 1:
+        return SendFeedbackResult(
+            status=3,
+            message="Incorrect post id",
+        )
+
+    logging.info("/like\tid=%s", result_id)
+
+    try:
+        if not apply_post_action(auth.user_id, result_id, PostAction.LIKE):
+            return SendFeedbackResult(status=1, message="Post is not yours")
+        logging.info("/like\tid=%s\tOK", result_id)
+        return SendFeedbackResult(status=0, message="Post is liked")
+    except DBException as exc:
+        logging.error("Error in database: %s", exc)
+        return SendFeedbackResult(status=6, message="Error in database")
+    except Exception as exc:
+        logging.error("Unknown error: %s", exc)
+        return SendFeedbackResult(status=4, message="Unknown error")
+
+
+@router.post(
+    "/api/v1/post/{post_id}/dislike",
+    response_model=SendFeedbackResult,
+    tags=["Действия с готовым постом"],
+)
+def send_dislike(post_id: int, auth: AuthResult = Depends(get_post_auth)):
+    """
+    Метод для отправки дизлайка на пост
+
+    post_id - айди генерации, полученный из generate
+
+    """
+    if auth.status:
+        return SendFeedbackResult(status=auth.status, message=auth.message)
+
+    result_id = int(post_id)
+
+    if result_id <= 1:
+        return SendFeedbackResult(
+            status=3,
+            message="Incorrect post id",
+        )
+
+    logging.info("/dislike\tid=%s", result_id)
+
+    try:
+        if not apply_post_action(
+            auth.user_id, result_id, PostAction.DISLIKE
+        ):
+            return SendFeedbackResult(status=1, message="Post is not yours")
+        logging.info("/dislike\tid=%s\tOK", result_id)
+        return SendFeedbackResult(status=0, message="Post is disliked")
+    except DBException as exc:
+        logging.error("Error in database: %s", exc)
+        return SendFeedbackResult(status=6, message="Error in database")
+    except Exception as exc:
+        logging.error("Unknown error: %s", exc)
+        return SendFeedbackResult(status=4, message="Unknown error")
+
+
+@router.delete(
+    "/api/v1/post/{post_id}",
+    response_model=SendFeedbackResult,
+    tags=["Действия с готовым постом"],
+)
+def send_hidden(post_id: int, auth: AuthResult = Depends(get_post_auth)):
+    """
+    Метод для скрытия поста
+
+    post_id - айди генерации, полученный из generate
+
+    """
+    if auth.status:
+        return SendFeedbackResult(status=auth.status, message=auth.message)
+
+    result_id = int(post_id)
+
+    if result_id <= 1:
+        return SendFeedbackResult(
+            status=3,
+            message="Incorrect post id",
+        )
+
+    logging.info("/delete\tid=%s", result_id)
+
+    try:
+        if not apply_post_action(auth.user_id, result_id, PostAction.HIDE):
+            return SendFeedbackResult(status=1, message="Post is not yours")
+        logging.info("/delete\tid=%s\tOK", result_id)
+        return SendFeedbackResult(status=0, message="Post is hidden")
+    except DBException as exc:
+        logging.error("Error in database: %s", exc)
+        return SendFeedbackResult(status=6, message="Error in database")
+    except Exception as exc:
+        logging.error("Unknown error: %s", exc)
+        return SendFeedbackResult(status=4, message="Unknown error")
+
+
+@router.post(
+    "/api/v1/post/{post_id}/recover",
+    response_model=SendFeedbackResult,
+    tags=["Действия с готовым постом"],
+)
+def send_recovered(post_id: int, auth: AuthResult = Depends(get_post_auth)):
+    """
+    Метод для восстановления поста
+
+    post_id - айди генерации, полученный из generate
+
+    """
+    if auth.status:
+        return SendFeedbackResult(status=auth.status, message=auth.message)
+
+    result_id = int(post_id)
+
+    if result_id <= 1:
+        return SendFeedbackResult(
+            status=3,
+            message="Incorrect post id",
+        )
+
+    logging.info("/recover\tid=%s", result_id)
+
+    try:
+        if not apply_post_action(
+            auth.user_id, result_id, PostAction.RECOVER
+        ):
+            return SendFeedbackResult(status=1, message="Post is not yours")
+        logging.info("/recover\tid=%s\tOK", result_id)
+        return SendFeedbackResult(status=0, message="Post is recovered")
+    except DBException as exc:
+        logging.error("Error in database: %s", exc)
+        return SendFeedbackResult(status=6, message="Error in database")
+    except Exception as exc:
+        logging.error("Unknown error: %s", exc)
+        return SendFeedbackResult(status=4, message="Unknown error")
+
+
+@router.post(
+    "/api/v1/post/{post_id}/publish",
+    response_model=SendFeedbackResult,
+    tags=["Действия с готовым постом"],
+)
+def send_published(post_id: int, auth: AuthResult = Depends(get_post_auth)):
+    """
+    Метод для отправки а=факта о публикации на пост
+
+    post_id - айди генерации, полученный из generate
+
+    """
+    if auth.status:
+        return SendFeedbackResult(status=auth.status, message=auth.message)
+
+    result_id = int(post_id)
+
+    if result_id <= 1:
+        return SendFeedbackResult(
+            status=3,
+            message="Incorrect post id",
+        )
+
+    logging.info("/publish\tid=%s", result_id)
+
+    try:
+        if not apply_post_action(
+            auth.user_id, result_id, PostAction.PUBLISH
+        ):
+            return SendFeedbackResult(status=1, message="Post is not yours")
+        logging.info("/publish\tid=%s\tOK", result_id)
+        return SendFeedbackResult(status=0, message="Post is marked as published")
+    except DBException as exc:
+        logging.error("Error in database: %s", exc)
+        return SendFeedbackResult(status=6, message="Error in database")
+    except Exception as exc:
+        logging.error("Unknown error: %s", exc)
+        return SendFeedbackResult(status=4, message="Unknown error")
+
+
+@router.post(
+    "/api/v1/posts/action",
+    response_model=PostsActionResult,
+    tags=["Действия с готовым постом"],
+)
+def send_posts_action(
+    data: PostsActionQueryModel,
+    auth: AuthResult = Depends(get_post_auth),
+):
+    """
+    Метод для действия сразу с несколькими постами (например, скрыть или
+    опубликовать выбранные в истории). Все посты меняются одним запросом
+    к базе, чужие и несуществующие посты пропускаются
+
+    action - действие: like, dislike, hide, recover, publish
+
+    post_ids - айди генераций, полученные из generate
+
+    """
+    if auth.status:
+        return PostsActionResult(
+            status=auth.status,
+            message=auth.message,
+            data=PostsActionCount(count=0),
+        )
+
+    post_ids = sorted(set(data.post_ids))
+
+    if (
+        not post_ids
+        or len(post_ids) > config.limits.posts_action_max_size
+        or post_ids[0] <= 1
+    ):
+        return PostsActionResult(
+            status=3,
+            message="Incorrect post ids",
+            data=PostsActionCount(count=0),
+        )
+
+    logging.info("/posts/action\taction=%s; ids=%s", data.action.value, post_ids)
+
+    try:
+        count = db.apply_post_action(auth.user_id, post_ids, data.action)
+        logging.info("/posts/action\taction=%s; count=%s\tOK", data.action.value, count)
+        return PostsActionResult(
+            status=0,
+            message="OK",
+            data=PostsActionCount(count=count),
+        )
+    except DBException as exc:
+        logging.error("Error in database: %s", exc)
+        return PostsActionResult(
+            status=6,
+            message="Error in database",
+            data=PostsActionCount(count=0),
+        )
+    except Exception as exc:
+        logging.error("Unknown error: %s", exc)
+        return PostsActionResult(
+            status=4,
+            message="Unknown error",
+            data=PostsActionCount(count=0),
+        )
+
+
+@router.get(
+    "/api/v1/posts",
+    response_model=UserResults,
+    tags=["Статистика"],
+)
+def get_history(
+    *,
+    group_id: int = None,
+    offset: int = None,
+    limit: int = None,
+    cursor: int = None,
+    summary: bool = False,
+    auth: AuthResult = Depends(get_auth),
+):
+    """
+    Метод для получения списка всех сгенерированных юзером текстов
+    (от новых к старым, постранично)
+
+    group_id - int, необязательное, если указать его, то вернет все
+    записи для данного сообщества от данного юзера. Если не указать,
+    то все записи от данного юзера
+
+    limit - int, необязательное, максимальное количество результатов
+    (не больше history_max_limit, по умолчанию столько и вернется)
+
+    cursor - int, необязательное, next_cursor из предыдущего ответа.
+    Вернет посты старше него. Быстрее, чем offset, на любой глубине
+
+    offest - int, необязательное, смещение (не используется вместе с cursor)
+
+    summary - bool, необязательное, если true, то hint и text обрезаются до
+    history_summary_len символов. Полный текст - через /api/v1/generation/result
+    """
+
+    if auth.status:
+        return UserResults(
+            status=auth.status,
+            message=auth.message,
+            data=[],
+            count=0,
+        )
+
+    user_id = auth.user_id
+
+    logging.info(
+        "/posts\tvk_user_id=%s; group_id=%s; offset=%s; limit=%s; cursor=%s",
+        user_id,
+        group_id,
+        offset,
+        limit,
+        cursor,
+    )
+
+    try:
+        max_limit = config.limits.history_max_limit
+        page_size = min(limit or max_limit, max_limit)
+        generated_results = db.get_users_texts(
+            group_id,
+            user_id,
+            page_size,
+            before_id=cursor,
+            offset=offset,
+            summary_len=config.limits.history_summary_len if summary else None,
+        )
+        total_len = db.count_users_texts(group_id, user_id)
+        next_cursor = -1
+        if len(generated_results) == page_size:
+            next_cursor = generated_results[-1].post_id
+        logging.info(
+            "/posts\tvk_user_id=%s; group_id=%s; offset=%s; limit=%s\tOK",
+            user_id,
+            group_id,
+            offset,
+            limit,
+        )
+        return UserResults(
+            status=0,
+            message="Results returned",
+            data=generated_results,
+            count=total_len,
+            next_cursor=next_cursor,
+        )
+
+    except DBException as exc:
+        logging.error("Error in database while fetching user results text: %s", exc)
+        return UserResults(
+            status=6,
+            message="Error in database while fetching user results text",
+            data=[],
+            count=0,
+        )
+    except Exception as exc:
+        logging.error("Unknown error: %s", exc)
+        return UserResults(
+            status=4,
+            message="Unknown error",
+            data=[],
+            count=0,
+        )
@@ -0,0 +1,92 @@
+"""
+Модуль с ранжированием старых постов по близости к затравке (BM25)
+"""
+
+import logging
+import re
+import time
+
+import numpy as np
+
+# Грубый стемминг для русского: сравниваем слова по первым буквам,
+# чтобы "клубника", "клубнику" и "клубникой" считались одним термином
+STEM_LEN = 6
+# Слово целиком, в группе - его первые STEM_LEN букв
+STEM_RE = re.compile(rf"(\w{{1,{STEM_LEN}}})\w*")
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Разбивает текст на термины для BM25
+    """
+    return STEM_RE.findall(text.lower())
+
+
+def term_frequencies(
+    texts: list[str], query_terms: list[str], deadline: float
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Матрица частот (пост x термин затравки) и длины постов. Только
+    по терминам затравки: остальные слова на скоринг не влияют.
+    Разбиение на слова идет, пока не прошел deadline, а подсчет -
+    одним проходом numpy по номерам терминов всех разобранных постов
+    """
+    docs = []
+    for doc, text in enumerate(texts):
+        if time.perf_counter() > deadline:
+            logging.info("rank_texts: time budget exceeded after %s texts", doc)
+            break
+        docs.append(tokenize(text))
+
+    # Слова не из затравки попадают в лишний последний столбец
+    other = len(query_terms)
+    term_index = {term: i for i, term in enumerate(query_terms)}
+    lengths = np.fromiter((len(terms) for terms in docs), np.int64, len(docs))
+    columns = np.fromiter(
+        (term_index.get(term, other) for terms in docs for term in terms),
+        np.int64,
+        int(lengths.sum()),
+    )
+    cells = np.repeat(np.arange(len(docs)) * (other + 1), lengths) + columns
+    tf = np.bincount(cells, minlength=len(docs) * (other + 1))
+    tf = tf.reshape(len(docs), other + 1)[:, :other]
+    return tf.astype(np.float32), lengths
+
+
+def bm25_scores(tf: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+    BM25 каждого поста по матрице частот терминов затравки
+    """
+    docs = len(lengths)
+    doc_freq = np.count_nonzero(tf, axis=0)
+    idf = np.log1p((docs - doc_freq + 0.5) / (doc_freq + 0.5))
+    avg_len = max(float(lengths.mean()), 1.0)
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / avg_len)
+    return (tf * (BM25_K1 + 1) / (tf + norm[:, None])) @ idf
+
+
+def rank_texts(texts: list[str], hint: str, time_budget: float = 0.05) -> list[str]:
+    """
+    Сортирует посты по убыванию BM25 относительно затравки, чтобы при
+    упаковке в контекст первыми попадали самые близкие к теме. Посты,
+    до которых не дошли за time_budget секунд (по настенным часам),
+    и посты без совпадений остаются в исходном порядке после остальных
+    """
+    if len(texts) < 2:
+        return texts
+
+    query_terms = list(dict.fromkeys(tokenize(hint)))
+    if not query_terms:
+        return texts
+
+    tf, lengths = term_frequencies(
+        texts, query_terms, time.perf_counter() + time_budget
+    )
+    scored = len(lengths)
+    if scored < 2:
+        return texts
+
+    order = np.argsort(-bm25_scores(tf, lengths), kind="stable")
+    return [texts[i] for i in order] + texts[scored:]
@@ -0,0 +1,146 @@
+"""
+Модуль с защитой запросов к нейросети: предохранитель (circuit breaker),
+учет задержек для дублирующих запросов и задержки между повторами
+"""
+
+import random
+import time
+
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Предохранитель провайдера. Пока доля ошибок среди последних window
+    запросов (не меньше min_calls) ниже failure_ratio, он замкнут.
+    Иначе размыкается на open_time секунд, и запросы сразу завершаются
+    ошибкой, а не висят до таймаута. Потом пропускает один пробный
+    запрос: успех замыкает его, ошибка снова размыкает.
+    Все методы вызываются из event loop, блокировки не нужны
+    """
+
+    def __init__(
+        self,
+        window: int = 20,
+        min_calls: int = 10,
+        failure_ratio: float = 0.5,
+        open_time: float = 30.0,
+    ):
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.open_time = open_time
+        self.outcomes: deque[bool] = deque(maxlen=window)
+        self.state = CLOSED
+        self.opened_at = 0.0
+        # Когда пропущен пробный запрос (0 - не пропущен)
+        self.probe_at = 0.0
+        self.opened = 0
+
+    def _refresh(self, now: float):
+        if self.state == OPEN and now - self.opened_at >= self.open_time:
+            self.state = HALF_OPEN
+            self.probe_at = 0.0
+
+    def is_open(self) -> bool:
+        """
+        Разомкнут ли предохранитель (не меняет его состояние)
+        """
+        self._refresh(time.monotonic())
+        return self.state == OPEN
+
+    def allow(self) -> bool:
+        """
+        Можно ли отправить запрос. В полуразомкнутом состоянии пропускает
+        один пробный запрос; если его результат так и не пришел (запрос
+        отменили), через open_time пропускает следующий
+        """
+        now = time.monotonic()
+        self._refresh(now)
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and now - self.probe_at >= self.open_time:
+            self.probe_at = now
+            return True
+        return False
+
+    def _open(self, now: float):
+        self.state = OPEN
+        self.opened_at = now
+        self.opened += 1
+        self.outcomes.clear()
+
+    def record(self, ok: bool):
+        """
+        Учитывает результат запроса
+        """
+        now = time.monotonic()
+        self._refresh(now)
+        if self.state == HALF_OPEN:
+            if ok:
+                self.state = CLOSED
+                self.outcomes.clear()
+            else:
+                self._open(now)
+            return
+        if self.state == OPEN:
+            return
+        self.outcomes.append(ok)
+        failures = self.outcomes.count(False)
+        if (
+            len(self.outcomes) >= self.min_calls
+            and failures >= self.failure_ratio * len(self.outcomes)
+        ):
+            self._open(now)
+
+    def stats(self) -> dict:
+        """
+        Состояние предохранителя (для логов и метрик)
+        """
+        self._refresh(time.monotonic())
+        return {
+            "state": self.state,
+            "failures": self.outcomes.count(False),
+            "calls": len(self.outcomes),
+            "opened": self.opened,
+        }
+
+
+class LatencyTracker:
+    """
+    Задержки последних window успешных запросов по методам генерации
+    """
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self.latencies: dict[str, deque[float]] = {}
+
+    def add(self, method: str, latency: float):
+        """
+        Запоминает задержку успешного запроса
+        """
+        if method not in self.latencies:
+            self.latencies[method] = deque(maxlen=self.window)
+        self.latencies[method].append(latency)
+
+    def quantile(self, method: str, q: float, min_samples: int = 20) -> float:
+        """
+        Квантиль задержки метода или None, если запросов пока мало
+        """
+        latencies = self.latencies.get(method)
+        if latencies is None or len(latencies) < min_samples:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def retry_delay(attempt: int, base: float, maximum: float) -> float:
+    """
+    Задержка перед повтором номер attempt (с нуля): экспоненциальная,
+    со случайным разбросом от нуля (full jitter), чтобы повторы разных
+    запросов не приходили к провайдеру одновременно
+    """
+    return random.uniform(0, min(maximum, base * 2**attempt))
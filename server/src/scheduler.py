@@ -0,0 +1,405 @@
+"""
+Модуль с ограничением частоты запросов (token bucket по юзерам и группам)
+и честной очередью генераций между юзерами (deficit round robin
+с учетом стоимости генераций)
+"""
+
+import asyncio
+import dataclasses
+import math
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+
+class SchedulerException(Exception):
+    """
+    Класс исключения, связанного с очередью генераций
+    """
+
+    pass
+
+
+class TokenBucket:
+    """
+    Ведро токенов: burst запросов сразу, дальше rate запросов в секунду
+    """
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now: float):
+        """
+        Доливает токены за прошедшее время
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost: float) -> float:
+        """
+        Через сколько секунд в ведре наберется cost токенов
+        """
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def reset_time(self) -> float:
+        """
+        Через сколько секунд ведро снова будет полным
+        """
+        return (self.burst - self.tokens) / self.rate
+
+
+@dataclasses.dataclass
+class RateLimit:
+    """
+    Результат проверки лимита: для ответа и заголовков X-RateLimit-*.
+    Числа - по самому строгому из ведер (юзера или группы)
+    """
+
+    allowed: bool
+    limit: int = 0
+    remaining: int = 0
+    reset: int = 0
+    retry_after: int = 0
+
+    def headers(self) -> dict:
+        """
+        Заголовки ответа
+        """
+        if not self.limit:
+            return {}
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(self.remaining),
+            "X-RateLimit-Reset": str(self.reset),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(self.retry_after)
+        return headers
+
+
+class RateLimiter:
+    """
+    Лимиты частоты генераций на юзера и на группу. Запрос проходит, только
+    если токенов хватает в обоих ведрах, и тогда списывается из обоих.
+    rate <= 0 - лимита нет. Хранится не больше max_buckets ведер (LRU):
+    вытесненное ведро было бы полным через burst / rate секунд
+    """
+
+    def __init__(
+        self,
+        user_rate: float,
+        user_burst: float,
+        group_rate: float,
+        group_burst: float,
+        max_buckets: int = 100000,
+    ):
+        self.limits = {
+            "user": (user_rate, user_burst),
+            "group": (group_rate, group_burst),
+        }
+        self.max_buckets = max_buckets
+        self.buckets: OrderedDict[tuple[str, int], TokenBucket] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _bucket(self, kind: str, key: int, now: float) -> TokenBucket:
+        rate, burst = self.limits[kind]
+        if rate <= 0 or key is None or key <= 0:
+            return None
+        bucket = self.buckets.get((kind, key))
+        if bucket is None:
+            bucket = TokenBucket(rate, burst, now)
+            self.buckets[(kind, key)] = bucket
+            while len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end((kind, key))
+            bucket.refill(now)
+        return bucket
+
+    def check(self, user_id: int, group_id: int = None, cost: float = 1) -> RateLimit:
+        """
+        Списывает cost запросов с лимитов юзера и группы, если их хватает
+        """
+        return self.check_groups(user_id, {group_id: cost})
+
+    def check_groups(self, user_id: int, group_costs: dict[int, float]) -> RateLimit:
+        """
+        Списывает запросы пакета: с юзера - сумму, с каждой группы - ее
+        часть group_costs. Все или ничего: если хоть одному ведру не
+        хватает токенов, не списывается ни с одного
+        """
+        now = time.monotonic()
+        with self.lock:
+            charges = [
+                (self._bucket("user", user_id, now), sum(group_costs.values()))
+            ] + [
+                (self._bucket("group", group_id, now), cost)
+                for group_id, cost in group_costs.items()
+            ]
+            charges = [(bucket, cost) for bucket, cost in charges if bucket is not None]
+            if not charges:
+                return RateLimit(True)
+
+            allowed = all(bucket.tokens >= cost for bucket, cost in charges)
+            if allowed:
+                for bucket, cost in charges:
+                    bucket.tokens -= cost
+            strictest = min(
+                (bucket for bucket, _ in charges),
+                key=lambda bucket: bucket.tokens / bucket.burst,
+            )
+            return RateLimit(
+                allowed,
+                limit=int(strictest.burst),
+                remaining=max(int(strictest.tokens), 0),
+                reset=math.ceil(strictest.reset_time()),
+                retry_after=math.ceil(
+                    max(bucket.wait_time(cost) for bucket, cost in charges)
+                ),
+            )
+
+
+class TenantMetrics:
+    """
+    Счетчики по юзерам: сколько генераций принято, отклонено лимитом,
+    выполнено и сколько они ждали в очереди. Хранится не больше
+    max_tenants юзеров (LRU), чтобы память не росла
+    """
+
+    FIELDS = ("admitted", "limited", "served", "wait_seconds")
+
+    def __init__(self, max_tenants: int = 10000):
+        self.max_tenants = max_tenants
+        self.tenants: OrderedDict[int, dict] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, tenant: int, field: str, value: float = 1):
+        """
+        Увеличивает счетчик юзера
+        """
+        with self.lock:
+            counters = self.tenants.get(tenant)
+            if counters is None:
+                counters = dict.fromkeys(self.FIELDS, 0)
+                self.tenants[tenant] = counters
+                while len(self.tenants) > self.max_tenants:
+                    self.tenants.popitem(last=False)
+            else:
+                self.tenants.move_to_end(tenant)
+            counters[field] += value
+
+    def top(self, count: int = 20) -> dict[int, dict]:
+        """
+        Самые активные юзеры (для логов и метрик)
+        """
+        with self.lock:
+            tenants = sorted(
+                self.tenants.items(),
+                key=lambda item: item[1]["admitted"] + item[1]["limited"],
+                reverse=True,
+            )
+            return {tenant: dict(counters) for tenant, counters in tenants[:count]}
+
+
+@dataclasses.dataclass(eq=False)
+class QueueEntry:
+    """
+    Ожидающая генерация: стоимость, время постановки в очередь
+    и future, которое выполнится, когда подойдет ее очередь
+    """
+
+    cost: float
+    future: asyncio.Future
+    enqueued: float = dataclasses.field(default_factory=time.monotonic)
+
+
+class FairScheduler:
+    """
+    Честная очередь генераций между юзерами (deficit round robin).
+    Одновременно выполняется не больше concurrency генераций; когда место
+    освобождается, его получает следующий по кругу юзер с запросами,
+    поэтому юзер с сотней запросов не задерживает тех, у кого один.
+
+    cost - оценка стоимости генерации (NNApi.estimated_cost), она
+    списывается с дефицита юзера, за круг юзер получает quantum. Дорогой
+    генерации приходится ждать несколько кругов, и дешевые правки других
+    юзеров проходят раньше. Из своих запросов юзер получает самый дешевый,
+    но ожидание уменьшает стоимость на aging в секунду, так что длинные
+    генерации не ждут бесконечно.
+
+    Место в очереди занимается при приеме запроса (try_reserve, из потоков
+    пула эндпоинтов), а сам запрос встает в очередь позже, в turn (в event
+    loop). Проверка места и резерв атомарны, поэтому одновременные запросы
+    не переполнят очередь. Состояние очереди - под lock
+    """
+
+    def __init__(
+        self,
+        concurrency: int,
+        *,
+        quantum: float = 4000.0,
+        max_queue: int = 1000,
+        max_tenant_queue: int = 20,
+        metrics: TenantMetrics = None,
+        aging: float = 1000.0,
+    ):
+        self.concurrency = concurrency
+        self.quantum = quantum
+        self.max_queue = max_queue
+        self.max_tenant_queue = max_tenant_queue
+        self.metrics = metrics
+        self.aging = aging
+        # Юзеры с ожидающими запросами в порядке обхода
+        self.queues: OrderedDict[int, list[QueueEntry]] = OrderedDict()
+        self.deficit: dict[int, float] = {}
+        self.queued = 0
+        self.running = 0
+        # Места, занятые принятыми запросами, которые еще не встали в очередь
+        self.reserved: dict[int, int] = {}
+        self.reserved_total = 0
+        self.lock = threading.Lock()
+
+    def try_reserve(self, tenant: int, count: int = 1) -> bool:
+        """
+        Занимает места в очереди для count запросов юзера, если они есть.
+        Место освобождается в turn(reserved=True) или release
+        """
+        with self.lock:
+            tenant_queued = len(self.queues.get(tenant, ())) + self.reserved.get(
+                tenant, 0
+            )
+            if (
+                self.queued + self.reserved_total + count > self.max_queue
+                or tenant_queued + count > self.max_tenant_queue
+            ):
+                return False
+            self.reserved[tenant] = self.reserved.get(tenant, 0) + count
+            self.reserved_total += count
+            return True
+
+    def release(self, tenant: int, count: int = 1):
+        """
+        Освобождает места запросов, которые так и не встали в очередь
+        """
+        with self.lock:
+            self._unreserve(tenant, count)
+
+    def _unreserve(self, tenant: int, count: int):
+        count = min(count, self.reserved.get(tenant, 0))
+        self.reserved_total -= count
+        self.reserved[tenant] = self.reserved.get(tenant, 0) - count
+        if not self.reserved[tenant]:
+            del self.reserved[tenant]
+
+    def _pick(self, queue: list[QueueEntry], now: float) -> QueueEntry:
+        """
+        Самый дешевый запрос юзера с учетом времени ожидания
+        """
+        return min(
+            queue, key=lambda entry: entry.cost - self.aging * (now - entry.enqueued)
+        )
+
+    def _dispatch(self):
+        # Вызывается под lock
+        now = time.monotonic()
+        while self.running < self.concurrency and self.queues:
+            tenant, queue = next(iter(self.queues.items()))
+            entry = self._pick(queue, now)
+            if entry.future.done():
+                # Ожидание отменено вместе с future, место ему не нужно
+                self._remove(tenant, entry)
+                continue
+            if self.deficit[tenant] < entry.cost:
+                # Ход юзера закончился: в конец круга, с квантом на следующий
+                self.queues.move_to_end(tenant)
+                self.deficit[tenant] += self.quantum
+                continue
+            self.deficit[tenant] -= entry.cost
+            self._remove(tenant, entry)
+            self.running += 1
+            entry.future.set_result(None)
+
+    def _remove(self, tenant: int, entry: QueueEntry):
+        # Вызывается под lock
+        queue = self.queues[tenant]
+        queue.remove(entry)
+        self.queued -= 1
+        if not queue:
+            del self.queues[tenant]
+            del self.deficit[tenant]
+
+    def _withdraw(self, tenant: int, entry: QueueEntry) -> bool:
+        """
+        Заканчивает ожидание: True, если место уже выдано, иначе
+        убирает запрос из очереди. Под lock место не может быть выдано
+        между проверкой и удалением
+        """
+        with self.lock:
+            if entry.future.done():
+                return True
+            self._remove(tenant, entry)
+            return False
+
+    def _finish(self):
+        with self.lock:
+            self.running -= 1
+            self._dispatch()
+
+    @asynccontextmanager
+    async def turn(
+        self, tenant: int, cost: float, timeout: float = None, reserved: bool = False
+    ):
+        """
+        Ждет очереди юзера (не дольше timeout секунд) и держит место
+        в concurrency, пока выполняется тело with. reserved - место
+        в очереди уже занято через try_reserve
+        """
+        future = asyncio.get_running_loop().create_future()
+        entry = QueueEntry(cost, future)
+        with self.lock:
+            if reserved:
+                self._unreserve(tenant, 1)
+            if tenant not in self.queues:
+                self.queues[tenant] = []
+                self.deficit[tenant] = self.quantum
+            self.queues[tenant].append(entry)
+            self.queued += 1
+            self._dispatch()
+
+        # wait, в отличие от wait_for, не отменяет future: место, выданное
+        # одновременно с таймаутом или отменой, не теряется
+        try:
+            await asyncio.wait((future,), timeout=timeout)
+        except BaseException:
+            if self._withdraw(tenant, entry):
+                self._finish()
+            raise
+        if not self._withdraw(tenant, entry):
+            raise SchedulerException("Timed out in the generation queue")
+
+        if self.metrics is not None:
+            self.metrics.add(tenant, "served")
+            self.metrics.add(tenant, "wait_seconds", time.monotonic() - entry.enqueued)
+        try:
+            yield
+        finally:
+            self._finish()
+
+    def stats(self) -> dict:
+        """
+        Счетчики очереди (для логов и метрик)
+        """
+        with self.lock:
+            return {
+                "running": self.running,
+                "queued": self.queued,
+                "reserved": self.reserved_total,
+                "tenants": len(self.queues),
+            }
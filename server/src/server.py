@@ -2,69 +2,91 @@
 Главный модуль с сервером FastAPI
 """
 
+import asyncio
+import json
 import logging
 import time
 import re
 
+from collections import Counter
 from typing import Annotated
 
 from fastapi import (
     BackgroundTasks,
+    Depends,
     FastAPI,
-    Header,
     UploadFile,
     Form,
+    Response,
 )
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.openapi.utils import get_openapi
+from starlette.background import BackgroundTask
 
 import requests
 
 from models import (
     GenerateQueryModel,
-    SendFeedbackResult,
+    GenerateBatchQueryModel,
+    GenerateBatchID,
+    GenerateResultBatchID,
     GenerateResultID,
-    GenerateResultStatus,
-    GenerateResultData,
     GenerateID,
-    GenerateStatus,
-    GenerateResult,
-    UserResults,
     UploadFileResult,
 )
-from config import Config
-from database import Database, DBException
-from utils import (
-    is_valid,
-    parse_query_string,
-    replace_stop_words,
-    prepare_string,
-    UtilsException,
-)
+from database import DBException
+from utils import replace_stop_words, prepare_string
 from nn_api import NNException, NNApi
-
-logging.basicConfig(
-    format="%(asctime)s %(message)s",
-    handlers=[
-        logging.FileHandler(
-            f"/home/logs/log_{time.ctime().replace(' ', '_')}.txt",
-            mode="w",
-            encoding="UTF-8",
-        )
-    ],
-    datefmt="%H:%M:%S UTC",
-    level=logging.INFO,
+from key_pool import KeyPoolException
+from templates import TemplateException
+from ranking import rank_texts
+from cache import SingleFlightException, make_fingerprint
+from auth import AuthResult
+from structured_logging import text_id_var
+from scheduler import RateLimit, SchedulerException
+from service_metrics import MetricsRoute, generation_phase_seconds
+from components import (
+    config,
+    db,
+    adb,
+    templates,
+    token_counter,
+    generation_events,
+    single_flight,
+    result_cache,
+    post_writes,
+    generation_states,
+    tenant_metrics,
+    rate_limiter,
+    fair_scheduler,
+    model_client,
+    metrics_exporter,
+    setup_key_slots,
+    get_auth,
+    get_generation_auth,
 )
+import post_routes
+import status_routes
+from status_routes import stream_generation_events, unsubscribe_events
+
+# Ошибки, с которыми генерация записывается неудачной
+GENERATION_ERRORS = (
+    TemplateException,
+    KeyPoolException,
+    SchedulerException,
+    NNException,
+    SingleFlightException,
+    DBException,
+)
+
 
 app = FastAPI()
-config = Config("config.json")
-db = Database(
-    config.db_user,
-    config.db_password,
-    config.db_name,
-    config.db_port,
-    config.db_host,
-)
+app.router.route_class = MetricsRoute
+app.include_router(post_routes.router)
+app.include_router(status_routes.router)
+# Ссылки на запущенные корутины, чтобы сборщик мусора их не прибил
+running_tasks = set()
 
 origins = [
     "*",
@@ -133,470 +155,302 @@ def startup():
     logging.info("Server started")
     try:
         if db.need_migration():
-            logging.info("Creating tables...")
+            logging.info("Migrating schema from version %s...", db.get_schema_version())
             db.migrate()
-            logging.info("Creating tables...\tOK")
+            logging.info("Migrating schema...\tOK, version %s", db.get_schema_version())
+        setup_key_slots()
+        metrics_exporter.start()
     except DBException as exc:
-        logging.error(f"Error while checking tables: {exc}")
+        logging.error("Error while checking tables: %s", exc)
         raise Exception("DB Error! Shutting down...") from exc
     except Exception as exc:
-        logging.error(f"Unknown error: {exc}")
+        logging.error("Unknown error: %s", exc)
         raise Exception("Unknown error! Shutting down...") from exc
 
 
-@app.post(
-    "/api/v1/post/{post_id}/like",
-    response_model=SendFeedbackResult,
-    tags=["Действия с готовым постом"],
-)
-def send_like(post_id: int, Authorization=Header()):
+@app.on_event("shutdown")
+def shutdown():
     """
-    Метод для отправки лайка на пост
-
-    post_id - айди генерации, полученный из generate
-
+    При остановке сервера дописать в базу буфер отложенной записи
+    и сбросить последний снимок метрик
     """
-    try:
-        auth_data = parse_query_string(Authorization)
-        if not is_valid(query=auth_data, secret=config.client_secret):
-            return SendFeedbackResult(status=1, message="Authorization error")
-    except UtilsException as exc:
-        logging.error(f"Error in utils, probably the request was not correct: {exc}")
-        return SendFeedbackResult(
-            status=3,
-            message="Error in utils, probably the request was not correct",
-        )
-
-    result_id = int(post_id)
-
-    if result_id <= 1:
-        return SendFeedbackResult(
-            status=3,
-            message="Incorrect post id",
-        )
+    if post_writes is not None:
+        post_writes.stop()
+        logging.info("Write-behind buffer flushed: %s", post_writes.stats())
+    metrics_exporter.stop()
 
-    logging.info(f"/like\tid={result_id}")
 
-    try:
-        if not db.user_owns_post(auth_data["vk_user_id"], result_id):
-            return SendFeedbackResult(status=1, message="Post is not yours")
-
-        db.write_feedback(result_id, 1)
-        logging.info(logging.info(f"/like\tid={result_id}\tOK"))
-        return SendFeedbackResult(status=0, message="Post is liked")
-    except DBException as exc:
-        logging.error(f"Error in database: {exc}")
-        return SendFeedbackResult(status=6, message="Error in database")
-    except Exception as exc:
-        logging.error(f"Unknown error: {exc}")
-        return SendFeedbackResult(status=4, message="Unknown error")
-
-
-@app.post(
-    "/api/v1/post/{post_id}/dislike",
-    response_model=SendFeedbackResult,
-    tags=["Действия с готовым постом"],
-)
-def send_dislike(post_id: int, Authorization=Header()):
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
     """
-    Метод для отправки дизлайка на пост
-
-    post_id - айди генерации, полученный из generate
-
+    Метрики всех процессов в текстовом формате Prometheus
     """
-    try:
-        auth_data = parse_query_string(Authorization)
-        if not is_valid(query=auth_data, secret=config.client_secret):
-            return SendFeedbackResult(status=1, message="Authorization error")
-    except UtilsException as exc:
-        logging.error(f"Error in utils, probably the request was not correct: {exc}")
-        return SendFeedbackResult(
-            status=3,
-            message="Error in utils, probably the request was not correct",
-        )
-
-    result_id = int(post_id)
-
-    if result_id <= 1:
-        return SendFeedbackResult(
-            status=3,
-            message="Incorrect post id",
-        )
-
-    logging.info(f"/dislike\tid={result_id}")
-
-    try:
-        if not db.user_owns_post(auth_data["vk_user_id"], result_id):
-            return SendFeedbackResult(status=1, message="Post is not yours")
-
-        db.write_feedback(result_id, -1)
-        logging.info(logging.info(f"/dislike\tid={result_id}\tOK"))
-        return SendFeedbackResult(status=0, message="Post is disliked")
-    except DBException as exc:
-        logging.error(f"Error in database: {exc}")
-        return SendFeedbackResult(status=6, message="Error in database")
-    except Exception as exc:
-        logging.error(f"Unknown error: {exc}")
-        return SendFeedbackResult(status=4, message="Unknown error")
+    return Response(
+        metrics_exporter.collect(),
+        media_type="text/plain; version=0.0.4",
+    )
 
 
-@app.delete(
-    "/api/v1/post/{post_id}",
-    response_model=SendFeedbackResult,
-    tags=["Действия с готовым постом"],
-)
-def send_hidden(post_id: int, Authorization=Header()):
+def check_rate_limit(
+    user_id: int, group_counts: dict[int, int], response: Response
+) -> RateLimit:
     """
-    Метод для скрытия поста
-
-    post_id - айди генерации, полученный из generate
-
+    Списывает генерации с лимитов юзера и групп (group_counts - сколько
+    генераций на какую группу) и выставляет заголовки X-RateLimit-*
     """
-    try:
-        auth_data = parse_query_string(Authorization)
-        if not is_valid(query=auth_data, secret=config.client_secret):
-            return SendFeedbackResult(status=1, message="Authorization error")
-    except UtilsException as exc:
-        logging.error(f"Error in utils, probably the request was not correct: {exc}")
-        return SendFeedbackResult(
-            status=3,
-            message="Error in utils, probably the request was not correct",
-        )
-
-    result_id = int(post_id)
-
-    if result_id <= 1:
-        return SendFeedbackResult(
-            status=3,
-            message="Incorrect post id",
+    limit = rate_limiter.check_groups(user_id, group_counts)
+    count = sum(group_counts.values())
+    response.headers.update(limit.headers())
+    tenant_metrics.add(user_id, "admitted" if limit.allowed else "limited", count)
+    if not limit.allowed:
+        logging.info(
+            "Rate limit exceeded: vk_user_id=%s; group_ids=%s",
+            user_id,
+            list(group_counts),
         )
-
-    logging.info(f"/delete\tid={result_id}")
-
-    try:
-        if not db.user_owns_post(auth_data["vk_user_id"], result_id):
-            return SendFeedbackResult(status=1, message="Post is not yours")
-
-        db.hide_generation(result_id, 1)
-        logging.info(logging.info(f"/delete\tid={result_id}\tOK"))
-        return SendFeedbackResult(status=0, message="Post is hidden")
-    except DBException as exc:
-        logging.error(f"Error in database: {exc}")
-        return SendFeedbackResult(status=6, message="Error in database")
-    except Exception as exc:
-        logging.error(f"Unknown error: {exc}")
-        return SendFeedbackResult(status=4, message="Unknown error")
+    return limit
 
 
-@app.post(
-    "/api/v1/post/{post_id}/recover",
-    response_model=SendFeedbackResult,
-    tags=["Действия с готовым постом"],
-)
-def send_recovered(post_id: int, Authorization=Header()):
+async def finish_generation(
+    gen_id: int,
+    text: str,
+    gen_time: int,
+    is_ok: bool = True,
+):
     """
-    Метод для восстановления поста
-
-    post_id - айди генерации, полученный из generate
-
+    Записывает результат генерации в базу и отправляет его подписчикам SSE
     """
-    try:
-        auth_data = parse_query_string(Authorization)
-        if not is_valid(query=auth_data, secret=config.client_secret):
-            return SendFeedbackResult(status=1, message="Authorization error")
-    except UtilsException as exc:
-        logging.error(f"Error in utils, probably the request was not correct: {exc}")
-        return SendFeedbackResult(
-            status=3,
-            message="Error in utils, probably the request was not correct",
-        )
-
-    result_id = int(post_id)
-
-    if result_id <= 1:
-        return SendFeedbackResult(
-            status=3,
-            message="Incorrect post id",
-        )
-
-    logging.info(f"/recover\tid={result_id}")
+    await adb.add_record_result(gen_id, text, gen_time, is_ok)
+    await generation_states.finished_async(gen_id, text, is_ok)
+    generation_events.publish(
+        gen_id,
+        "result",
+        {"text_status": 1 if is_ok else 2, "text_data": text},
+    )
 
-    try:
-        if not db.user_owns_post(auth_data["vk_user_id"], result_id):
-            return SendFeedbackResult(status=1, message="Post is not yours")
 
-        db.hide_generation(result_id, 0)
-        logging.info(logging.info(f"/recover\tid={result_id}\tOK"))
-        return SendFeedbackResult(status=0, message="Post is recovered")
-    except DBException as exc:
-        logging.error(f"Error in database: {exc}")
-        return SendFeedbackResult(status=6, message="Error in database")
-    except Exception as exc:
-        logging.error(f"Unknown error: {exc}")
-        return SendFeedbackResult(status=4, message="Unknown error")
+def save_result(gen_id: int, text: str, gen_time: int, is_ok: bool = True):
+    """
+    Записывает результат генерации в базу и в хранилище состояний
+    (для синхронного кода эндпоинтов)
+    """
+    db.add_record_result(gen_id, text, gen_time, is_ok)
+    generation_states.finished(gen_id, text, is_ok)
 
 
-@app.post(
-    "/api/v1/post/{post_id}/publish",
-    response_model=SendFeedbackResult,
-    tags=["Действия с готовым постом"],
-)
-def send_published(post_id: int, Authorization=Header()):
+def job_payload(method: str, texts: list[str], hint: str, user_id: int) -> str:
+    """
+    Задача для воркера в очереди generation_jobs (разбирает worker.run_job)
     """
-    Метод для отправки а=факта о публикации на пост
+    return json.dumps(
+        {"method": method, "texts": texts, "hint": hint, "user_id": user_id},
+        ensure_ascii=False,
+    )
 
-    post_id - айди генерации, полученный из generate
 
+def build_request(gen_method: str, texts: list[str], hint: str) -> NNApi:
     """
-    try:
-        auth_data = parse_query_string(Authorization)
-        if not is_valid(query=auth_data, secret=config.client_secret):
-            return SendFeedbackResult(status=1, message="Authorization error")
-    except UtilsException as exc:
-        logging.error(f"Error in utils, probably the request was not correct: {exc}")
-        return SendFeedbackResult(
-            status=3,
-            message="Error in utils, probably the request was not correct",
-        )
-
-    result_id = int(post_id)
+    Готовит запрос к нейросети: шаблон метода, очистка текстов,
+    ранжирование старых постов и упаковка в бюджет токенов (если
+    в шаблоне метода есть старые посты)
+    """
+    with generation_phase_seconds.time(gen_method=gen_method, phase="template"):
+        template = templates.get(gen_method)
+    api = NNApi(template, gen_method, token_counter, config.nn.api_base)
 
-    if result_id <= 1:
-        return SendFeedbackResult(
-            status=3,
-            message="Incorrect post id",
-        )
+    with generation_phase_seconds.time(gen_method=gen_method, phase="prepare_query"):
+        hint = prepare_string(replace_stop_words(hint))
 
-    logging.info(f"/publish\tid={result_id}")
+        if template.needs_hint and (hint == ""):
+            raise NNException("Hint cannot be empty (unless it is gen_from_scratch)")
 
-    try:
-        if not db.user_owns_post(auth_data["vk_user_id"], result_id):
-            return SendFeedbackResult(status=1, message="Post is not yours")
+        if not template.needs_old_texts:
+            # Старые посты в шаблон не попадут - не чистим и не ранжируем их
+            texts = []
+        else:
+            texts = [prepare_string(replace_stop_words(text)) for text in texts]
+            if config.prompts.rank_context:
+                texts = rank_texts(texts, hint, config.prompts.rank_time_budget)
 
-        db.write_published(result_id)
-        logging.info(logging.info(f"/publish\tid={result_id}\tOK"))
-        return SendFeedbackResult(status=0, message="Post is marked as published")
-    except DBException as exc:
-        logging.error(f"Error in database: {exc}")
-        return SendFeedbackResult(status=6, message="Error in database")
-    except Exception as exc:
-        logging.error(f"Unknown error: {exc}")
-        return SendFeedbackResult(status=4, message="Unknown error")
+        api.prepare_query(texts, hint)
+    return api
 
 
-@app.get(
-    "/api/v1/posts",
-    response_model=UserResults,
-    tags=["Статистика"],
-)
-def get_history(
-    group_id: int = None,
-    offset: int = None,
-    limit: int = None,
-    Authorization=Header(),
-):
+def find_cached(
+    method: str, texts: list[str], hint: str
+) -> tuple[NNApi, str, str]:
     """
-    Метод для получения списка всех сгенерированных юзером текстов
-
-    group_id - int, необязательное, если указать его, то вернет все
-    записи для данного сообщества от данного юзера. Если не указать,
-    то все записи от данного юзера
-
-    limit - int, необязательное, максимальное количество результатов
-
-    offest - int, необязательное, смещение
+    Готовит запрос, считает ключ генерации и ищет готовый результат
+    в кэше. Запрос и ключ передаются в ask_nn, чтобы не готовить их
+    второй раз. Возвращает (запрос, ключ, результат), каждое может быть None
     """
-
     try:
-        auth_data = parse_query_string(Authorization)
-        if not is_valid(query=auth_data, secret=config.client_secret):
-            return UserResults(
-                status=1,
-                message="Authorization error",
-                data=[],
-                count=0,
-            )
-    except UtilsException as exc:
-        logging.error(f"Error in utils, probably the request was not correct: {exc}")
-        return UserResults(
-            status=3,
-            message="Authorization error",
-            data=[],
-            count=0,
-        )
-    except Exception as exc:
-        logging.error(f"Unknown error: {exc}")
-        return UserResults(
-            status=1,
-            message="Unknown error",
-            data=[],
-            count=0,
-        )
+        api = build_request(method, texts, hint)
+    except (NNException, TemplateException):
+        # Ошибку в запросе запишет ask_nn
+        return None, None, None
+    fingerprint = make_fingerprint(method, api.query)
+    if result_cache.enabled_for(method):
+        return api, fingerprint, result_cache.get(fingerprint)
+    return api, fingerprint, None
 
-    user_id = auth_data["vk_user_id"]
-
-    logging.info(
-        f"/posts\tvk_user_id={user_id}; group_id={group_id}; offset={offset}; limit={limit}"
-    )
 
-    try:
-        generated_results = db.get_users_texts(group_id, user_id)
-        total_len = len(generated_results)
-        if offset:
-            generated_results = generated_results[offset:]
-        if limit:
-            generated_results = generated_results[:limit]
-        logging.info(
-            f"/posts\tvk_user_id={user_id}; group_id={group_id}; offset={offset}; limit={limit}\tOK"
-        )
-        return UserResults(
-            status=0,
-            message="Results returned",
-            data=generated_results,
-            count=total_len,
-        )
-
-    except DBException as exc:
-        logging.error(f"Error in database while fetching user results text: {exc}")
-        return UserResults(
-            status=6,
-            message="Error in database while fetching user results text",
-            data=[],
-            count=0,
-        )
-    except Exception as exc:
-        logging.error(f"Unknown error: {exc}")
-        return UserResults(
-            status=4,
-            message="Unknown error",
-            data=[],
-            count=0,
-        )
-
-
-def ask_nn(
+async def ask_nn(
     gen_method: str,
     texts: list[str],
     hint: str,
     gen_id: int,
+    *,
+    stream: bool = False,
+    coalesce: bool = True,
+    user_id: int = 0,
+    api: NNApi = None,
+    fingerprint: str = None,
+    reserved: bool = False,
 ):
     """
-    Общий метод для вызова функций работы с нейросетью
+    Общий метод для вызова функций работы с нейросетью.
+    Выполняется в event loop: запрос к нейросети асинхронный,
+    база - через adb (асинхронный драйвер или пул потоков).
+    При stream=True куски ответа сразу публикуются подписчикам SSE,
+    при coalesce=False генерация не объединяется с такими же идущими.
+    Ключ занимается в очереди юзера user_id (fair_scheduler).
+    api и fingerprint - уже готовый запрос и его ключ (из find_cached),
+    без них запрос готовится здесь. reserved - место в очереди
+    fair_scheduler занято при приеме запроса (try_reserve).
+    Возвращает True, если генерация завершилась успешно
     """
 
     time_start = int(time.time())
+    text_id_var.set(gen_id)
 
     logging.info(
-        f"/{gen_method}\tlen(texts)={len(texts)}; hint[:20]={hint[:20]}; gen_id={gen_id}"
+        "/%s\tlen(texts)=%s; hint[:20]=%s; gen_id=%s",
+        gen_method,
+        len(texts),
+        hint[:20],
+        gen_id,
     )
 
-    token = None
-
     try:
-        token = config.next_token()
-
-        logging.info(f"Got token[:10]: {token[:10]}")
-
-        api = NNApi(token=token)
-
-        if gen_method == "generate_text":
-            api.load_context(config.gen_context_path)
-        elif gen_method == "append_text":
-            api.load_context(config.append_context_path)
-        elif gen_method == "rephrase_text":
-            api.load_context(config.rephrase_context_path)
-        elif gen_method == "summarize_text":
-            api.load_context(config.summarize_context_path)
-        elif gen_method == "extend_text":
-            api.load_context(config.extend_context_path)
-        elif gen_method == "unmask_text":
-            api.load_context(config.unmask_context_path)
-        elif gen_method == "gen_from_scratch":
-            api.load_context(config.gen_from_scratch_context_path)
-        elif gen_method == "fix_grammar":
-            api.load_context(config.fix_grammar_context_path)
-
-        texts = [prepare_string(replace_stop_words(text)) for text in texts]
-        hint = prepare_string(replace_stop_words(hint))
-
-        if (gen_method != "gen_from_scratch") and (hint == ""):
-            raise NNException("Hint cannot be empty (unless it is gen_from_scratch)")
-
-        api.prepare_query(texts, hint)
-
-        api.send_request()
-
-        result = prepare_string(api.get_result())
+        if api is None:
+            api = build_request(gen_method, texts, hint)
+        if fingerprint is None:
+            fingerprint = make_fingerprint(gen_method, api.query)
+
+        async def call_model() -> str:
+            nonlocal reserved
+            # Провайдер лежит - не держим запрос в очереди
+            if model_client.breaker.is_open():
+                raise NNException("Model provider is unavailable (circuit is open)")
+            # Ключи занимаем в свою очередь среди юзеров (дешевые правки
+            # раньше длинных генераций) и только на время запроса
+            # к нейросети, пул освободит их при любом исходе.
+            # Резерв места в очереди переходит к model_client
+            use_reservation, reserved = reserved, False
+            return await model_client.generate(
+                api, gen_id, stream, user_id, use_reservation
+            )
 
-        if gen_method == "append_text":
-            result = result.replace(hint, "")
-            result = prepare_string(f"{hint} {result}")
+        if stream or not coalesce:
+            # Стриму нужны свои куски ответа, его не объединяем
+            result = await call_model()
+        else:
+            # Одинаковые одновременные генерации ждут один запрос к нейросети
+            result = await single_flight.run(fingerprint, call_model)
 
         time_elapsed = int(time.time() - time_start)
 
-        db.add_record_result(gen_id, result, time_elapsed)
+        if result_cache.enabled_for(gen_method):
+            result_cache.put(fingerprint, result)
 
-        logging.info(
-            f"/{gen_method}\tlen(texts)={len(texts)}; hint[:20]={hint[:20]}; gen_id={gen_id}\tOK"
-        )
+        with generation_phase_seconds.time(gen_method=gen_method, phase="db_write"):
+            await finish_generation(gen_id, result, time_elapsed)
 
-    except NNException as exc:
-        logging.error(f"Error in NN API: {exc}\n")
-        db.add_record_result(gen_id, "", 0, False)
-    except DBException as exc:
-        logging.error(f"Error in database: {exc}")
-        db.add_record_result(gen_id, "", 0, False)
+        logging.info(
+            "/%s\tlen(texts)=%s; hint[:20]=%s; gen_id=%s\tOK",
+            gen_method,
+            len(texts),
+            api.hint[:20],
+            gen_id,
+        )
+        return True
+
+    except GENERATION_ERRORS as exc:
+        logging.error("%s in gen_id=%s: %s", type(exc).__name__, gen_id, exc)
+        await finish_generation(gen_id, "", 0, False)
+    except asyncio.CancelledError:
+        # Генерация не должна остаться "в процессе": записываем ошибку
+        # (shield - запись не прервется повторной отменой) и отменяемся
+        logging.error("Generation gen_id=%s was cancelled", gen_id)
+        await asyncio.shield(finish_generation(gen_id, "", 0, False))
+        raise
     except Exception as exc:
-        logging.error(f"Unknown error: {exc}")
-        db.add_record_result(gen_id, "", 0, False)
+        logging.error("Unknown error: %s", exc)
+        await finish_generation(gen_id, "", 0, False)
     finally:
-        config.free()
+        # Место в очереди не понадобилось: результат общий с такой же
+        # генерацией или ошибка случилась до запроса к нейросети
+        if reserved:
+            fair_scheduler.release(user_id)
+    return False
+
+
+async def ask_nn_batch(
+    jobs: list[tuple[GenerateQueryModel, int, NNApi, str]], user_id: int
+):
+    """
+    Выполняет генерации пакета конкурентно, но не больше
+    batch_concurrency одновременно, чтобы один пакет не занял все ключи.
+    jobs - (элемент пакета, gen_id, запрос и ключ из find_cached),
+    места в очереди для них уже заняты (try_reserve)
+    """
+    semaphore = asyncio.Semaphore(config.limits.batch_concurrency)
+
+    async def run(item: GenerateQueryModel, gen_id: int, api: NNApi, fingerprint: str):
+        async with semaphore:
+            # Одинаковые запросы в пакете - это намеренно разные варианты
+            await ask_nn(
+                item.method,
+                item.context_data,
+                item.hint,
+                gen_id,
+                coalesce=False,
+                user_id=user_id,
+                api=api,
+                fingerprint=fingerprint,
+                reserved=True,
+            )
+
+    await asyncio.gather(*(run(*job) for job in jobs))
 
 
 def process_method(
     method: str,
     data: GenerateQueryModel,
     background_tasks: BackgroundTasks,
-    Authorization=Header(),
+    auth: AuthResult,
+    response: Response,
 ):
     """
     Общий метод для обработки запроса на генерацию
     """
-    try:
-        auth_data = parse_query_string(Authorization)
-        if not is_valid(query=auth_data, secret=config.client_secret):
-            return GenerateID(
-                status=1,
-                message="Authorization error",
-                data=GenerateResultID(text_id=-1),
-            )
-    except UtilsException as exc:
-        logging.error(f"Error in utils, probably the request was not correct: {exc}")
-        return GenerateID(
-            status=3,
-            message="Authorization error",
-            data=GenerateResultID(text_id=-1),
-        )
-    except Exception as exc:
-        logging.error(f"Unknown error: {exc}")
+    if auth.status:
         return GenerateID(
-            status=4,
-            message="Unknown error",
+            status=auth.status,
+            message=auth.message,
             data=GenerateResultID(text_id=-1),
         )
 
-    try:
-        texts = data.context_data
-        hint = data.hint
-        user_id = auth_data["vk_user_id"]
-        platform = auth_data["vk_platform"]
-        group_id = data.group_id
-        time_now = int(time.time())
-    except KeyError as exc:
-        logging.error(f"Key error. Check the header: {exc}")
+    texts = data.context_data
+    hint = data.hint
+    user_id = auth.user_id
+    group_id = data.group_id
+
+    if not check_rate_limit(user_id, {group_id: 1}, response).allowed:
         return GenerateID(
-            status=4,
-            message="Key error. Check the header",
+            status=7,
+            message="Rate limit exceeded",
             data=GenerateResultID(text_id=-1),
         )
 
@@ -606,27 +460,81 @@ def process_method(
             user_id,
             method,
             group_id,
-            time_now,
-            platform,
+            int(time.time()),
+            auth.platform,
         )
     except DBException as exc:
-        logging.error(f"Error in database: {exc}")
+        logging.error("Error in database: %s", exc)
         return GenerateID(
             status=6,
             message="Error in database",
             data=GenerateResultID(text_id=-1),
         )
+    # В режиме очереди генерацию выполнит воркер, а не этот процесс
+    generation_states.created(gen_id, user_id, owned=not config.jobs.enabled)
+
+    api, fingerprint, cached = find_cached(method, texts, hint)
+    if cached is not None:
+        logging.info("/%s\tgen_id=%s\tcache hit", method, gen_id)
+        try:
+            save_result(gen_id, cached, 0)
+        except DBException as exc:
+            logging.error("Error in database: %s", exc)
+            return GenerateID(
+                status=6,
+                message="Error in database",
+                data=GenerateResultID(text_id=-1),
+            )
+        return GenerateID(
+            status=0,
+            message="OK",
+            data=GenerateResultID(text_id=gen_id),
+        )
+
+    if config.jobs.enabled:
+        # Ключами распоряжаются воркеры, API только ставит задачу в очередь
+        try:
+            db.add_job(gen_id, job_payload(method, texts, hint, user_id))
+        except DBException as exc:
+            logging.error("Error in database: %s", exc)
+            save_result(gen_id, "", 0, False)
+            return GenerateID(
+                status=6,
+                message="Error in database",
+                data=GenerateResultID(text_id=-1),
+            )
+        return GenerateID(
+            status=0,
+            message="OK",
+            data=GenerateResultID(text_id=gen_id),
+        )
 
-    if not config.ready():
-        logging.error("Service is not ready. Not enough tokens")
-        db.add_record_result(gen_id, "", 0, False)
+    # Место в очереди занимаем сразу, даже если такая же генерация уже
+    # идет: присоединившаяся к ней в очередь за ключом не встанет и место
+    # вернет, но лимиты очереди юзера действуют и на одинаковые запросы
+    reserved = fair_scheduler.try_reserve(user_id)
+    if not reserved:
+        logging.error("Generation queue is full for vk_user_id=%s", user_id)
+        save_result(gen_id, "", 0, False)
         return GenerateID(
             status=7,
             message="Server is not ready",
             data=GenerateResultID(text_id=-1),
         )
 
-    background_tasks.add_task(ask_nn, method, texts, hint, gen_id)
+    # ask_nn - корутина, поэтому BackgroundTasks выполнит ее в event loop,
+    # а не займет поток из пула на все время генерации
+    background_tasks.add_task(
+        ask_nn,
+        method,
+        texts,
+        hint,
+        gen_id,
+        user_id=user_id,
+        api=api,
+        fingerprint=fingerprint,
+        reserved=reserved,
+    )
 
     return GenerateID(
         status=0,
@@ -643,7 +551,8 @@ def process_method(
 def generate(
     data: GenerateQueryModel,
     background_tasks: BackgroundTasks,
-    Authorization=Header(),
+    response: Response,
+    auth: AuthResult = Depends(get_generation_auth),
 ):
     """
     Метод для генерации текстового контета нейросетью выбранным способом
@@ -662,149 +571,238 @@ def generate(
 
     group_id - int, айди группы, для которой генерируется пост. Нужно
     чтобы связать генерацию с группой и потом выдавать статистику для группы по этому айди
+
+    Генерации ограничены по частоте на юзера и на группу: остаток лимита
+    приходит в заголовках X-RateLimit-Limit, X-RateLimit-Remaining
+    и X-RateLimit-Reset, при превышении - status 7 и Retry-After
     """
     return process_method(
         data.method,
         data,
         background_tasks,
-        Authorization,
+        auth,
+        response,
     )
 
 
-@app.get(
-    "/api/v1/generation/status",
-    response_model=GenerateStatus,
+@app.post(
+    "/api/v1/generation/batch",
+    response_model=GenerateBatchID,
     tags=["Генерация"],
 )
-def get_status(text_id: int, Authorization=Header()):
+def generate_batch(
+    data: GenerateBatchQueryModel,
+    background_tasks: BackgroundTasks,
+    response: Response,
+    auth: AuthResult = Depends(get_generation_auth),
+):
     """
-    Возвращает статус генерации, 0 - не готово, 1 - готово,
-    2 - ошибка
+    Метод для генерации нескольких вариантов за один вызов. Авторизация
+    проверяется один раз, записи добавляются одним запросом в базу,
+    а генерации выполняются конкурентно
 
-    text_id - айди текста, выданный методом генерации
-    """
-    logging.info(f"/get_gen_status\ttext_id={text_id}")
+    items - list[GenerateQueryModel], запросы, каждый как в
+    /api/v1/generation/generate (не больше batch_max_size штук)
 
-    if int(text_id) <= 1:
-        return GenerateStatus(
-            status=3,
-            message="Incorrect post id",
-            data=GenerateResultStatus(text_status=-1),
+    Возвращает айди текстов в порядке запросов. Статусы всего пакета можно
+    получить одним вызовом /api/v1/generation/batch/status
+
+    Каждый запрос пакета списывается с лимитов частоты генераций юзера
+    и своей группы, пакет принимается целиком или никак
+    """
+    if auth.status:
+        return GenerateBatchID(
+            status=auth.status,
+            message=auth.message,
+            data=GenerateResultBatchID(text_ids=[]),
         )
+    user_id = auth.user_id
 
-    try:
-        auth_data = parse_query_string(Authorization)
-        if not is_valid(query=auth_data, secret=config.client_secret):
-            return GenerateStatus(
-                status=1,
-                message="Authorization error",
-                data=GenerateResultStatus(text_status=-1),
-            )
-    except UtilsException as exc:
-        logging.error(f"Error in utils, probably the request was not correct: {exc}")
-        return GenerateStatus(
+    if not data.items or len(data.items) > config.limits.batch_max_size:
+        return GenerateBatchID(
             status=3,
-            message="Authorization error",
-            data=GenerateResultStatus(text_status=-1),
+            message="Batch must contain from 1 to "
+            f"{config.limits.batch_max_size} items",
+            data=GenerateResultBatchID(text_ids=[]),
         )
-    except Exception as exc:
-        logging.error(f"Unknown error: {exc}")
-        return GenerateStatus(
-            status=4,
-            message="Unknown error",
-            data=GenerateResultStatus(text_status=-1),
+
+    logging.info("/batch\tvk_user_id=%s; len(items)=%s", user_id, len(data.items))
+
+    group_counts = Counter(item.group_id for item in data.items)
+    if not check_rate_limit(user_id, group_counts, response).allowed:
+        return GenerateBatchID(
+            status=7,
+            message="Rate limit exceeded",
+            data=GenerateResultBatchID(text_ids=[]),
         )
 
     try:
-        if not db.user_owns_post(auth_data["vk_user_id"], text_id):
-            return GenerateResultStatus(
-                status=1,
-                message="Post is not yours",
-                data=GenerateResultStatus(text_status=-1),
-            )
-
-        status = db.get_status(text_id)
-        logging.info(f"/get_gen_status\ttext_id={text_id}\tOK")
-        return GenerateStatus(
-            status=0,
-            message="OK",
-            data=GenerateResultStatus(text_status=status),
+        text_ids = db.add_records(
+            [
+                {
+                    "query": item.hint,
+                    "gen_method": item.method,
+                    "group_id": item.group_id,
+                }
+                for item in data.items
+            ],
+            user_id,
+            int(time.time()),
+            auth.platform,
         )
 
+        for gen_id in text_ids:
+            generation_states.created(
+                gen_id, user_id, owned=not config.jobs.enabled
+            )
+
+        jobs = []
+        for item, gen_id in zip(data.items, text_ids):
+            api, fingerprint, cached = find_cached(
+                item.method, item.context_data, item.hint
+            )
+            if cached is not None:
+                save_result(gen_id, cached, 0)
+                continue
+            jobs.append((item, gen_id, api, fingerprint))
+
+        if jobs and config.jobs.enabled:
+            db.add_jobs(
+                [
+                    (
+                        gen_id,
+                        job_payload(
+                            item.method, item.context_data, item.hint, user_id
+                        ),
+                    )
+                    for item, gen_id, _, _ in jobs
+                ]
+            )
+        elif jobs and not fair_scheduler.try_reserve(user_id, len(jobs)):
+            logging.error("Generation queue is full for vk_user_id=%s", user_id)
+            pending = {gen_id for _, gen_id, _, _ in jobs}
+            for gen_id in pending:
+                save_result(gen_id, "", 0, False)
+            # Готовые из кэша результаты отдаем, остальные не приняты
+            return GenerateBatchID(
+                status=7,
+                message="Server is not ready",
+                data=GenerateResultBatchID(
+                    text_ids=[
+                        -1 if gen_id in pending else gen_id for gen_id in text_ids
+                    ]
+                ),
+            )
+        elif jobs:
+            background_tasks.add_task(ask_nn_batch, jobs, user_id)
     except DBException as exc:
-        logging.error(f"Error in database: {exc}")
-        return GenerateStatus(
+        logging.error("Error in database: %s", exc)
+        return GenerateBatchID(
             status=6,
             message="Error in database",
-            data=GenerateResultStatus(text_status=-1),
+            data=GenerateResultBatchID(text_ids=[]),
         )
 
+    logging.info("/batch\tvk_user_id=%s; text_ids=%s\tOK", user_id, text_ids)
+    return GenerateBatchID(
+        status=0,
+        message="OK",
+        data=GenerateResultBatchID(text_ids=text_ids),
+    )
+
 
-@app.get(
-    "/api/v1/generation/result",
-    response_model=GenerateResult,
+@app.post(
+    "/api/v1/generation/stream",
     tags=["Генерация"],
 )
-def get_result(text_id: int, Authorization=Header()):
+async def generate_stream(
+    data: GenerateQueryModel,
+    response: Response,
+    auth: AuthResult = Depends(get_generation_auth),
+):
     """
-    Возвращает результат генерации по айди
+    Метод для генерации со стримингом: вместо text_id сразу возвращает
+    SSE-поток (text/event-stream), в котором текст приходит по кускам
 
-    text_id - айди текста, выданный методом генерации
-    """
+    Параметры такие же, как у /api/v1/generation/generate
 
-    if int(text_id) <= 1:
-        return GenerateResult(
-            status=3,
-            message="Incorrect post id",
-            data=GenerateResultData(ext_data=""),
+    События:
+    * status - {"text_status": 0, "text_id": int}, айди для лайков и публикации
+    * delta - {"text_data": "..."}, очередной кусок текста
+    * result - {"text_status": 1 или 2, "text_data": "..."}, итоговый текст
+    (уже с постобработкой), после него поток закрывается
+    """
+    if auth.status:
+        return GenerateID(
+            status=auth.status,
+            message=auth.message,
+            data=GenerateResultID(text_id=-1),
         )
+    user_id = auth.user_id
+    platform = auth.platform
 
-    logging.info(f"/get_gen_result\ttext_id={text_id}")
-    try:
-        auth_data = parse_query_string(Authorization)
-        if not is_valid(query=auth_data, secret=config.client_secret):
-            return GenerateResult(
-                status=1,
-                message="Authorization error",
-                data=GenerateResultData(text_data=""),
-            )
-    except UtilsException as exc:
-        logging.error(f"Error in utils, probably the request was not correct: {exc}")
-        return GenerateResult(
-            status=3,
-            message="Authorization error",
-            data=GenerateResultData(text_data=""),
-        )
-    except Exception as exc:
-        logging.error(f"Unknown error: {exc}")
-        return GenerateResult(
-            status=4,
-            message="Unknown error",
-            data=GenerateResultData(text_data=""),
+    limit = check_rate_limit(user_id, {data.group_id: 1}, response)
+    if not limit.allowed:
+        return GenerateID(
+            status=7,
+            message="Rate limit exceeded",
+            data=GenerateResultID(text_id=-1),
         )
 
     try:
-        if not db.user_owns_post(auth_data["vk_user_id"], text_id):
-            return GenerateResult(
-                status=1,
-                message="Post is not yours",
-                data=GenerateResultData(text_data=""),
-            )
-
-        result = db.get_value(text_id)
-        logging.info(f"/get_gen_result\ttext_id={text_id}\tOK")
-        return GenerateResult(
-            status=0,
-            message="OK",
-            data=GenerateResultData(text_data=result),
+        gen_id = await adb.add_record(
+            data.hint,
+            user_id,
+            data.method,
+            data.group_id,
+            int(time.time()),
+            platform,
         )
     except DBException as exc:
-        logging.error(f"Error in database: {exc}")
-        return GenerateResult(
+        logging.error("Error in database: %s", exc)
+        return GenerateID(
             status=6,
             message="Error in database",
-            data=GenerateResultData(text_data=""),
+            data=GenerateResultID(text_id=-1),
+        )
+    await generation_states.created_async(gen_id, user_id)
+
+    if not fair_scheduler.try_reserve(user_id):
+        logging.error("Generation queue is full for vk_user_id=%s", user_id)
+        await finish_generation(gen_id, "", 0, False)
+        return GenerateID(
+            status=7,
+            message="Server is not ready",
+            data=GenerateResultID(text_id=-1),
+        )
+
+    # Стриминг всегда выполняется в этом процессе, даже в режиме очереди:
+    # куски ответа идут через шину событий процесса
+    queue = generation_events.subscribe(gen_id)
+    task = asyncio.create_task(
+        ask_nn(
+            data.method,
+            data.context_data,
+            data.hint,
+            gen_id,
+            stream=True,
+            user_id=user_id,
+            reserved=True,
         )
+    )
+    running_tasks.add(task)
+    task.add_done_callback(running_tasks.discard)
+
+    return StreamingResponse(
+        stream_generation_events(gen_id, queue),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            **limit.headers(),
+        },
+        background=BackgroundTask(unsubscribe_events, gen_id, queue),
+    )
 
 
 @app.post(
@@ -815,7 +813,7 @@ def get_result(text_id: int, Authorization=Header()):
 def upload_file(
     upload_url: Annotated[str, Form()],
     file: UploadFile,
-    Authorization=Header(),
+    auth: AuthResult = Depends(get_auth),
 ):
     """
     Метод для загрузки файла на сервер ВКонтакте
@@ -824,31 +822,17 @@ def upload_file(
     group_id - int, айди группы
     """
 
-    logging.info(f"/upload {file.content_type}, {file.filename}")
-    try:
-        auth_data = parse_query_string(Authorization)
-        pattern = re.compile(r"^https:\/\/pu\.vk\.com\/.*$")
-        if (not is_valid(query=auth_data, secret=config.client_secret)) or (
-            not pattern.match(upload_url)
-        ):
-            return UploadFileResult(
-                status=1,
-                message="Authorization error",
-                upload_result="",
-            )
-
-    except UtilsException as exc:
-        logging.error(f"Error in utils, probably the request was not correct: {exc}")
+    logging.info("/upload %s, %s", file.content_type, file.filename)
+    if auth.status:
         return UploadFileResult(
-            status=3,
-            message="Authorization error",
+            status=auth.status,
+            message=auth.message,
             upload_result="",
         )
-    except Exception as exc:
-        logging.error(f"Unknown error: {exc}")
+    if not re.match(r"^https:\/\/pu\.vk\.com\/.*$", upload_url):
         return UploadFileResult(
-            status=4,
-            message="Unknown error",
+            status=1,
+            message="Authorization error",
             upload_result="",
         )
 
@@ -882,7 +866,7 @@ def upload_file(
                 timeout=45,
             )
 
-        logging.info(f"/upload {file.content_type}, {file.filename}\tOK")
+        logging.info("/upload %s, %s\tOK", file.content_type, file.filename)
 
         return UploadFileResult(
             status=0,
@@ -891,7 +875,7 @@ def upload_file(
         )
 
     except Exception as exc:
-        logging.info(f"Error in /upload: {exc}")
+        logging.info("Error in /upload: %s", exc)
         return UploadFileResult(
             status=4,
             message="Unknown error",
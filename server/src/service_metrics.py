@@ -0,0 +1,80 @@
+"""
+Модуль с метриками HTTP-запросов и этапов генерации и маршрутом
+FastAPI, который их считает
+"""
+
+import re
+import time
+import uuid
+
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+
+from metrics import Registry
+from structured_logging import request_id_var
+
+metrics_registry = Registry()
+http_request_seconds = metrics_registry.histogram(
+    "strawberry_http_request_seconds",
+    "Время обработки запроса эндпоинтом",
+    ("route", "http_method"),
+)
+http_responses = metrics_registry.counter(
+    "strawberry_http_responses_total",
+    "Ответы по HTTP-кодам",
+    ("route", "code"),
+)
+api_statuses = metrics_registry.counter(
+    "strawberry_api_status_total",
+    "Ответы по полю status",
+    ("route", "status"),
+)
+generation_phase_seconds = metrics_registry.histogram(
+    "strawberry_generation_phase_seconds",
+    "Время этапов генерации: template, prepare_query, queue, send_request, db_write",
+    ("gen_method", "phase"),
+)
+db_call_seconds = metrics_registry.histogram(
+    "strawberry_db_call_seconds",
+    "Время вызова методов базы",
+    ("method",),
+)
+# В начале JSON-ответов API всегда поле status
+API_STATUS_RE = re.compile(rb'^\{"status":\s*(-?\d+)')
+
+
+class MetricsRoute(APIRoute):
+    """
+    Маршрут, который считает время обработки, HTTP-коды и status ответов
+    и задает айди запроса для логов (из X-Request-ID или новый)
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        route = self.path
+
+        async def timed_handler(request: Request) -> Response:
+            request_id = (
+                request.headers.get("X-Request-ID", "")[:64] or uuid.uuid4().hex
+            )
+            request_id_var.set(request_id)
+            start = time.perf_counter()
+            try:
+                response = await handler(request)
+            except Exception:
+                http_responses.inc(route=route, code=500)
+                raise
+            finally:
+                http_request_seconds.observe(
+                    time.perf_counter() - start,
+                    route=route,
+                    http_method=request.method,
+                )
+            response.headers["X-Request-ID"] = request_id
+            http_responses.inc(route=route, code=response.status_code)
+            match = API_STATUS_RE.match(getattr(response, "body", b""))
+            if match:
+                api_statuses.inc(route=route, status=int(match.group(1)))
+            return response
+
+        return timed_handler
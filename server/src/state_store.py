@@ -0,0 +1,258 @@
+"""
+Модуль с хранилищем состояния генераций (владелец, статус, результат)
+перед базой данных: опросы статуса обслуживаются из памяти
+"""
+
+import logging
+import threading
+
+from collections import OrderedDict
+
+from starlette.concurrency import run_in_threadpool
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class StateStoreException(Exception):
+    """
+    Класс исключения, связанного с хранилищем состояния генераций
+    """
+
+    pass
+
+
+class MemoryBackend:
+    """
+    Хранилище состояний в памяти процесса с вытеснением по LRU.
+    Это и локальный кэш, и замена общему хранилищу, когда процесс один
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: OrderedDict[int, dict] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, gen_id: int) -> dict:
+        """
+        Возвращает копию состояния или None
+        """
+        with self.lock:
+            entry = self.entries.get(gen_id)
+            if entry is None:
+                return None
+            self.entries.move_to_end(gen_id)
+            return dict(entry)
+
+    def update(self, gen_id: int, fields: dict):
+        """
+        Дописывает поля в состояние генерации
+        """
+        with self.lock:
+            self.entries.setdefault(gen_id, {}).update(fields)
+            self.entries.move_to_end(gen_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def size(self) -> int:
+        """
+        Число состояний в хранилище
+        """
+        with self.lock:
+            return len(self.entries)
+
+
+class RedisBackend:
+    """
+    Общее для процессов и воркеров хранилище в Redis: хэш на генерацию,
+    запись полей атомарна, весь хэш живет ttl секунд после изменения.
+    Клиент синхронный: из корутин к нему ходят через пул потоков
+    (GenerationStateStore.created_async и finished_async)
+    """
+
+    def __init__(self, url: str, ttl: int, prefix: str = "strawberry:gen:"):
+        if redis is None:
+            raise StateStoreException("Package redis is not installed")
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, gen_id: int) -> dict:
+        """
+        Возвращает состояние или None
+        """
+        try:
+            data = self.client.hgetall(f"{self.prefix}{gen_id}")
+        except Exception as exc:
+            raise StateStoreException(f"Error in RedisBackend.get: {exc}") from exc
+        if not data:
+            return None
+        for key in ("user_id", "status"):
+            if key in data:
+                data[key] = int(data[key])
+        return data
+
+    def update(self, gen_id: int, fields: dict):
+        """
+        Дописывает поля в состояние генерации
+        """
+        key = f"{self.prefix}{gen_id}"
+        try:
+            pipe = self.client.pipeline()
+            pipe.hset(key, mapping=fields)
+            pipe.expire(key, self.ttl)
+            pipe.execute()
+        except Exception as exc:
+            raise StateStoreException(f"Error in RedisBackend.update: {exc}") from exc
+
+    def size(self) -> int:
+        """
+        Размер не считается: ключи живут по TTL
+        """
+        return -1
+
+
+def make_state_backend(uri: str, max_size: int, ttl: int):
+    """
+    Общее хранилище по адресу из конфига: redis://... или memory://
+    (локальная замена, например для тестов). None - общего хранилища нет
+    """
+    if not uri:
+        return None
+    if uri.startswith("memory://"):
+        return MemoryBackend(max_size)
+    if uri.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(uri, ttl)
+    raise StateStoreException(f"Unknown state backend: {uri}")
+
+
+class GenerationStateStore:
+    """
+    Состояния генераций: user_id (владелец), status и text.
+    process_method и ask_nn пишут сюда сразу при изменении (write-through),
+    эндпоинты читают отсюда и идут в базу только при промахе.
+    Методы синхронные (для эндпоинтов в пуле потоков), корутины
+    используют created_async и finished_async.
+
+    Локальный кэш ограничен max_size. Незавершенной генерации в локальном
+    кэше можно верить, только если ее выполняет этот же процесс (owned):
+    иначе результат запишет кто-то другой, и актуальное состояние есть
+    только в общем хранилище (shared) или в базе
+    """
+
+    def __init__(self, max_size: int, shared=None):
+        self.local = MemoryBackend(max_size)
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+
+    def created(self, gen_id: int, user_id: int, owned: bool = True):
+        """
+        Генерация создана и еще не готова
+        """
+        fields = {"user_id": user_id, "status": 0}
+        self.local.update(gen_id, dict(fields, owned=owned))
+        self._update_shared(gen_id, fields)
+
+    def finished(self, gen_id: int, text: str, is_ok: bool = True):
+        """
+        Генерация завершена (успешно или с ошибкой)
+        """
+        fields = {"status": 1 if is_ok else 2, "text": text}
+        self.local.update(gen_id, fields)
+        self._update_shared(gen_id, fields)
+
+    async def created_async(self, gen_id: int, user_id: int, owned: bool = True):
+        """
+        created для корутин: запрос к общему хранилищу идет в пуле потоков,
+        а не блокирует event loop
+        """
+        if self.shared is None:
+            self.created(gen_id, user_id, owned)
+        else:
+            await run_in_threadpool(self.created, gen_id, user_id, owned)
+
+    async def finished_async(self, gen_id: int, text: str, is_ok: bool = True):
+        """
+        finished для корутин (см. created_async)
+        """
+        if self.shared is None:
+            self.finished(gen_id, text, is_ok)
+        else:
+            await run_in_threadpool(self.finished, gen_id, text, is_ok)
+
+    def remember(self, gen_id: int, user_id: int, status: int, text: str = None):
+        """
+        Запоминает завершенную генерацию, прочитанную из базы
+        """
+        if status == 0:
+            return
+        fields = {"user_id": user_id, "status": status}
+        if text is not None:
+            fields["text"] = text
+        self.local.update(gen_id, fields)
+
+    def runs_here(self, gen_id: int) -> bool:
+        """
+        Выполняет ли генерацию этот процесс: тогда ее события
+        придут в шину событий процесса
+        """
+        state = self.local.get(gen_id)
+        return state is not None and bool(state.get("owned"))
+
+    def get(self, gen_id: int) -> dict:
+        """
+        Возвращает состояние с user_id и status (и text, если известен)
+        или None, если надо идти в базу
+        """
+        state = self.local.get(gen_id)
+        if is_complete(state) and (state["status"] != 0 or state.get("owned")):
+            self.hits += 1
+            return state
+
+        if self.shared is not None:
+            try:
+                state = self.shared.get(gen_id)
+            except StateStoreException as exc:
+                logging.error("Error in state store: %s", exc)
+                state = None
+            if is_complete(state):
+                if state["status"] != 0:
+                    self.local.update(gen_id, state)
+                self.hits += 1
+                return state
+
+        self.misses += 1
+        return None
+
+    def _update_shared(self, gen_id: int, fields: dict):
+        """
+        Пишет поля в общее хранилище. Ошибка не мешает генерации:
+        читатели в худшем случае сходят в базу
+        """
+        if self.shared is None:
+            return
+        try:
+            self.shared.update(gen_id, fields)
+        except StateStoreException as exc:
+            logging.error("Error in state store: %s", exc)
+
+    def stats(self) -> dict:
+        """
+        Счетчики хранилища (для логов и метрик)
+        """
+        return {
+            "size": self.local.size(),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def is_complete(state: dict) -> bool:
+    """
+    Есть ли в состоянии владелец и статус (процесс, который только
+    завершает чужую генерацию, знает лишь статус и текст)
+    """
+    return state is not None and "user_id" in state and "status" in state
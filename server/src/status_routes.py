@@ -0,0 +1,330 @@
+"""
+Модуль с эндпоинтами статуса и результата генераций: опрос
+и поток событий (SSE)
+"""
+
+import asyncio
+import logging
+
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+from models import (
+    GenerateBatchStatus,
+    GenerateResultBatchStatus,
+    GenerateResultStatus,
+    GenerateResultData,
+    GenerateStatus,
+    GenerateResult,
+)
+from database import DBException
+from events import format_sse
+from auth import AuthResult
+from service_metrics import MetricsRoute
+from components import (
+    config,
+    db,
+    adb,
+    generation_events,
+    generation_states,
+    get_auth,
+    log_poll,
+)
+
+router = APIRouter(route_class=MetricsRoute)
+
+
+@router.get(
+    "/api/v1/generation/status",
+    response_model=GenerateStatus,
+    tags=["Генерация"],
+)
+def get_status(text_id: int, auth: AuthResult = Depends(get_auth)):
+    """
+    Возвращает статус генерации, 0 - не готово, 1 - готово,
+    2 - ошибка
+
+    text_id - айди текста, выданный методом генерации
+    """
+    log_poll("/get_gen_status\ttext_id=%s", text_id, text_id=text_id)
+
+    if int(text_id) <= 1:
+        return GenerateStatus(
+            status=3,
+            message="Incorrect post id",
+            data=GenerateResultStatus(text_status=-1),
+        )
+
+    if auth.status:
+        return GenerateStatus(
+            status=auth.status,
+            message=auth.message,
+            data=GenerateResultStatus(text_status=-1),
+        )
+
+    try:
+        state = generation_states.get(text_id)
+        if state is None:
+            if not db.user_owns_post(auth.user_id, text_id):
+                return GenerateStatus(
+                    status=1,
+                    message="Post is not yours",
+                    data=GenerateResultStatus(text_status=-1),
+                )
+            status = db.get_status(text_id)
+            generation_states.remember(text_id, auth.user_id, status)
+        elif state["user_id"] != auth.user_id:
+            return GenerateStatus(
+                status=1,
+                message="Post is not yours",
+                data=GenerateResultStatus(text_status=-1),
+            )
+        else:
+            status = state["status"]
+        log_poll("/get_gen_status\ttext_id=%s\tOK", text_id, text_id=text_id)
+        return GenerateStatus(
+            status=0,
+            message="OK",
+            data=GenerateResultStatus(text_status=status),
+        )
+
+    except DBException as exc:
+        logging.error("Error in database: %s", exc)
+        return GenerateStatus(
+            status=6,
+            message="Error in database",
+            data=GenerateResultStatus(text_status=-1),
+        )
+
+
+@router.get(
+    "/api/v1/generation/batch/status",
+    response_model=GenerateBatchStatus,
+    tags=["Генерация"],
+)
+def get_batch_status(
+    text_ids: Annotated[list[int], Query()],
+    auth: AuthResult = Depends(get_auth),
+):
+    """
+    Возвращает статусы нескольких генераций одним запросом в базу,
+    0 - не готово, 1 - готово, 2 - ошибка, -1 - пост не найден или чужой
+
+    text_ids - айди текстов (?text_ids=1&text_ids=2), выданные методом генерации
+    """
+    log_poll("/get_batch_status\ttext_ids=%s", text_ids)
+
+    if not text_ids or len(text_ids) > config.limits.batch_max_size:
+        return GenerateBatchStatus(
+            status=3,
+            message=f"Pass from 1 to {config.limits.batch_max_size} ids",
+            data=GenerateResultBatchStatus(text_statuses=[]),
+        )
+
+    if auth.status:
+        return GenerateBatchStatus(
+            status=auth.status,
+            message=auth.message,
+            data=GenerateResultBatchStatus(text_statuses=[]),
+        )
+
+    try:
+        statuses = []
+        missing = []
+        for text_id in text_ids:
+            state = generation_states.get(text_id)
+            if state is None:
+                missing.append(text_id)
+                statuses.append(None)
+            elif state["user_id"] != auth.user_id:
+                statuses.append(-1)
+            else:
+                statuses.append(state["status"])
+        if missing:
+            from_db = iter(db.get_statuses(auth.user_id, missing))
+            statuses = [
+                next(from_db) if status is None else status for status in statuses
+            ]
+        log_poll("/get_batch_status\ttext_ids=%s\tOK", text_ids)
+        return GenerateBatchStatus(
+            status=0,
+            message="OK",
+            data=GenerateResultBatchStatus(text_statuses=statuses),
+        )
+    except DBException as exc:
+        logging.error("Error in database: %s", exc)
+        return GenerateBatchStatus(
+            status=6,
+            message="Error in database",
+            data=GenerateResultBatchStatus(text_statuses=[]),
+        )
+
+
+@router.get(
+    "/api/v1/generation/result",
+    response_model=GenerateResult,
+    tags=["Генерация"],
+)
+def get_result(text_id: int, auth: AuthResult = Depends(get_auth)):
+    """
+    Возвращает результат генерации по айди
+
+    text_id - айди текста, выданный методом генерации
+    """
+
+    if int(text_id) <= 1:
+        return GenerateResult(
+            status=3,
+            message="Incorrect post id",
+            data=GenerateResultData(text_data=""),
+        )
+
+    log_poll("/get_gen_result\ttext_id=%s", text_id, text_id=text_id)
+    if auth.status:
+        return GenerateResult(
+            status=auth.status,
+            message=auth.message,
+            data=GenerateResultData(text_data=""),
+        )
+
+    try:
+        state = generation_states.get(text_id)
+        if state is not None and state["user_id"] != auth.user_id:
+            return GenerateResult(
+                status=1,
+                message="Post is not yours",
+                data=GenerateResultData(text_data=""),
+            )
+        if state is not None and "text" in state:
+            result = state["text"]
+        else:
+            if state is None and not db.user_owns_post(auth.user_id, text_id):
+                return GenerateResult(
+                    status=1,
+                    message="Post is not yours",
+                    data=GenerateResultData(text_data=""),
+                )
+            result = db.get_value(text_id)
+        log_poll("/get_gen_result\ttext_id=%s\tOK", text_id, text_id=text_id)
+        return GenerateResult(
+            status=0,
+            message="OK",
+            data=GenerateResultData(text_data=result),
+        )
+    except DBException as exc:
+        logging.error("Error in database: %s", exc)
+        return GenerateResult(
+            status=6,
+            message="Error in database",
+            data=GenerateResultData(text_data=""),
+        )
+
+
+async def unsubscribe_events(text_id: int, queue: asyncio.Queue):
+    """
+    Отписывает SSE-поток после ответа. Задача ответа выполняется и тогда,
+    когда клиент ушел до первого сообщения и генератор потока так
+    и не запустился (его finally не выполнится)
+    """
+    generation_events.unsubscribe(text_id, queue)
+
+
+async def stream_generation_events(text_id: int, queue: asyncio.Queue):
+    """
+    Генератор SSE-сообщений для одной генерации
+    """
+    # Генерацию другого процесса (воркер очереди или другой uvicorn
+    # worker) ждем по базе: ее события в шину этого процесса не придут
+    poll_db = config.events.db_fallback or not generation_states.runs_here(text_id)
+    try:
+        status = await adb.get_status(text_id)
+        if status != 0:
+            text = await adb.get_value(text_id)
+            yield format_sse("result", {"text_status": status, "text_data": text})
+            return
+        yield format_sse("status", {"text_status": status, "text_id": text_id})
+
+        while True:
+            try:
+                event, data = await asyncio.wait_for(
+                    queue.get(), config.events.fallback_interval
+                )
+            except asyncio.TimeoutError:
+                if not poll_db:
+                    yield ": ping\n\n"
+                    continue
+                status = await adb.get_status(text_id)
+                if status == 0:
+                    yield ": ping\n\n"
+                    continue
+                text = await adb.get_value(text_id)
+                event, data = "result", {"text_status": status, "text_data": text}
+
+            yield format_sse(event, data)
+            if event == "result":
+                return
+    except DBException as exc:
+        logging.error("Error in database: %s", exc)
+        yield format_sse("error", {"message": "Error in database"})
+    finally:
+        generation_events.unsubscribe(text_id, queue)
+
+
+@router.get(
+    "/api/v1/generation/events",
+    tags=["Генерация"],
+)
+async def get_events(text_id: int, auth: AuthResult = Depends(get_auth)):
+    """
+    SSE-поток (text/event-stream) с ходом генерации вместо опроса
+    status и result. Сразу присылает текущий статус, а затем результат,
+    как только генерация закончится
+
+    События:
+    * status - {"text_status": 0}
+    * result - {"text_status": 1 или 2, "text_data": "..."}, после него поток закрывается
+
+    text_id - айди текста, выданный методом генерации
+    """
+    logging.info("/get_gen_events\ttext_id=%s", text_id)
+
+    if int(text_id) <= 1:
+        return GenerateStatus(
+            status=3,
+            message="Incorrect post id",
+            data=GenerateResultStatus(text_status=-1),
+        )
+
+    if auth.status:
+        return GenerateStatus(
+            status=auth.status,
+            message=auth.message,
+            data=GenerateResultStatus(text_status=-1),
+        )
+
+    try:
+        if not await adb.user_owns_post(auth.user_id, text_id):
+            return GenerateStatus(
+                status=1,
+                message="Post is not yours",
+                data=GenerateResultStatus(text_status=-1),
+            )
+    except DBException as exc:
+        logging.error("Error in database: %s", exc)
+        return GenerateStatus(
+            status=6,
+            message="Error in database",
+            data=GenerateResultStatus(text_status=-1),
+        )
+
+    # Подписываемся до чтения статуса, чтобы не пропустить результат
+    queue = generation_events.subscribe(text_id)
+    return StreamingResponse(
+        stream_generation_events(text_id, queue),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(unsubscribe_events, text_id, queue),
+    )
@@ -0,0 +1,207 @@
+"""
+Модуль с настройкой логов: записи в формате JSON (по строке на запись)
+пишет в файл фоновый поток, поток запроса только кладет запись в очередь
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import socket
+
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import (
+    QueueHandler,
+    QueueListener,
+    RotatingFileHandler,
+    TimedRotatingFileHandler,
+)
+
+# Айди запроса и генерации, к которым относятся записи лога
+request_id_var: ContextVar[str] = ContextVar("request_id", default=None)
+text_id_var: ContextVar[int] = ContextVar("text_id", default=None)
+
+
+class LoggingException(Exception):
+    """
+    Класс исключения, связанного с настройкой логов
+    """
+
+    pass
+
+
+def add_context(record: logging.LogRecord) -> bool:
+    """
+    Фильтр, который добавляет в запись айди запроса и генерации из контекста.
+    Работает в потоке запроса, до очереди: в фоновом потоке контекста нет
+    """
+    record.request_id = request_id_var.get()
+    if getattr(record, "text_id", None) is None:
+        record.text_id = text_id_var.get()
+    return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает только долю rates[имя логгера] записей уровня INFO и ниже
+    (например, опросов статуса). Предупреждения и ошибки пишутся все.
+    Записи с sampled=True уже отобраны до создания (LogPipeline.sampled)
+    """
+
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def sample(self, name: str) -> bool:
+        """
+        Попадает ли очередная запись логгера name в долю
+        """
+        rate = self.rates.get(name)
+        return rate is None or random.random() < rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or getattr(record, "sampled", False):
+            return True
+        return self.sample(record.name)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Запись лога одной строкой JSON
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "message": record.getMessage(),
+        }
+        for key in ("request_id", "text_id"):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler, который не форматирует запись в потоке запроса:
+    очередь внутри процесса, поэтому запись можно передать как есть,
+    а форматирует и пишет ее фоновый поток
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class LogPipeline:
+    """
+    Логи процесса: записи идут в очередь, фоновый поток пишет их в
+    directory/log_<хост>_<pid>.jsonl с ротацией по размеру (rotation="size",
+    max_bytes) или по времени (rotation="time", when). Файл у каждого
+    процесса свой: несколько процессов не могут ротировать один файл.
+    Воркеры и процессы uvicorn --workers запускаются через spawn и заново
+    импортируют server, поэтому каждый сам вызывает start(). Если процесс
+    все же форкнули, дочерний запускает свой поток и файл после fork
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        *,
+        level: str = "INFO",
+        rotation: str = "size",
+        max_bytes: int = 100 * 1024 * 1024,
+        backup_count: int = 10,
+        when: str = "midnight",
+        sampling: dict[str, float] = None,
+    ):
+        if rotation not in ("size", "time"):
+            raise LoggingException(f"Unknown log rotation: {rotation}")
+        self.directory = directory
+        self.level = level
+        self.rotation = rotation
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.when = when
+        self.queue_handler = DeferredQueueHandler(queue.SimpleQueue())
+        self.sampling_filter = SamplingFilter(sampling or {})
+        self.queue_handler.addFilter(self.sampling_filter)
+        self.queue_handler.addFilter(add_context)
+        self.listener = None
+
+    def sampled(self, logger: logging.Logger) -> bool:
+        """
+        Решает до создания записи INFO, писать ли ее: уровень включен
+        и запись попала в долю. Отобранную запись логируют с
+        extra={"sampled": True}, чтобы фильтр не отбирал ее второй раз
+        """
+        return logger.isEnabledFor(logging.INFO) and self.sampling_filter.sample(
+            logger.name
+        )
+
+    def _file_handler(self) -> logging.Handler:
+        path = os.path.join(
+            self.directory, f"log_{socket.gethostname()}_{os.getpid()}.jsonl"
+        )
+        if self.rotation == "time":
+            handler = TimedRotatingFileHandler(
+                path,
+                when=self.when,
+                backupCount=self.backup_count,
+                encoding="UTF-8",
+                utc=True,
+            )
+        else:
+            handler = RotatingFileHandler(
+                path,
+                maxBytes=self.max_bytes,
+                backupCount=self.backup_count,
+                encoding="UTF-8",
+            )
+        handler.setFormatter(JsonFormatter())
+        return handler
+
+    def start(self):
+        """
+        Подключает очередь к корневому логгеру и запускает фоновый поток
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        root = logging.getLogger()
+        root.setLevel(self.level)
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(self.queue_handler)
+        self.listener = QueueListener(self.queue_handler.queue, self._file_handler())
+        self.listener.start()
+        atexit.register(self.stop)
+        os.register_at_fork(after_in_child=self._restart_in_child)
+
+    def _restart_in_child(self):
+        """
+        Поток родителя после fork не существует: нужна своя очередь,
+        свой поток и свой файл
+        """
+        self.queue_handler.queue = queue.SimpleQueue()
+        self.listener = QueueListener(self.queue_handler.queue, self._file_handler())
+        self.listener.start()
+
+    def stop(self):
+        """
+        Дописывает очередь и останавливает фоновый поток
+        """
+        if self.listener is None:
+            return
+        listener, self.listener = self.listener, None
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
@@ -0,0 +1,112 @@
+"""
+Модуль с реестром шаблонов контекста для методов генерации
+"""
+
+import os
+import re
+import threading
+import time
+
+from models import GenerationMethod
+
+OLD_TEXTS_PLACEHOLDER = "[OLD_TEXTS]"
+HINT_PLACEHOLDER = "[HINT]"
+PLACEHOLDERS_RE = re.compile(
+    f"({re.escape(OLD_TEXTS_PLACEHOLDER)}|{re.escape(HINT_PLACEHOLDER)})"
+)
+
+
+class TemplateException(Exception):
+    """
+    Класс исключения, связанного с шаблонами контекста
+    """
+
+    pass
+
+
+class Template:
+    """
+    Шаблон контекста, заранее разбитый на куски по плейсхолдерам,
+    чтобы подстановка делалась за один проход
+    """
+
+    def __init__(self, text: str, mtime: float = 0.0):
+        self.parts = PLACEHOLDERS_RE.split(text)
+        self.mtime = mtime
+        self.needs_hint = HINT_PLACEHOLDER in self.parts
+        # Шаблоны правок (fix_grammar, rephrase_text...) старых постов не берут
+        self.needs_old_texts = OLD_TEXTS_PLACEHOLDER in self.parts
+        # Текст шаблона без плейсхолдеров - для подсчета бюджета запроса
+        self.static_text = "".join(
+            part
+            for part in self.parts
+            if part not in (OLD_TEXTS_PLACEHOLDER, HINT_PLACEHOLDER)
+        )
+
+    def render(self, old_texts: str, hint: str) -> str:
+        """
+        Подставляет старые посты и затравку в шаблон
+        """
+        values = {OLD_TEXTS_PLACEHOLDER: old_texts, HINT_PLACEHOLDER: hint}
+        return "".join(values.get(part, part) for part in self.parts)
+
+
+class TemplateRegistry:
+    """
+    Реестр шаблонов: файл contexts/<значение GenerationMethod>.txt на каждый
+    метод. Все шаблоны читаются при старте, а изменения файлов подхватываются
+    по mtime (не чаще раза в check_interval секунд) без перезапуска
+    """
+
+    def __init__(self, contexts_dir: str, check_interval: float = 5.0):
+        self.contexts_dir = contexts_dir
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.templates: dict[GenerationMethod, Template] = {}
+        self.checked_at: dict[GenerationMethod, float] = {}
+        for method in GenerationMethod:
+            self.templates[method] = self._load(method)
+            self.checked_at[method] = time.monotonic()
+
+    def path(self, method: GenerationMethod) -> str:
+        """
+        Путь к файлу шаблона метода
+        """
+        return os.path.join(self.contexts_dir, f"{method.value}.txt")
+
+    def _load(self, method: GenerationMethod) -> Template:
+        path = self.path(method)
+        try:
+            mtime = os.stat(path).st_mtime
+            with open(path, "r", encoding="UTF-8") as ctx_file:
+                return Template(ctx_file.read(), mtime)
+        except Exception as exc:
+            raise TemplateException(
+                f"Error while loading template {path}: {exc}"
+            ) from exc
+
+    def get(self, method: str) -> Template:
+        """
+        Возвращает шаблон метода, перечитав файл, если он изменился
+        """
+        try:
+            method = GenerationMethod(method)
+        except ValueError as exc:
+            raise TemplateException(f"Unknown generation method: {method}") from exc
+
+        now = time.monotonic()
+        if now - self.checked_at[method] < self.check_interval:
+            return self.templates[method]
+
+        with self.lock:
+            self.checked_at[method] = now
+            template = self.templates[method]
+            try:
+                changed = os.stat(self.path(method)).st_mtime != template.mtime
+            except OSError:
+                # Файл пропал - продолжаем работать со старой версией
+                return template
+            if changed:
+                template = self._load(method)
+                self.templates[method] = template
+            return template
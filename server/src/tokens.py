@@ -0,0 +1,127 @@
+"""
+Модуль с подсчетом токенов для упаковки контекста в окно модели
+"""
+
+import base64
+import hashlib
+import logging
+import math
+
+# Оценка по умолчанию без словаря (cl100k_base, с запасом):
+# ASCII-символ (латиница, цифры, пробелы) ~ 0.3 токена,
+# кириллица и прочие многобайтовые символы ~ 0.5 токена на каждый
+# "лишний" байт UTF-8 (у кириллицы он один, у эмодзи - три)
+ASCII_TOKENS_PER_CHAR = 0.3
+EXTRA_BYTE_TOKENS = 0.5
+SAFETY_FACTOR = 1.1
+
+# Словари, которые умеет загружать TiktokenCounter: sha256 файла
+# <имя>.tiktoken, регулярка разбиения на слова и служебные токены
+# (как в tiktoken_ext.openai_public). Файл кладется в образ при сборке
+ENCODINGS = {
+    "cl100k_base": {
+        "sha256": "223921b76ee99bde995b7ff738513eef100fb51d18c93597a113bcffe865b2a7",
+        "pat_str": (
+            r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}++|\p{N}{1,3}+|"""
+            r""" ?[^\s\p{L}\p{N}]++[\r\n]*+|\s++$|\s*[\r\n]|\s+(?!\S)|\s"""
+        ),
+        "special_tokens": {
+            "<|endoftext|>": 100257,
+            "<|fim_prefix|>": 100258,
+            "<|fim_middle|>": 100259,
+            "<|fim_suffix|>": 100260,
+            "<|endofprompt|>": 100276,
+        },
+    },
+}
+
+
+class TokenCounter:
+    """
+    Приближенный счетчик токенов без словаря. Работает за два прохода
+    кодирования строки, поэтому почти ничего не стоит.
+
+    Где оценка неточна: русский и английский текст она оценивает сверху
+    с запасом 10-30%, а вот эмодзи - как 1.5 токена, хотя в cl100k_base
+    эмодзи занимает от 1 до 4 токенов, а составные (с ZWJ, флаги, оттенки
+    кожи) - по 1.5 на каждую часть, и реальных токенов может быть больше.
+    Длинные числа и ссылки тоже дробятся мельче оценки. Для постов, где
+    такого много, нужен словарь (TiktokenCounter)
+    """
+
+    name = "approx"
+
+    def count(self, text: str) -> int:
+        """
+        Возвращает оценку количества токенов в тексте (сверху)
+        """
+        if not text:
+            return 0
+        # ASCII-символы считаем отдельно: у эмодзи лишних байтов больше
+        # одного, и разность длин занизила бы число остальных символов
+        ascii_chars = len(text.encode("ascii", "ignore"))
+        extra_bytes = len(text.encode("utf-8")) - len(text)
+        return math.ceil(
+            (ascii_chars * ASCII_TOKENS_PER_CHAR + extra_bytes * EXTRA_BYTE_TOKENS)
+            * SAFETY_FACTOR
+        )
+
+
+def load_ranks(path: str, expected_sha256: str) -> dict[bytes, int]:
+    """
+    Читает файл словаря tiktoken (строки "токен в base64 ранг")
+    и проверяет его sha256
+    """
+    with open(path, "rb") as vocab_file:
+        contents = vocab_file.read()
+    if hashlib.sha256(contents).hexdigest() != expected_sha256:
+        raise ValueError(f"Vocabulary {path} has a wrong checksum")
+    return {
+        base64.b64decode(token): int(rank)
+        for token, rank in (line.split() for line in contents.splitlines() if line)
+    }
+
+
+class TiktokenCounter(TokenCounter):
+    """
+    Точный счетчик на tiktoken. Словарь читается из файла vocab_path,
+    а не через кэш tiktoken, поэтому сеть не нужна и окружение
+    процесса не меняется
+    """
+
+    name = "tiktoken"
+
+    def __init__(self, encoding: str, vocab_path: str):
+        import tiktoken  # pylint: disable=import-outside-toplevel
+
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown encoding: {encoding}")
+        spec = ENCODINGS[encoding]
+        self.encoding = tiktoken.Encoding(
+            name=encoding,
+            pat_str=spec["pat_str"],
+            mergeable_ranks=load_ranks(vocab_path, spec["sha256"]),
+            special_tokens=spec["special_tokens"],
+        )
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+def make_token_counter(
+    encoding: str = "cl100k_base",
+    vocab_path: str = None,
+) -> TokenCounter:
+    """
+    Возвращает точный счетчик, если есть tiktoken и файл словаря,
+    иначе - приближенный
+    """
+    if vocab_path is None:
+        return TokenCounter()
+    try:
+        return TiktokenCounter(encoding, vocab_path)
+    except Exception as exc:
+        logging.error(f"Tokenizer is not available, using estimation: {exc}")
+        return TokenCounter()
@@ -0,0 +1,145 @@
+"""
+Модуль с воркером, который выполняет генерации из очереди в базе данных.
+Запускается отдельно от API, поэтому воркеры и API масштабируются независимо:
+
+python worker.py --processes 4
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import socket
+
+from database import DBException
+from server import (
+    ask_nn,
+    finish_generation,
+    setup_key_slots,
+    metrics_exporter,
+    generation_states,
+    adb,
+    config,
+)
+
+
+async def heartbeat(job_id: int, worker: str):
+    """
+    Продлевает аренду задачи, пока идет генерация
+    """
+    while True:
+        await asyncio.sleep(config.jobs.visibility_timeout / 3)
+        try:
+            await adb.extend_job_lease(job_id, worker, config.jobs.visibility_timeout)
+        except DBException as exc:
+            logging.error("Error in database while extending job lease: %s", exc)
+
+
+async def run_job(job_id: int, gen_id: int, payload: str, worker: str):
+    """
+    Выполняет одну задачу из очереди
+    """
+    logging.info("worker=%s\tjob_id=%s; gen_id=%s", worker, job_id, gen_id)
+    beat = asyncio.create_task(heartbeat(job_id, worker))
+    try:
+        data = json.loads(payload)
+        # ask_nn сам записывает в базу и результат, и ошибку генерации,
+        # задача получает тот же исход
+        is_ok = await ask_nn(
+            data["method"],
+            data["texts"],
+            data["hint"],
+            gen_id,
+            user_id=data.get("user_id", 0),
+        )
+        await adb.finish_job(job_id, worker, is_ok)
+        logging.info(
+            "worker=%s\tjob_id=%s; gen_id=%s\t%s",
+            worker,
+            job_id,
+            gen_id,
+            "OK" if is_ok else "FAILED",
+        )
+    except DBException as exc:
+        # Задача останется арендованной и после таймаута уйдет другому воркеру
+        logging.error("Error in database while finishing job: %s", exc)
+    except Exception as exc:
+        logging.error("Unknown error in job %s: %s", job_id, exc)
+        await adb.finish_job(job_id, worker, False)
+        await finish_generation(gen_id, "", 0, False)
+    finally:
+        beat.cancel()
+
+
+async def work(worker: str):
+    """
+    Главный цикл воркера: держит в работе до worker_concurrency задач
+    """
+    logging.info("Worker %s started", worker)
+    setup_key_slots()
+    metrics_exporter.start()
+    in_flight = set()
+    while True:
+        if len(in_flight) >= config.jobs.worker_concurrency:
+            await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            continue
+
+        try:
+            job = await adb.lease_job(
+                worker,
+                config.jobs.visibility_timeout,
+                config.jobs.max_attempts,
+            )
+            if job is None:
+                expired = await adb.expire_jobs(config.jobs.max_attempts)
+                for gen_id in expired:
+                    await generation_states.finished_async(gen_id, "", False)
+                if expired:
+                    logging.error("%s jobs failed after all attempts", len(expired))
+                await asyncio.sleep(config.jobs.poll_interval)
+                continue
+        except DBException as exc:
+            logging.error("Error in database while leasing job: %s", exc)
+            await asyncio.sleep(config.jobs.poll_interval)
+            continue
+
+        task = asyncio.create_task(run_job(*job, worker))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+
+def run_process():
+    """
+    Точка входа одного процесса воркера
+    """
+    asyncio.run(work(f"{socket.gethostname()}:{os.getpid()}"))
+
+
+def main():
+    """
+    Запускает пул процессов воркеров
+    """
+    parser = argparse.ArgumentParser(description="Strawberry generation worker")
+    parser.add_argument("--processes", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        run_process()
+        return
+
+    # spawn, а не fork: при импорте server запускаются фоновые потоки
+    # (логи, метрики, отложенная запись), и после fork их блокировки
+    # остались бы в дочернем процессе в неизвестном состоянии. Дочерний
+    # процесс импортирует модули заново и запускает свои потоки
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=run_process) for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
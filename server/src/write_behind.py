@@ -0,0 +1,184 @@
+"""
+Модуль с буфером отложенной записи (write-behind) действий с постами
+"""
+
+import logging
+import threading
+import time
+
+# Подтверждать действие сразу после попадания в буфер
+DURABILITY_MEMORY = "memory"
+# Подтверждать действие после коммита пачки, в которую оно попало
+DURABILITY_FLUSH = "flush"
+
+
+class WriteBehindException(Exception):
+    """
+    Класс исключения, связанного с буфером отложенной записи
+    """
+
+    pass
+
+
+class WriteBehindBuffer:
+    """
+    Буфер изменений постов. Повторные изменения одного поля одного поста
+    от одного юзера схлопываются (побеждает последнее); изменения от разных
+    юзеров не затирают друг друга - владельца проверит запись в базу.
+    Фоновый поток раз в flush_interval секунд записывает все накопленное
+    одной транзакцией через flush_func.
+
+    flush_func получает список (text_id, user_id, column, value).
+    Буфер ограничен max_size записями: когда он полон, put ждет записи.
+    durability - DURABILITY_MEMORY (при падении процесса теряется то,
+    что не успели записать) или DURABILITY_FLUSH (put ждет коммита).
+    put ждет не дольше put_timeout секунд (база недоступна или зависла)
+    и выбрасывает WriteBehindException; изменение при этом остается
+    в буфере и может быть записано позже
+    """
+
+    def __init__(
+        self,
+        flush_func,
+        max_size: int,
+        flush_interval: float,
+        durability: str = DURABILITY_MEMORY,
+        put_timeout: float = 5.0,
+    ):
+        if durability not in (DURABILITY_MEMORY, DURABILITY_FLUSH):
+            raise WriteBehindException(f"Unknown durability: {durability}")
+        self.flush_func = flush_func
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.put_timeout = put_timeout
+        # (text_id, column, user_id) -> value
+        self.pending: dict[tuple[int, str, int], object] = {}
+        self.cond = threading.Condition()
+        # Номер пачки, в которую попадут новые записи, и последней записанной
+        self.batch = 1
+        self.flushed = 0
+        self.failed_batches: set[int] = set()
+        self.stopped = False
+        self.writes = 0
+        self.flushes = 0
+        self.thread = threading.Thread(
+            target=self.run, name="write-behind", daemon=True
+        )
+        self.thread.start()
+
+    def put(self, user_id: int, text_id: int, values: dict):
+        """
+        Добавляет изменения поста в буфер
+        """
+        deadline = time.monotonic() + self.put_timeout
+        with self.cond:
+            if self.stopped:
+                raise WriteBehindException("Buffer is stopped")
+            new_keys = [
+                (text_id, column, user_id)
+                for column in values
+                if (text_id, column, user_id) not in self.pending
+            ]
+            while new_keys and len(self.pending) + len(new_keys) > self.max_size:
+                self.cond.notify_all()
+                self._wait(deadline, "buffer space")
+                if self.stopped:
+                    raise WriteBehindException("Buffer is stopped")
+
+            for column, value in values.items():
+                self.pending[(text_id, column, user_id)] = value
+            self.writes += 1
+            batch = self.batch
+
+            if self.durability == DURABILITY_FLUSH:
+                while self.flushed < batch:
+                    self._wait(deadline, f"batch {batch} to be written")
+                if batch in self.failed_batches:
+                    raise WriteBehindException(f"Batch {batch} was not written")
+
+    def _wait(self, deadline: float, what: str):
+        # Вызывается под cond
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise WriteBehindException(f"Timed out waiting for {what}")
+        self.cond.wait(remaining)
+
+    def run(self):
+        """
+        Фоновый поток: записывает буфер раз в flush_interval секунд
+        или раньше, если буфер заполнился
+        """
+        while True:
+            with self.cond:
+                if not self.stopped and len(self.pending) < self.max_size:
+                    self.cond.wait(self.flush_interval)
+                stopped = self.stopped
+            self.flush()
+            if stopped:
+                return
+
+    def flush(self):
+        """
+        Записывает все накопленное одной транзакцией
+        """
+        with self.cond:
+            pending, self.pending = self.pending, {}
+            batch = self.batch
+            self.batch += 1
+            # Место освободилось - будим тех, кто ждет в put
+            self.cond.notify_all()
+
+        error = None
+        if pending:
+            updates = [
+                (text_id, user_id, column, value)
+                for (text_id, column, user_id), value in pending.items()
+            ]
+            try:
+                self.flush_func(updates)
+            except Exception as exc:
+                error = exc
+                logging.error(
+                    f"Error in write-behind flush of {len(updates)} updates: {exc}"
+                )
+
+        with self.cond:
+            if error is not None:
+                if self.durability == DURABILITY_FLUSH:
+                    # Ждущие в put получат ошибку и ответят клиенту сами
+                    self.failed_batches.add(batch)
+                    self.failed_batches = {
+                        failed
+                        for failed in self.failed_batches
+                        if failed > batch - 100
+                    }
+                else:
+                    # Подтвержденные действия не теряем: вернем в буфер,
+                    # не затирая более новые изменения тех же полей
+                    for key, value in pending.items():
+                        self.pending.setdefault(key, value)
+            elif pending:
+                self.flushes += 1
+            self.flushed = batch
+            self.cond.notify_all()
+
+    def stop(self):
+        """
+        Останавливает фоновый поток, записав все, что осталось в буфере
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def stats(self) -> dict:
+        """
+        Счетчики буфера (для логов и метрик)
+        """
+        with self.cond:
+            return {
+                "pending": len(self.pending),
+                "writes": self.writes,
+                "flushes": self.flushes,
+            }
@@ -0,0 +1,29 @@
+"""
+Общее для тестов: модули сервера и бенчмарков (заглушка провайдера,
+временный конфиг) доступны для импорта
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in (os.path.join(ROOT, "server", "src"), os.path.join(ROOT, "bench")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture(scope="session")
+def server():
+    """
+    Модуль server с временным конфигом (база SQLite), один на все тесты:
+    config.json читается при импорте
+    """
+    import common  # pylint: disable=import-outside-toplevel
+
+    cwd = os.getcwd()
+    module = common.load_server(nn_retry_base_delay=0.01, nn_retry_max_delay=0.05)
+    os.chdir(cwd)
+    return module
@@ -0,0 +1,88 @@
+"""
+Тесты проверки параметров запуска: кэш подписей, необязательные
+параметры и ответ на непредвиденную ошибку
+"""
+
+import sys
+import time
+
+from base64 import b64encode
+from hashlib import sha256
+from hmac import HMAC
+from urllib.parse import urlencode
+
+import pytest
+
+from auth import AuthCache, AuthException
+
+SECRET = "bench"
+
+
+def launch_params(**params) -> str:
+    """
+    Строка параметров запуска с подписью, как ее присылает ВК
+    """
+    vk_params = dict(sorted(params.items()))
+    digest = HMAC(SECRET.encode(), urlencode(vk_params).encode(), sha256).digest()
+    sign = b64encode(digest).decode()[:-1].replace("+", "-").replace("/", "_")
+    return urlencode(dict(vk_params, sign=sign))
+
+
+def test_valid_signature_is_cached():
+    cache = AuthCache(SECRET, 10, 3600)
+    authorization = launch_params(
+        vk_user_id=7, vk_platform="mobile_web", vk_ts=int(time.time())
+    )
+
+    assert cache.check(authorization)["vk_user_id"] == 7
+    assert cache.check(authorization)["vk_platform"] == "mobile_web"
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1}
+
+
+def test_params_without_platform_and_time_are_accepted():
+    cache = AuthCache(SECRET, 10, 3600)
+    authorization = launch_params(vk_user_id=7)
+
+    assert cache.check(authorization)["vk_user_id"] == 7
+    # Без vk_ts срок записи не определить: подпись проверяется каждый раз
+    assert cache.check(authorization)["vk_user_id"] == 7
+    assert cache.stats()["size"] == 0
+
+
+def test_wrong_signature_is_rejected():
+    cache = AuthCache(SECRET, 10, 3600)
+    authorization = launch_params(vk_user_id=7).replace("vk_user_id=7", "vk_user_id=8")
+
+    with pytest.raises(AuthException):
+        cache.check(authorization)
+
+
+@pytest.fixture
+def components(server):
+    """
+    Модуль components (импортируется вместе с server: конфиг читается
+    при импорте)
+    """
+    return sys.modules["components"]
+
+
+def test_post_actions_do_not_need_platform(components):
+    auth = components.get_post_auth(launch_params(vk_user_id=7))
+
+    assert (auth.status, auth.user_id, auth.platform) == (0, 7, None)
+
+
+def test_generation_needs_platform(server):
+    auth = server.get_generation_auth(launch_params(vk_user_id=7))
+
+    assert (auth.status, auth.message) == (4, "Key error. Check the header")
+
+
+def test_unexpected_error_is_status_4(components, monkeypatch):
+    def broken(authorization):
+        raise RuntimeError("cache is broken")
+
+    monkeypatch.setattr(components.auth_cache, "check", broken)
+    auth = components.get_auth(launch_params(vk_user_id=7))
+
+    assert (auth.status, auth.message) == (4, "Unknown error")
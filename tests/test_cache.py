@@ -0,0 +1,60 @@
+"""
+Тесты кэша результатов: вытеснение по LRU и TTL, счетчики
+и методы, для которых кэш включен
+"""
+
+import cache
+
+from cache import ResultCache, make_fingerprint
+
+
+class Clock:
+    """
+    Подменяет time.monotonic в модуле кэша
+    """
+
+    def __init__(self, monkeypatch):
+        self.now = 1000.0
+        monkeypatch.setattr(cache.time, "monotonic", lambda: self.now)
+
+
+def test_least_recently_used_entry_is_evicted(monkeypatch):
+    Clock(monkeypatch)
+    results = ResultCache(2, 60, ["append_text"])
+    results.put("a", "первый")
+    results.put("b", "второй")
+    assert results.get("a") == "первый"
+    results.put("c", "третий")
+
+    assert results.get("b") is None
+    assert (results.get("a"), results.get("c")) == ("первый", "третий")
+    assert results.stats() == {"size": 2, "hits": 3, "misses": 1}
+
+
+def test_expired_entry_is_dropped(monkeypatch):
+    clock = Clock(monkeypatch)
+    results = ResultCache(10, 60, ["append_text"])
+    results.put("a", "первый")
+    clock.now += 30
+    results.put("b", "второй")
+
+    clock.now += 31
+    assert results.get("a") is None
+    assert results.get("b") == "второй"
+    assert results.stats()["size"] == 1
+
+
+def test_cache_is_enabled_per_method():
+    results = ResultCache(10, 60, ["append_text", "fix_grammar"])
+
+    assert results.enabled_for("append_text")
+    assert not results.enabled_for("gen_from_scratch")
+    assert not ResultCache(0, 60, ["append_text"]).enabled_for("append_text")
+
+
+def test_fingerprint_depends_on_method_and_query():
+    fingerprint = make_fingerprint("append_text", "запрос")
+
+    assert fingerprint == make_fingerprint("append_text", "запрос")
+    assert fingerprint != make_fingerprint("extend_text", "запрос")
+    assert fingerprint != make_fingerprint("append_text", "запрос ")
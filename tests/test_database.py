@@ -0,0 +1,129 @@
+"""
+Тесты базы данных: айди новых записей при параллельных вставках,
+постраничная история по курсору, очередь задач на асинхронном движке
+"""
+
+import asyncio
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import select
+
+from async_database import AsyncDatabase
+from database import Database
+from db_common import JOB_DONE, JOB_FAILED
+from models import PostAction
+
+
+def test_parallel_inserts_get_their_own_ids(tmp_path):
+    db = Database("", "", "", 0, "", uri=f"sqlite:///{tmp_path}/test.sqlite")
+    db.migrate()
+
+    def insert_batches(worker: int) -> dict[int, str]:
+        inserted = {}
+        for batch in range(20):
+            queries = [f"{worker}-{batch}-{item}" for item in range(5)]
+            text_ids = db.add_records(
+                [
+                    {"query": query, "gen_method": "generate_text", "group_id": 1}
+                    for query in queries
+                ],
+                worker,
+                int(time.time()),
+                "vk",
+            )
+            inserted.update(zip(text_ids, queries))
+            query = f"{worker}-{batch}-single"
+            inserted[db.add_record(query, worker, "generate_text", 1, 0, "vk")] = query
+        return inserted
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(insert_batches, range(8)))
+
+    expected = {}
+    for inserted in results:
+        assert not expected.keys() & inserted.keys()
+        expected.update(inserted)
+    assert len(expected) == 8 * 20 * 6
+
+    table = db.generated_data
+    with db.engine.connect() as connection:
+        rows = dict(connection.execute(select(table.c.id, table.c.query)).fetchall())
+    assert rows == expected
+
+
+def test_history_pages_by_cursor(tmp_path):
+    db = Database("", "", "", 0, "", uri=f"sqlite:///{tmp_path}/test.sqlite")
+    db.migrate()
+    text_ids = db.add_records(
+        [
+            {"query": f"затравка {index}", "gen_method": "generate_text", "group_id": 1}
+            for index in range(7)
+        ],
+        1,
+        int(time.time()),
+        "vk",
+    )
+    for text_id in text_ids[:6]:
+        db.add_record_result(text_id, f"Пост номер {text_id}", 1)
+    db.apply_post_action(1, [text_ids[2]], PostAction.HIDE)
+    # Готовые посты: без скрытого и без последнего, у которого нет результата
+    visible = [text_ids[index] for index in (5, 4, 3, 1, 0)]
+
+    pages = [db.get_users_texts(1, 1, 2)]
+    # Новый пост между страницами не сдвигает следующие страницы
+    db.add_record_result(text_ids[6], "Свежий пост", 1)
+    while pages[-1]:
+        pages.append(db.get_users_texts(1, 1, 2, before_id=pages[-1][-1].post_id))
+
+    assert [[post.post_id for post in page] for page in pages] == [
+        visible[:2],
+        visible[2:4],
+        visible[4:],
+        [],
+    ]
+    assert db.count_users_texts(1, 1) == 6
+    assert db.get_users_texts(2, 1, 10) == []
+
+    summary = db.get_users_texts(0, 1, 1, summary_len=4)[0]
+    assert (summary.post_id, summary.hint, summary.text) == (
+        text_ids[6],
+        "затр",
+        "Свеж",
+    )
+
+
+def test_async_job_queue(tmp_path):
+    db = Database("", "", "", 0, "", uri=f"sqlite:///{tmp_path}/test.sqlite")
+    db.migrate()
+    adb = AsyncDatabase(db)
+    first, second = db.add_records(
+        [{"query": "q", "gen_method": "generate_text", "group_id": 1}] * 2,
+        7,
+        int(time.time()),
+        "vk",
+    )
+    db.add_jobs([(first, "first"), (second, "second")])
+
+    async def scenario():
+        job_id, gen_id, payload = await adb.lease_job("a", 60, 1)
+        assert (gen_id, payload) == (first, "first")
+        await adb.extend_job_lease(job_id, "a", 60)
+        await adb.finish_job(job_id, "a")
+
+        # Аренда второй задачи сразу истекает, попыток больше нет
+        assert (await adb.lease_job("b", -1, 1))[1] == second
+        assert await adb.lease_job("c", 60, 1) is None
+        assert await adb.expire_jobs(1) == [second]
+        await adb.engine.dispose()
+
+    asyncio.run(scenario())
+
+    jobs = db.generation_jobs
+    with db.engine.connect() as connection:
+        states = connection.execute(
+            select(jobs.c.gen_id, jobs.c.state, jobs.c.worker)
+        ).fetchall()
+    assert sorted(states) == [(first, JOB_DONE, "a"), (second, JOB_FAILED, "b")]
+    assert db.get_status(second) == 2
@@ -0,0 +1,71 @@
+"""
+Тесты SSE-потока генерации: результат генерации другого процесса
+приходит по базе, даже если сверка с базой не включена в конфиге
+"""
+
+import asyncio
+import json
+import time
+
+RESULT = "Клубника поспела"
+
+
+def read_events(server, gen_id: int, finish) -> list[tuple[str, dict]]:
+    """
+    Читает поток генерации gen_id до результата. finish - корутина,
+    которая завершает генерацию, пока поток ждет
+    """
+
+    async def scenario():
+        queue = server.generation_events.subscribe(gen_id)
+        events = []
+
+        async def read():
+            async for message in server.stream_generation_events(gen_id, queue):
+                if not message.startswith(":"):
+                    event, data = message.strip().split("\n")
+                    events.append((event[len("event: "):], json.loads(data[6:])))
+
+        reader = asyncio.create_task(read())
+        await asyncio.sleep(0.05)
+        await finish()
+        await asyncio.wait_for(reader, 2)
+        return events
+
+    return asyncio.run(scenario())
+
+
+def add_generation(server, owned: bool) -> int:
+    gen_id = server.db.add_record(
+        "клубника", 1, "generate_text", 1, int(time.time()), "vk"
+    )
+    server.generation_states.created(gen_id, 1, owned=owned)
+    return gen_id
+
+
+def test_other_process_result_comes_from_database(server, monkeypatch):
+    monkeypatch.setattr(server.config.events, "db_fallback", False)
+    monkeypatch.setattr(server.config.events, "fallback_interval", 0.05)
+    gen_id = add_generation(server, owned=False)
+
+    async def finish_elsewhere():
+        # Результат записал другой процесс: в шину этого событие не придет
+        server.db.add_record_result(gen_id, RESULT, 3)
+
+    events = read_events(server, gen_id, finish_elsewhere)
+
+    assert events[0] == ("status", {"text_status": 0, "text_id": gen_id})
+    assert events[-1] == ("result", {"text_status": 1, "text_data": RESULT})
+
+
+def test_own_result_comes_from_the_event_bus(server, monkeypatch):
+    monkeypatch.setattr(server.config.events, "db_fallback", False)
+    monkeypatch.setattr(server.config.events, "fallback_interval", 0.05)
+    gen_id = add_generation(server, owned=True)
+
+    async def finish_here():
+        await server.finish_generation(gen_id, RESULT, 3)
+
+    events = read_events(server, gen_id, finish_here)
+
+    assert events[-1] == ("result", {"text_status": 1, "text_data": RESULT})
@@ -0,0 +1,126 @@
+"""
+Тесты пула ключей на каждом хранилище загрузки (память процесса,
+разделяемая память, база): выбор ключа, паузы после ошибок и аренда слотов
+"""
+
+import subprocess
+import sys
+import time
+
+import pytest
+
+from database import Database
+from key_pool import KeyPool, SharedMemoryKeySlots, make_key_slots
+
+BACKENDS = ("local", "shm", "db")
+
+
+@pytest.fixture
+def make_pool(tmp_path):
+    """
+    Пул из двух ключей на хранилище backend
+    """
+    db = Database("", "", "", 0, "", uri=f"sqlite:///{tmp_path}/keys.sqlite")
+    db.migrate()
+
+    def make(backend: str, max_in_flight: int = 2) -> KeyPool:
+        pool = KeyPool(["key-a", "key-b"], max_in_flight=max_in_flight)
+        pool.use_slots(
+            make_key_slots(backend, pool, db=db, path=str(tmp_path / "slots"))
+        )
+        return pool
+
+    return make
+
+
+def key_indexes(leases) -> list[int]:
+    """
+    Номера ключей выданных аренд
+    """
+    return sorted(lease.index for lease in leases)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_least_loaded_key_is_taken_up_to_the_limit(make_pool, backend):
+    pool = make_pool(backend)
+    first, second = pool.try_acquire(), pool.try_acquire()
+    assert key_indexes([first, second]) == [0, 1]
+
+    leases = [first, second, pool.try_acquire(), pool.try_acquire()]
+    assert key_indexes(leases) == [0, 0, 1, 1]
+    assert pool.try_acquire() is None and not pool.ready()
+
+    pool.release(first)
+    assert pool.try_acquire().index == first.index
+    assert [key["in_flight"] for key in pool.stats()] == [2, 2]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_failed_key_cools_down(make_pool, backend):
+    pool = make_pool(backend, max_in_flight=1)
+    lease = pool.try_acquire()
+    lease.failed(429)
+    pool.release(lease)
+
+    assert pool.try_acquire().index != lease.index
+    assert pool.try_acquire() is None
+    assert [key["cooling_down"] for key in pool.stats()] == [
+        index == lease.index for index in range(2)
+    ]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_cooldown_grows_until_success(make_pool, backend):
+    slots = make_pool(backend).slots
+
+    def cooldown() -> float:
+        slots.cool_down(0, 10, 15)
+        return slots.snapshot()[0][1] - time.time()
+
+    assert cooldown() == pytest.approx(10, abs=1)
+    assert cooldown() == pytest.approx(15, abs=1)
+    slots.reset_strikes(0)
+    assert cooldown() == pytest.approx(10, abs=1)
+
+
+@pytest.mark.parametrize("backend", ("shm", "db"))
+def test_expired_lease_is_taken_over(make_pool, backend):
+    slots = make_pool(backend, max_in_flight=1).slots
+    stale = slots.acquire(0, -1)
+    fresh = slots.acquire(0, 60)
+    assert fresh is not None
+    assert slots.acquire(0, 60) is None
+
+    # Процесс с истекшей арендой не освобождает чужой слот
+    slots.release(0, stale)
+    assert slots.snapshot()[0][0] == 1
+    slots.release(0, fresh)
+    assert slots.snapshot()[0][0] == 0
+
+
+def test_shared_memory_is_shared_and_frees_dead_holders(tmp_path):
+    path = str(tmp_path / "slots")
+    first = SharedMemoryKeySlots(path, ["key-a"], 1)
+    second = SharedMemoryKeySlots(path, ["key-a"], 1)
+    first.acquire(0, 60)
+    assert second.snapshot() == [(1, 0.0)]
+    assert second.acquire(0, 60) is None
+
+    # Слот держит процесс, который уже завершился
+    child = subprocess.run(
+        [sys.executable, "-c", "import os; print(os.getpid())"],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    first.SLOT.pack_into(
+        first.memory,
+        first.HEADER.size + first.KEY.size,
+        int(child.stdout),
+        1,
+        time.time() + 60,
+    )
+    assert second.acquire(0, 60) is not None
+
+    # Другой набор ключей - учет начинается заново
+    assert SharedMemoryKeySlots(path, ["key-b"], 1).snapshot() == [(0, 0.0)]
@@ -0,0 +1,74 @@
+"""
+Тесты метрик: сложение снимков процессов и сбор /metrics из каталога
+"""
+
+import json
+import os
+
+from metrics import MetricsExporter, Registry, merge_snapshots
+
+
+def make_registry() -> Registry:
+    """
+    Набор метрик, как у процесса сервера
+    """
+    registry = Registry()
+    registry.counter("requests_total", "Запросы", ("path",))
+    registry.gauge("in_flight", "Запросы в работе")
+    registry.gauge("queue_depth", "Очередь в общей базе", aggregate="max")
+    registry.histogram("latency_seconds", "Задержки", buckets=(0.1, 1.0))
+    return registry
+
+
+def record(registry: Registry, requests: int, in_flight: int, depth: int):
+    """
+    Значения всех метрик процесса
+    """
+    registry.metrics["requests_total"].inc(requests, path="/status")
+    registry.metrics["in_flight"].set(in_flight)
+    registry.metrics["queue_depth"].set(depth)
+    registry.metrics["latency_seconds"].observe(0.05 * requests)
+
+
+def test_snapshots_merge_by_kind():
+    first, second, finished = make_registry(), make_registry(), make_registry()
+    record(first, 1, 3, 7)
+    record(second, 4, 5, 9)
+    record(finished, 10, 100, 100)
+
+    merged = merge_snapshots(
+        [
+            (first.snapshot(), True),
+            (second.snapshot(), True),
+            (finished.snapshot(), False),
+        ]
+    )
+
+    assert merged["requests_total"]["values"] == {("/status",): 15}
+    # Текущие значения - только по живым процессам
+    assert merged["in_flight"]["values"] == {(): 8}
+    assert merged["queue_depth"]["values"] == {(): 9}
+    # Корзины 0.1, 1.0, +Inf, затем сумма и количество
+    buckets = merged["latency_seconds"]["values"][()]
+    assert buckets[:3] == [1, 2, 0]
+    assert buckets[3:] == [0.05 + 0.2 + 0.5, 3]
+
+
+def test_collect_reads_other_processes(tmp_path):
+    own = make_registry()
+    record(own, 1, 1, 1)
+    other = make_registry()
+    record(other, 2, 1, 1)
+    with open(tmp_path / "other-1.json", "w", encoding="UTF-8") as snapshot_file:
+        json.dump(other.snapshot(), snapshot_file)
+    with open(tmp_path / "gone-2.json", "w", encoding="UTF-8") as snapshot_file:
+        json.dump(other.snapshot(), snapshot_file)
+    os.utime(tmp_path / "gone-2.json", (0, 0))
+
+    text = MetricsExporter(own, str(tmp_path), retention=3600).collect()
+
+    assert 'requests_total{path="/status"} 3.0' in text
+    assert "in_flight 2.0" in text
+    assert 'latency_seconds_bucket{le="+Inf"} 2' in text
+    # Снимок, который давно не обновлялся, удален
+    assert sorted(os.listdir(tmp_path)) == ["other-1.json"]
@@ -0,0 +1,116 @@
+"""
+Тесты запросов к нейросети со сбоями провайдера (заглушка с очередью
+сценариев): повторы, дубли запросов и места в очереди генераций
+"""
+
+import asyncio
+import time
+
+import pytest
+
+import model_client
+
+from models import GenerationMethod
+from resilience import CircuitBreaker, LatencyTracker
+from stub_model import ERROR, OK, STALL, StubModel
+
+TEXTS = ["Клубника поспела, приходите за урожаем!"]
+METHOD = GenerationMethod.APPEND
+
+
+@pytest.fixture
+def model(server, monkeypatch):
+    """
+    Свежие предохранитель и задержки методов
+    """
+    client = server.model_client
+    monkeypatch.setattr(client, "breaker", CircuitBreaker(20, 10, 0.5, 30.0))
+    monkeypatch.setattr(client, "latency", LatencyTracker())
+    return server
+
+
+def generate(server, faults: list[str], hint: str) -> tuple[bool, StubModel, list]:
+    """
+    Выполняет одну генерацию на заглушке со сценариями faults.
+    Возвращает (успех, заглушка, снимки очереди (запросов к заглушке,
+    выполняется генераций) каждые 5 мс)
+    """
+
+    async def scenario():
+        stub = StubModel(latency=0.05, stall_time=5.0, faults=faults)
+        server.config.nn.api_base = await stub.start()
+        samples = []
+        try:
+            gen_id = await server.adb.add_record(
+                hint, 1, METHOD.value, 1, int(time.time()), "vk"
+            )
+            task = asyncio.create_task(
+                server.ask_nn(METHOD.value, TEXTS, hint, gen_id, user_id=1)
+            )
+            while not task.done():
+                samples.append((stub.requests, server.fair_scheduler.running))
+                await asyncio.sleep(0.005)
+            return await task, stub, samples
+        finally:
+            server.config.nn.api_base = None
+            await stub.stop()
+
+    return asyncio.run(scenario())
+
+
+def test_retry_releases_queue_place_during_backoff(model, monkeypatch):
+    monkeypatch.setattr(model_client, "retry_delay", lambda *args: 0.3)
+
+    is_ok, stub, samples = generate(model, [ERROR, OK], "Повтор после ошибки")
+
+    assert is_ok
+    assert stub.requests == 2
+    # Ошибка получена, повтор еще не отправлен - место в очереди свободно
+    assert (1, 0) in samples
+    assert model.fair_scheduler.stats()["running"] == 0
+
+
+def test_hedge_takes_its_own_queue_place(model, monkeypatch):
+    model.model_client.latency.add(METHOD, 0.05)
+    monkeypatch.setattr(model.config.nn, "hedge_min_samples", 1)
+    monkeypatch.setattr(model.fair_scheduler, "concurrency", 2)
+
+    is_ok, stub, samples = generate(model, [STALL, OK], "Дубль на втором ключе")
+
+    assert is_ok
+    assert stub.requests == 2
+    assert max(running for _, running in samples) == 2
+    assert model.fair_scheduler.stats()["running"] == 0
+
+
+def test_no_hedge_without_a_free_queue_place(model, monkeypatch):
+    model.model_client.latency.add(METHOD, 0.05)
+    monkeypatch.setattr(model.config.nn, "hedge_min_samples", 1)
+    monkeypatch.setattr(model.fair_scheduler, "concurrency", 1)
+    monkeypatch.setitem(model.config.nn.timeouts, METHOD.value, 0.5)
+    monkeypatch.setattr(model_client, "retry_delay", lambda *args: 0.0)
+
+    start = time.monotonic()
+    is_ok, stub, samples = generate(model, [STALL, OK], "Без дубля")
+
+    # Дубля не было: вторая попытка - повтор после дедлайна первой
+    assert is_ok
+    assert stub.requests == 2
+    assert time.monotonic() - start >= 0.5
+    assert max(running for _, running in samples) == 1
+
+
+def test_failed_attempts_fail_the_generation(model, monkeypatch):
+    monkeypatch.setattr(model_client, "retry_delay", lambda *args: 0.0)
+    attempts = model.config.nn.max_attempts
+
+    is_ok, stub, _ = generate(model, [ERROR] * attempts, "Все попытки с ошибкой")
+
+    assert not is_ok
+    assert stub.requests == attempts
+    assert model.fair_scheduler.stats() == {
+        "running": 0,
+        "queued": 0,
+        "reserved": 0,
+        "tenants": 0,
+    }
@@ -0,0 +1,50 @@
+"""
+Тесты подготовки запроса: упаковка старых постов в бюджет токенов
+и оценка стоимости для очереди генераций
+"""
+
+from common import CONTEXTS_DIR
+from models import GenerationMethod
+from nn_api import MESSAGE_OVERHEAD_TOKENS, SYSTEM_PROMPT, NNApi
+from templates import TemplateRegistry
+from tokens import TokenCounter
+
+POSTS = [
+    "Клубника поспела! Приходите на ферму за свежим урожаем, " * 20
+    for _ in range(10)
+]
+HINT = "Приходите к нам за клубникой, урожай в этом году отличный"
+
+
+def prepare(method: GenerationMethod, texts: list[str] = POSTS) -> NNApi:
+    api = NNApi(TemplateRegistry(CONTEXTS_DIR).get(method), method, TokenCounter())
+    api.prepare_query(texts, HINT)
+    return api
+
+
+def test_edits_are_cheaper_than_generation():
+    fix_grammar = prepare(GenerationMethod.FIX_GRAMMAR)
+    from_scratch = prepare(GenerationMethod.GENERATE_FROM_SCRATCH)
+
+    assert fix_grammar.estimated_cost() < from_scratch.estimated_cost()
+    # Правка без старых постов - это почти только бюджет ответа
+    assert fix_grammar.prompt_tokens < 500
+
+
+def test_cost_counts_only_the_sent_query():
+    counter = TokenCounter()
+    for method in GenerationMethod:
+        api = prepare(method)
+        system_tokens = MESSAGE_OVERHEAD_TOKENS + counter.count(SYSTEM_PROMPT)
+        assert api.prompt_tokens == system_tokens + counter.count(api.query)
+        if not api.template.needs_old_texts:
+            # Старые посты в запрос правки не попадают и цену не меняют
+            assert POSTS[0] not in api.query
+            assert api.prompt_tokens == prepare(method, []).prompt_tokens
+
+
+def test_packing_fits_the_token_budget():
+    api = prepare(GenerationMethod.GENERATE, POSTS * 10)
+
+    assert 0 < api.query.count(POSTS[0]) < len(POSTS) * 10
+    assert api.prompt_tokens + api.reply_tokens <= 4096
@@ -0,0 +1,38 @@
+"""
+Тесты ранжирования старых постов по близости к затравке (BM25)
+"""
+
+from ranking import rank_texts, term_frequencies, tokenize
+
+POSTS = [
+    "Открываем сезон катания на велосипедах по набережной",
+    "Клубника поспела: собираем клубнику на ферме каждое утро",
+    "Концерт в субботу, вход свободный",
+    "Варенье из клубники по бабушкиному рецепту",
+]
+
+
+def test_tokenize_stems_words():
+    words = tokenize("Клубника, КЛУБНИКУ и клубникой!")
+    assert words == ["клубни", "клубни", "и", "клубни"]
+
+
+def test_closest_posts_go_first():
+    ranked = rank_texts(POSTS, "Урожай клубники на ферме")
+
+    assert ranked[:2] == [POSTS[1], POSTS[3]]
+    # Посты без совпадений сохраняют исходный порядок
+    assert ranked[2:] == [POSTS[0], POSTS[2]]
+
+
+def test_term_frequencies_count_only_hint_terms():
+    tf, lengths = term_frequencies(POSTS[1:2], ["клубни", "ферме", "урожай"], 1e18)
+
+    assert tf.tolist() == [[2.0, 1.0, 0.0]]
+    assert lengths.tolist() == [8]
+
+
+def test_posts_past_the_time_budget_keep_their_order():
+    texts = POSTS * 50
+    assert rank_texts(texts, "клубника", time_budget=0.0) == texts
+    assert rank_texts(texts, "") == texts
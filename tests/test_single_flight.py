@@ -0,0 +1,108 @@
+"""
+Тесты объединения одинаковых генераций: ждущие генерации получают
+исход первой, в том числе ошибку и отмену, и проходят те же лимиты
+"""
+
+import asyncio
+import time
+
+import pytest
+
+from fastapi import BackgroundTasks, Response
+
+from auth import AuthResult
+from models import GenerateQueryModel
+from scheduler import FairScheduler, RateLimiter
+from stub_model import STALL, StubModel
+
+TEXTS = ["Клубника поспела, приходите за урожаем!"]
+HINT = "Собираем клубнику"
+
+
+async def start_generation(server, gen_id: int) -> asyncio.Task:
+    """
+    Запускает генерацию gen_id тем же запросом, что и остальные,
+    с местом в очереди, занятым при приеме
+    """
+    assert server.fair_scheduler.try_reserve(1)
+    return asyncio.create_task(
+        server.ask_nn("append_text", TEXTS, HINT, gen_id, user_id=1, reserved=True)
+    )
+
+
+def test_followers_fail_when_leader_is_cancelled(server):
+    async def scenario():
+        stub = StubModel(latency=0.05, faults=[STALL])
+        server.config.nn.api_base = await stub.start()
+        try:
+            gen_ids = [
+                server.db.add_record(HINT, 1, "append_text", 1, int(time.time()), "vk")
+                for _ in range(3)
+            ]
+            leader = await start_generation(server, gen_ids[0])
+            while stub.requests == 0:
+                await asyncio.sleep(0.01)
+            followers = [
+                await start_generation(server, gen_id) for gen_id in gen_ids[1:]
+            ]
+            await asyncio.sleep(0.05)
+            assert server.single_flight.stats()["coalesced"] == 2
+
+            leader.cancel()
+            results = await asyncio.wait_for(asyncio.gather(*followers), 5)
+            assert results == [False, False]
+            with pytest.raises(asyncio.CancelledError):
+                await leader
+            # Места в очереди вернулись: и ведущей, и присоединившихся
+            assert server.fair_scheduler.stats()["reserved"] == 0
+            assert server.fair_scheduler.stats()["queued"] == 0
+            assert stub.requests == 1
+            return gen_ids
+        finally:
+            server.config.nn.api_base = None
+            await stub.stop()
+
+    for gen_id in asyncio.run(scenario()):
+        assert server.db.get_status(gen_id) == 2
+
+
+def send_follower(server) -> int:
+    """
+    Отправляет запрос, такой же, как идущая генерация. Возвращает status ответа
+    """
+    data = GenerateQueryModel(
+        method="append_text", context_data=TEXTS, hint=HINT, group_id=1
+    )
+    auth = AuthResult({"vk_user_id": 1, "vk_platform": "vk"})
+    result = server.process_method(
+        data.method, data, BackgroundTasks(), auth, Response()
+    )
+    return result.status
+
+
+@pytest.fixture
+def flight(server, monkeypatch):
+    """
+    Такая же генерация уже идет
+    """
+    _, fingerprint, _ = server.find_cached("append_text", TEXTS, HINT)
+    monkeypatch.setattr(server.single_flight, "flights", {fingerprint: None})
+    assert server.single_flight.in_flight(fingerprint)
+
+
+def test_coalesced_follower_is_rate_limited(server, monkeypatch, flight):
+    monkeypatch.setattr(server, "rate_limiter", RateLimiter(0.001, 1, 0, 0))
+
+    assert send_follower(server) == 0
+    assert send_follower(server) == 7
+
+
+def test_coalesced_follower_takes_a_queue_place(server, monkeypatch, flight):
+    monkeypatch.setattr(server, "rate_limiter", RateLimiter(0, 0, 0, 0))
+    monkeypatch.setattr(
+        server, "fair_scheduler", FairScheduler(1, max_tenant_queue=1)
+    )
+
+    assert send_follower(server) == 0
+    assert send_follower(server) == 7
+    assert server.fair_scheduler.stats()["reserved"] == 1
@@ -0,0 +1,93 @@
+"""
+Тесты хранилища состояний генераций: когда можно верить локальному
+кэшу, чтение из общего хранилища и запись в него из корутин
+"""
+
+import asyncio
+import time
+
+from state_store import GenerationStateStore, MemoryBackend, StateStoreException
+
+
+class SlowBackend(MemoryBackend):
+    """
+    Общее хранилище с сетевой задержкой на каждую запись
+    """
+
+    def update(self, gen_id: int, fields: dict):
+        time.sleep(0.2)
+        super().update(gen_id, fields)
+
+
+class BrokenBackend(MemoryBackend):
+    """
+    Недоступное общее хранилище
+    """
+
+    def get(self, gen_id: int) -> dict:
+        raise StateStoreException("Connection refused")
+
+    def update(self, gen_id: int, fields: dict):
+        raise StateStoreException("Connection refused")
+
+
+def test_owned_generation_is_served_from_memory():
+    store = GenerationStateStore(10)
+    store.created(5, user_id=1)
+
+    assert store.get(5) == {"user_id": 1, "status": 0, "owned": True}
+    store.finished(5, "Готово")
+    assert store.get(5)["text"] == "Готово"
+
+
+def test_foreign_pending_generation_goes_to_shared_store():
+    shared = MemoryBackend(10)
+    api = GenerationStateStore(10, shared)
+    worker = GenerationStateStore(10, shared)
+    api.created(5, user_id=1, owned=False)
+
+    # Локальный статус 0 чужой генерации мог устареть
+    assert api.get(5)["status"] == 0
+    worker.finished(5, "Готово")
+    assert api.get(5) == {"user_id": 1, "status": 1, "text": "Готово"}
+    assert api.stats()["misses"] == 0
+
+
+def test_unavailable_shared_store_falls_back_to_database():
+    store = GenerationStateStore(10, BrokenBackend(10))
+    store.created(5, user_id=1, owned=False)
+
+    assert store.get(5) is None
+    assert store.stats()["misses"] == 1
+
+
+def test_local_cache_is_bounded():
+    store = GenerationStateStore(2)
+    for gen_id in range(5):
+        store.remember(gen_id, user_id=1, status=1)
+
+    assert store.stats()["size"] == 2
+    assert store.get(0) is None
+
+
+def test_async_writes_do_not_block_the_event_loop():
+    store = GenerationStateStore(10, SlowBackend(10))
+
+    async def scenario():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        await store.created_async(5, user_id=1)
+        await store.finished_async(5, "Готово")
+        task.cancel()
+        return ticks
+
+    # Две записи по 0.2 с: event loop все это время обслуживал другие корутины
+    assert asyncio.run(scenario()) >= 20
+    assert store.shared.get(5)["status"] == 1
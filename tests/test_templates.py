@@ -0,0 +1,77 @@
+"""
+Тесты реестра шаблонов: подстановка за один проход, перечитывание
+измененного файла и работа без файла
+"""
+
+import os
+
+import pytest
+
+from models import GenerationMethod
+from templates import TemplateException, TemplateRegistry
+
+
+@pytest.fixture
+def contexts(tmp_path):
+    """
+    Каталог с шаблоном на каждый метод
+    """
+    for method in GenerationMethod:
+        (tmp_path / f"{method.value}.txt").write_text(
+            "Посты: [OLD_TEXTS]\nЗатравка: [HINT]", encoding="UTF-8"
+        )
+    return tmp_path
+
+
+def touch(path, text: str):
+    """
+    Переписывает файл и сдвигает его mtime, чтобы изменение было видно
+    даже при грубом разрешении времени файловой системы
+    """
+    path.write_text(text, encoding="UTF-8")
+    mtime = os.stat(path).st_mtime + 10
+    os.utime(path, (mtime, mtime))
+
+
+def test_template_renders_placeholders(contexts):
+    template = TemplateRegistry(str(contexts)).get("generate_text")
+
+    assert template.needs_hint and template.needs_old_texts
+    assert template.static_text == "Посты: \nЗатравка: "
+    # Плейсхолдер внутри подставленного текста не раскрывается второй раз
+    assert (
+        template.render("пост про [HINT]", "клубника")
+        == "Посты: пост про [HINT]\nЗатравка: клубника"
+    )
+
+
+def test_changed_file_is_reloaded_after_check_interval(contexts):
+    registry = TemplateRegistry(str(contexts), check_interval=0)
+    touch(contexts / "fix_grammar.txt", "Исправь: [HINT]")
+
+    template = registry.get("fix_grammar")
+    assert template.render("", "текст") == "Исправь: текст"
+    assert not template.needs_old_texts
+
+
+def test_changes_wait_for_check_interval(contexts):
+    registry = TemplateRegistry(str(contexts), check_interval=3600)
+    touch(contexts / "fix_grammar.txt", "Исправь: [HINT]")
+
+    assert registry.get("fix_grammar").needs_old_texts
+
+
+def test_removed_file_keeps_the_loaded_template(contexts):
+    registry = TemplateRegistry(str(contexts), check_interval=0)
+    os.remove(contexts / "append_text.txt")
+
+    assert registry.get("append_text").render("", "а") == "Посты: \nЗатравка: а"
+
+
+def test_unknown_method_and_missing_file_raise(contexts):
+    with pytest.raises(TemplateException):
+        TemplateRegistry(str(contexts)).get("write_poem")
+
+    os.remove(contexts / "unmask_text.txt")
+    with pytest.raises(TemplateException):
+        TemplateRegistry(str(contexts))
@@ -0,0 +1,180 @@
+"""
+Тесты очереди задач: задача воркера, убитого посреди генерации,
+достается другому воркеру после истечения аренды
+"""
+
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from sqlalchemy import select
+
+from common import ROOT, SRC_DIR, write_config
+from database import Database
+from db_common import JOB_DONE, JOB_FAILED, JOB_LEASED
+
+
+def wait_for(predicate, timeout: float) -> bool:
+    """
+    Ждет, пока predicate() не станет истинным, не дольше timeout секунд
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def free_port() -> int:
+    """
+    Свободный локальный порт
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def start_stub():
+    """
+    Запускает заглушку провайдера отдельным процессом (воркеры ходят
+    к ней из своих процессов), возвращает ее адрес для nn_api_base
+    """
+    processes = []
+
+    def start(*args: str) -> str:
+        port = free_port()
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(ROOT, "bench", "stub_model.py"),
+                "--port",
+                str(port),
+                *args,
+            ],
+            stdout=subprocess.DEVNULL,
+        )
+        processes.append(process)
+
+        def accepts() -> bool:
+            try:
+                socket.create_connection(("127.0.0.1", port), 0.1).close()
+                return True
+            except OSError:
+                return False
+
+        assert wait_for(accepts, 10)
+        return f"http://127.0.0.1:{port}/v1"
+
+    yield start
+    for process in processes:
+        process.kill()
+        process.wait()
+
+
+def start_worker(workdir: str) -> subprocess.Popen:
+    """
+    Запускает процесс worker.py с конфигом из workdir
+    """
+    return subprocess.Popen(
+        [sys.executable, os.path.join(SRC_DIR, "worker.py")],
+        cwd=workdir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def stop_worker(worker: subprocess.Popen):
+    """
+    Убивает процесс воркера без шанса что-то дописать
+    """
+    worker.send_signal(signal.SIGKILL)
+    worker.wait()
+
+
+def queue_generation(workdir: str, **overrides) -> tuple[Database, int]:
+    """
+    Готовит базу в workdir и ставит в очередь одну генерацию
+    """
+    write_config(
+        workdir,
+        use_job_queue=True,
+        job_visibility_timeout=2,
+        job_poll_interval=0.1,
+        nn_hedge=False,
+        **overrides,
+    )
+    db = Database("", "", "", 0, "", uri=f"sqlite:///{workdir}/bench.sqlite")
+    db.migrate()
+    gen_id = db.add_record("клубника", 1, "generate_text", 1, int(time.time()), "web")
+    db.add_job(
+        gen_id,
+        json.dumps(
+            {
+                "method": "generate_text",
+                "texts": ["Пост о летнем урожае клубники"],
+                "hint": "клубника",
+                "user_id": 1,
+            },
+            ensure_ascii=False,
+        ),
+    )
+    return db, gen_id
+
+
+def get_job(db: Database) -> dict:
+    """
+    Единственная задача в очереди
+    """
+    with db.engine.connect() as connection:
+        row = connection.execute(select(db.generation_jobs)).fetchall()[0]
+    return dict(row._mapping)
+
+
+def test_killed_worker_job_is_picked_up_again(tmp_path, start_stub):
+    stub_url = start_stub("--latency", "3")
+    db, gen_id = queue_generation(str(tmp_path), nn_api_base=stub_url)
+
+    first = start_worker(str(tmp_path))
+    try:
+        assert wait_for(lambda: get_job(db)["state"] == JOB_LEASED, 30)
+        first_holder = get_job(db)["worker"]
+    finally:
+        stop_worker(first)
+    # Генерация не закончена, задача висит на мертвом воркере
+    assert db.get_status(gen_id) == 0
+
+    second = start_worker(str(tmp_path))
+    try:
+        assert wait_for(lambda: db.get_status(gen_id) != 0, 30)
+    finally:
+        stop_worker(second)
+
+    job = get_job(db)
+    assert db.get_status(gen_id) == 1
+    assert db.get_value(gen_id).startswith("Ответ заглушки")
+    assert job["state"] == JOB_DONE
+    assert job["attempts"] == 2
+    assert job["worker"] != first_holder
+
+
+def test_failed_generation_fails_its_job(tmp_path, start_stub):
+    # 400 - ошибка в запросе, ее не повторяют
+    stub_url = start_stub("--latency", "0", "--error-rate", "1", "--error-status", "400")
+    db, gen_id = queue_generation(str(tmp_path), nn_api_base=stub_url)
+
+    worker = start_worker(str(tmp_path))
+    try:
+        assert wait_for(lambda: get_job(db)["state"] == JOB_FAILED, 30)
+    finally:
+        stop_worker(worker)
+
+    assert db.get_status(gen_id) == 2
+    assert get_job(db)["attempts"] == 1
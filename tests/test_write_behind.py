@@ -0,0 +1,97 @@
+"""
+Тесты буфера отложенной записи: схлопывание изменений, сохранность
+при ошибке записи и ограниченное ожидание коммита
+"""
+
+import threading
+import time
+
+import pytest
+
+from write_behind import (
+    DURABILITY_FLUSH,
+    DURABILITY_MEMORY,
+    WriteBehindBuffer,
+    WriteBehindException,
+)
+
+
+class Storage:
+    """
+    База для flush_func: записанные пачки, может падать или зависать
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.failing = False
+        self.hung = threading.Event()
+
+    def write(self, updates: list):
+        if self.hung.is_set():
+            time.sleep(1.0)
+        if self.failing:
+            raise ConnectionError("Database is down")
+        self.batches.append(sorted(updates))
+
+
+def test_changes_of_one_field_coalesce_per_user():
+    storage = Storage()
+    buffer = WriteBehindBuffer(storage.write, 100, 60.0)
+    buffer.put(1, 10, {"rating": 1})
+    buffer.put(1, 10, {"rating": -1})
+    buffer.put(2, 10, {"rating": 1})
+    buffer.stop()
+
+    assert storage.batches == [[(10, 1, "rating", -1), (10, 2, "rating", 1)]]
+
+
+def test_failed_flush_keeps_confirmed_changes():
+    storage = Storage()
+    storage.failing = True
+    buffer = WriteBehindBuffer(storage.write, 100, 60.0, DURABILITY_MEMORY)
+    buffer.put(1, 10, {"hidden": 1})
+    buffer.flush()
+
+    assert buffer.stats()["pending"] == 1
+    storage.failing = False
+    buffer.stop()
+    assert storage.batches == [[(10, 1, "hidden", 1)]]
+
+
+def test_flush_durability_reports_failed_batch():
+    storage = Storage()
+    storage.failing = True
+    buffer = WriteBehindBuffer(storage.write, 100, 0.01, DURABILITY_FLUSH)
+
+    with pytest.raises(WriteBehindException, match="not written"):
+        buffer.put(1, 10, {"published": 1})
+    buffer.stop()
+
+
+def test_put_does_not_wait_forever_for_a_hung_database():
+    storage = Storage()
+    storage.hung.set()
+    buffer = WriteBehindBuffer(
+        storage.write, 100, 0.01, DURABILITY_FLUSH, put_timeout=0.2
+    )
+
+    start = time.monotonic()
+    with pytest.raises(WriteBehindException, match="Timed out"):
+        buffer.put(1, 10, {"published": 1})
+    assert time.monotonic() - start < 0.5
+    storage.hung.clear()
+    buffer.stop()
+
+
+def test_put_does_not_wait_forever_for_buffer_space():
+    storage = Storage()
+    storage.hung.set()
+    buffer = WriteBehindBuffer(storage.write, 1, 60.0, put_timeout=0.2)
+    # Первая пачка пишется и зависла, вторая заполнила буфер
+    buffer.put(1, 10, {"hidden": 1})
+    buffer.put(1, 11, {"hidden": 1})
+
+    with pytest.raises(WriteBehindException, match="Timed out"):
+        buffer.put(1, 12, {"hidden": 1})
+    storage.hung.clear()
+    buffer.stop()